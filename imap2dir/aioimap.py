@@ -0,0 +1,973 @@
+"""
+A small asyncio IMAP4rev1 client (IMAPS only) that pipelines commands.
+
+Every connection sends commands as soon as they're issued, without
+waiting for the previous ones to complete; untagged responses are
+attributed to the oldest command still waiting for its completion,
+which is what servers processing commands in order will produce.
+Literals in those responses can be streamed into a caller-provided
+sink rather than kept in memory, which is how large messages get
+downloaded. Connections can switch to COMPRESS=DEFLATE (RFC 4978)
+once logged in.
+A pool keeps a number of these connections logged in and with the
+folder selected, and spreads commands over them; it's meant to last
+for as long as there's work to be done on the folder, with idle
+connections checked (and replaced if need be) before being put back
+to work.
+"""
+import asyncio
+from collections import OrderedDict
+import itertools
+import random
+import re
+import ssl
+import time
+import zlib
+
+IMAPS_PORT = 993
+READ_CHUNK_SIZE = 64 * 1024
+DEFAULT_PIPELINE_DEPTH = 4
+MAX_COMMAND_ATTEMPTS = 3
+MAX_THROTTLED_ATTEMPTS = 10
+THROTTLED_CODES = frozenset([b'THROTTLED', b'UNAVAILABLE', b'LIMIT'])
+BACKOFF_INITIAL_DELAY = 1.0
+BACKOFF_MAX_DELAY = 120.0
+TARGET_COMMAND_SECONDS = 10.0
+MIN_BATCH_FACTOR = 1.0 / 32
+BATCH_FACTOR_STEP = 1.0 / 32
+MAX_ERROR_RATE_TO_GROW = 0.05
+EWMA_WEIGHT = 0.1
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class IMAPError(Exception):
+    pass
+
+class IMAPCommandError(IMAPError):
+    def __init__(self, command, response):
+        super().__init__('%s failed: %s %s' % (
+            command, response.status.decode('ascii', 'replace'),
+            response.text.decode('utf-8', 'replace')))
+        self.response = response
+
+class IMAPConnectionLost(IMAPError):
+    pass
+
+class Literal:
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+def astring(value):
+    # quoted string when possible, literal otherwise
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    if not value.isascii() or b'\r' in value or b'\n' in value:
+        return Literal(value)
+    return b'"' + value.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+
+RESPONSE_CODE_RE = re.compile(rb'^\[([^\s\]]+)(?: ([^\]]*))?\] ?')
+LITERAL_MARKER_RE = re.compile(rb'\{(\d+)\}$')
+ATOM_RE = re.compile(rb'[^\s()"\[\]]+(?:\[[^\]]*\](?:<[\d.]+>)?)?')
+QUOTED_RE = re.compile(rb'"((?:[^"\\]|\\.)*)"')
+QUOTED_ESCAPE_RE = re.compile(rb'\\(.)')
+
+def tokenize(segments):
+    # Turns a response made of text and literal segments into nested
+    # lists of tokens; atoms and strings become bytes, NIL becomes None
+    stack = [[]]
+    for index, segment in enumerate(segments):
+        if index % 2 == 1:
+            stack[-1].append(segment)
+            continue
+        text = segment
+        if index + 1 < len(segments):
+            text = LITERAL_MARKER_RE.sub(b'', text)
+        position = 0
+        while position < len(text):
+            char = text[position:position + 1]
+            if char == b' ':
+                position += 1
+            elif char == b'(':
+                stack.append([])
+                position += 1
+            elif char == b')':
+                closed = stack.pop()
+                stack[-1].append(closed)
+                position += 1
+            elif char == b'"':
+                match = QUOTED_RE.match(text, position)
+                stack[-1].append(QUOTED_ESCAPE_RE.sub(rb'\1', match.group(1)))
+                position = match.end()
+            else:
+                match = ATOM_RE.match(text, position)
+                if match is None:
+                    # stray bracket or the like
+                    stack[-1].append(char)
+                    position += 1
+                    continue
+                atom = match.group(0)
+                stack[-1].append(None if atom.upper() == b'NIL' else atom)
+                position = match.end()
+    while len(stack) > 1:
+        # unbalanced; be lenient
+        closed = stack.pop()
+        stack[-1].append(closed)
+    return stack[0]
+
+def response_code(text):
+    # (name, value) out of "[NAME value] human readable text"
+    match = RESPONSE_CODE_RE.match(text)
+    if match is None:
+        return (None, None)
+    return (match.group(1).upper(), match.group(2))
+
+class UntaggedResponse:
+    """An untagged ("* ...") server response."""
+    __slots__ = ('keyword', 'number', 'segments')
+
+    def __init__(self, segments):
+        first = segments[0][2:]
+        parts = first.split(b' ', 2)
+        if parts[0].isdigit() and len(parts) > 1:
+            self.number = int(parts[0])
+            self.keyword = parts[1].upper()
+            rest = parts[2] if len(parts) > 2 else b''
+        else:
+            self.number = None
+            self.keyword = parts[0].upper()
+            rest = first[len(parts[0]) + 1:]
+        self.segments = [rest] + segments[1:]
+
+    @property
+    def text(self):
+        return self.segments[0]
+
+    def tokens(self):
+        return tokenize(self.segments)
+
+    def fetch_attributes(self):
+        # {b'UID': b'12', b'RFC822.SIZE': b'345', b'BODY[...]': b'...'}
+        attributes = self.tokens()[0]
+        return dict(
+                (name.upper(), value)
+                for name, value in zip(attributes[::2], attributes[1::2]))
+
+class Response:
+    """The completion of a command, along with its untagged responses."""
+    __slots__ = ('status', 'text', 'untagged')
+
+    def __init__(self, status, text, untagged):
+        self.status = status
+        self.text = text
+        self.untagged = untagged
+
+    @property
+    def code(self):
+        return response_code(self.text)
+
+    def filter(self, keyword):
+        return [resp for resp in self.untagged if resp.keyword == keyword]
+
+    def untagged_code(self, name):
+        # value of the last "* OK [NAME value]" response
+        value = None
+        for resp in self.untagged:
+            if resp.keyword in (b'OK', b'NO', b'BAD'):
+                code_name, code_value = response_code(resp.text)
+                if code_name == name:
+                    value = code_value
+        return value
+
+    def search_results(self):
+        return [int(uid)
+                for resp in self.filter(b'SEARCH')
+                for uid in resp.text.split()
+                if uid.isdigit()]
+
+class PendingCommand:
+    __slots__ = ('name', 'future', 'untagged', 'literal_sink')
+
+    def __init__(self, name, future, literal_sink=None):
+        self.name = name
+        self.future = future
+        self.untagged = []
+        self.literal_sink = literal_sink
+
+def split_address(address):
+    # 'host:port' -> (host, port); (address, None) when there's no port
+    host, separator, port = address.rpartition(':')
+    if not separator or not port.isdigit() or ':' in host:
+        return (address, None)
+    return (host, int(port))
+
+class Connection:
+    """A single IMAPS connection on which commands can be pipelined."""
+
+    def __init__(self, hostname, port=None, ssl_context=None, budget=None):
+        # the port can also be given as part of the hostname ('host:port')
+        self.hostname, address_port = split_address(hostname)
+        self.port = port or address_port or IMAPS_PORT
+        self.ssl_context = ssl_context or ssl.create_default_context()
+        self.budget = budget
+        self.capabilities = frozenset()
+        self.unsolicited = []
+        self.closed = False
+        self.bye = None
+        self.compressed = False
+        self.last_active = time.monotonic()
+        self._compressor = None
+        self._decompressor = None
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._buffer = bytearray()
+        self._tag_counter = 0
+        self._pending = OrderedDict()
+        self._send_lock = asyncio.Lock()
+        # (tag, future) of the command waiting to send a literal
+        self._continuation = None
+        self._greeting = None
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(
+                self.hostname, self.port, ssl=self.ssl_context)
+        loop = asyncio.get_running_loop()
+        self._greeting = loop.create_future()
+        self._read_task = asyncio.ensure_future(self._read_responses())
+        greeting = await self._greeting
+        if greeting.keyword not in (b'OK', b'PREAUTH'):
+            raise IMAPError('unexpected greeting: %s' % repr(greeting.text))
+        code_name, code_value = response_code(greeting.text)
+        if code_name == b'CAPABILITY':
+            self._set_capabilities(code_value)
+        else:
+            await self.refresh_capabilities()
+
+    def _set_capabilities(self, value):
+        self.capabilities = frozenset(
+                str(capability, 'ascii').upper()
+                for capability in value.split())
+
+    async def refresh_capabilities(self):
+        response = await self.command(b'CAPABILITY')
+        for resp in response.filter(b'CAPABILITY'):
+            self._set_capabilities(resp.text)
+
+    async def login(self, username, password):
+        response = await self.command(
+                b'LOGIN', astring(username), astring(password))
+        code_name, code_value = response.code
+        if code_name == b'CAPABILITY':
+            self._set_capabilities(code_value)
+        else:
+            await self.refresh_capabilities()
+        return response
+
+    async def enable(self, *extensions):
+        response = await self.command(
+                b'ENABLE', *[ext.encode('ascii') for ext in extensions])
+        return frozenset(
+                str(ext, 'ascii').upper()
+                for resp in response.filter(b'ENABLED')
+                for ext in resp.text.split())
+
+    async def compress(self):
+        # nothing else may be in flight; from the server's OK on,
+        # everything gets deflated both ways (see _dispatch())
+        return await self.command(b'COMPRESS', b'DEFLATE')
+
+    def _start_compression(self):
+        self.compressed = True
+        self._compressor = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        # whatever was read past the OK is deflated already
+        self._buffer[:] = self._decompressor.decompress(bytes(self._buffer))
+
+    async def select(self, folder_name, readonly=False):
+        response = await self.command(
+                b'EXAMINE' if readonly else b'SELECT', astring(folder_name))
+        exists = [resp.number for resp in response.filter(b'EXISTS')]
+        return dict(
+                exists=exists[-1] if exists else 0,
+                uidvalidity=int_or_none(response.untagged_code(b'UIDVALIDITY')),
+                uidnext=int_or_none(response.untagged_code(b'UIDNEXT')),
+                highestmodseq=int_or_none(
+                    response.untagged_code(b'HIGHESTMODSEQ')))
+
+    async def list(self, reference, pattern):
+        # (attributes, delimiter, name) for every matching folder
+        response = await self.command(
+                b'LIST', astring(reference), astring(pattern))
+        folders = []
+        for resp in response.filter(b'LIST'):
+            tokens = resp.tokens()
+            if len(tokens) < 3 or not isinstance(tokens[0], list):
+                continue
+            attributes, delimiter, name = tokens[:3]
+            folders.append((
+                frozenset(
+                    str(attribute, 'ascii', 'replace').lower()
+                    for attribute in attributes),
+                None if delimiter is None else str(delimiter, 'utf-8'),
+                str(name, 'utf-8')))
+        return folders
+
+    async def status(self, folder_name, *items):
+        # {'MESSAGES': 12, ...}
+        response = await self.command(
+                b'STATUS', astring(folder_name),
+                b'(' + b' '.join(item.encode('ascii') for item in items) + b')')
+        values = {}
+        for resp in response.filter(b'STATUS'):
+            tokens = resp.tokens()
+            if len(tokens) < 2 or not isinstance(tokens[-1], list):
+                continue
+            status_items = tokens[-1]
+            for name, value in zip(status_items[::2], status_items[1::2]):
+                values[str(name, 'ascii').upper()] = int_or_none(value)
+        return values
+
+    async def logout(self):
+        try:
+            await self.command(b'LOGOUT')
+        except IMAPError:
+            pass
+        self.close()
+
+    def close(self):
+        self.closed = True
+        if self._writer is not None:
+            self._writer.close()
+        if self._read_task is not None:
+            self._read_task.cancel()
+        self._fail_pending(IMAPConnectionLost('connection closed'))
+
+    async def command(self, name, *args, check=True, literal_sink=None):
+        # literal_sink(line, size), if given, is called for every literal
+        # in the command's untagged responses; whatever it returns other
+        # than None gets the literal written into it (in chunks of up to
+        # READ_CHUNK_SIZE), is closed right after (if it can be), and
+        # takes its place in the response.
+        # With a budget, commands the server refuses to run for the time
+        # being ([THROTTLED] and the like) are retried after a backoff.
+        throttled_attempt = 0
+        while True:
+            started = time.monotonic()
+            response = await self._command(name, args, literal_sink)
+            self.last_active = time.monotonic()
+            if self.budget is None:
+                break
+            if not is_throttled_response(response):
+                self.budget.record_success(
+                        time.monotonic() - started, command_name(name, args))
+                break
+            throttled_attempt += 1
+            if throttled_attempt >= MAX_THROTTLED_ATTEMPTS:
+                break
+            await asyncio.sleep(self.budget.record_throttled(
+                str(response.text, 'utf-8', 'replace')))
+        if check and response.status != b'OK':
+            raise IMAPCommandError(
+                    str(name, 'ascii', 'replace'), response)
+        return response
+
+    async def _command(self, name, args, literal_sink):
+        if self.closed:
+            raise IMAPConnectionLost('connection is closed')
+        self._tag_counter += 1
+        tag = b'A%d' % self._tag_counter
+        pending = PendingCommand(
+                name, asyncio.get_running_loop().create_future(),
+                literal_sink)
+        async with self._send_lock:
+            if self.closed:
+                raise IMAPConnectionLost('connection is closed')
+            self._pending[tag] = pending
+            try:
+                await self._send_command(tag, name, args)
+            except (OSError, IMAPConnectionLost) as e:
+                self._pending.pop(tag, None)
+                raise (e if isinstance(e, IMAPConnectionLost)
+                        else IMAPConnectionLost(repr(e)))
+        return await pending.future
+
+    async def _send_command(self, tag, name, args):
+        line = [tag, name]
+        for arg in args:
+            if isinstance(arg, str):
+                arg = arg.encode('utf-8')
+            if isinstance(arg, Literal):
+                if 'LITERAL+' in self.capabilities:
+                    line.append(b'{%d+}\r\n' % len(arg.data))
+                    self._write(b' '.join(line))
+                    line = [arg.data]
+                else:
+                    line.append(b'{%d}\r\n' % len(arg.data))
+                    continuation = asyncio.get_running_loop().create_future()
+                    self._continuation = (tag, continuation)
+                    self._write(b' '.join(line))
+                    try:
+                        await self._writer.drain()
+                        await continuation
+                    except IMAPCommandError:
+                        # rejected before we got to send the literal;
+                        # the command is over (see _dispatch)
+                        return
+                    except BaseException:
+                        # abandoned part-way: the server would take
+                        # whatever we sent next for the rest of it
+                        self._pending.pop(tag, None)
+                        self.close()
+                        raise
+                    line = [arg.data]
+            else:
+                line.append(arg)
+        self._write(b' '.join(line) + b'\r\n')
+        await self._writer.drain()
+
+    def _write(self, data):
+        if self._writer.is_closing():
+            raise IMAPConnectionLost('connection is closed')
+        uncompressed_size = len(data)
+        if self._compressor is not None:
+            data = (self._compressor.compress(data)
+                    + self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        if self.budget is not None:
+            self.budget.bytes_sent += len(data)
+            self.budget.uncompressed_bytes_sent += uncompressed_size
+        self._writer.write(data)
+
+    async def _fill(self):
+        data = await self._reader.read(READ_CHUNK_SIZE)
+        if not data:
+            raise IMAPConnectionLost(
+                    'connection closed by server'
+                    if self.bye is None else
+                    'connection closed by server: %s' % repr(self.bye))
+        compressed_size = len(data)
+        if self._decompressor is not None:
+            data = self._decompressor.decompress(data)
+        if self.budget is not None:
+            self.budget.bytes_received += compressed_size
+            self.budget.uncompressed_bytes_received += len(data)
+        self._buffer.extend(data)
+
+    async def _readline(self):
+        start = 0
+        while True:
+            end = self._buffer.find(b'\r\n', start)
+            if end >= 0:
+                line = bytes(self._buffer[:end])
+                del self._buffer[:end + 2]
+                return line
+            start = max(0, len(self._buffer) - 1)
+            await self._fill()
+
+    async def _read_exactly(self, size):
+        while len(self._buffer) < size:
+            await self._fill()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    async def _read_into(self, sink, size):
+        while size > 0:
+            if not self._buffer:
+                await self._fill()
+            chunk = bytes(self._buffer[:size])
+            del self._buffer[:len(chunk)]
+            sink.write(chunk)
+            size -= len(chunk)
+
+    def _literal_sink(self, first_line, line, size):
+        if not first_line.startswith(b'* ') or not self._pending:
+            return None
+        pending = next(iter(self._pending.values()))
+        if pending.literal_sink is None:
+            return None
+        return pending.literal_sink(line, size)
+
+    async def _read_responses(self):
+        try:
+            while True:
+                line = await self._readline()
+                segments = [line]
+                literal_match = LITERAL_MARKER_RE.search(line)
+                while literal_match is not None:
+                    size = int(literal_match.group(1))
+                    sink = self._literal_sink(segments[0], line, size)
+                    if sink is None:
+                        segments.append(await self._read_exactly(size))
+                    else:
+                        await self._read_into(sink, size)
+                        if hasattr(sink, 'close'):
+                            # rather than when the response is over
+                            sink.close()
+                        segments.append(sink)
+                    line = await self._readline()
+                    segments.append(line)
+                    literal_match = LITERAL_MARKER_RE.search(line)
+                self._dispatch(segments)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.closed = True
+            self._fail_pending(
+                    e if isinstance(e, IMAPConnectionLost)
+                    else IMAPConnectionLost(repr(e)))
+
+    def _dispatch(self, segments):
+        first = segments[0]
+        if first.startswith(b'+'):
+            if self._continuation is not None:
+                _tag, continuation = self._continuation
+                self._continuation = None
+                if not continuation.done():
+                    continuation.set_result(first)
+            return
+
+        if first.startswith(b'* '):
+            untagged = UntaggedResponse(segments)
+            if self._greeting is not None and not self._greeting.done():
+                self._greeting.set_result(untagged)
+                return
+            if untagged.keyword == b'BYE':
+                self.closed = True
+                self.bye = untagged.text
+            if self._pending:
+                next(iter(self._pending.values())).untagged.append(untagged)
+            else:
+                self.unsolicited.append(untagged)
+            return
+
+        tag, _, rest = first.partition(b' ')
+        status, _, text = rest.partition(b' ')
+        pending = self._pending.pop(tag, None)
+        if pending is None:
+            return
+        if self._continuation is not None and self._continuation[0] == tag:
+            # rejected before we got to send the literal
+            _tag, continuation = self._continuation
+            self._continuation = None
+            if not continuation.done():
+                continuation.set_exception(
+                        IMAPCommandError(
+                            str(pending.name, 'ascii', 'replace'),
+                            Response(status.upper(), text, pending.untagged)))
+        if pending.name == b'COMPRESS' and status.upper() == b'OK':
+            # before anything else gets read or written
+            self._start_compression()
+        pending.future.set_result(
+                Response(status.upper(), text, pending.untagged))
+
+    def _fail_pending(self, exception):
+        pending_commands = list(self._pending.values())
+        self._pending.clear()
+        for pending in pending_commands:
+            if not pending.future.done():
+                pending.future.set_exception(exception)
+        if self._continuation is not None:
+            _tag, continuation = self._continuation
+            if not continuation.done():
+                continuation.set_exception(exception)
+        self._continuation = None
+        if self._greeting is not None and not self._greeting.done():
+            self._greeting.set_exception(exception)
+
+def int_or_none(value):
+    return None if value is None else int(value)
+
+def command_name(name, args):
+    # what commands are told apart by in the stats, e.g. 'UID FETCH'
+    if name == b'UID' and args:
+        name += b' ' + args[0]
+    return str(name, 'ascii', 'replace')
+
+class LatencyHistogram:
+    """
+    How many commands completed within each of LATENCY_BUCKETS seconds
+    (cumulatively, as Prometheus has it), along with their sum.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, duration):
+        self.sum += duration
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if duration <= bound:
+                break
+        else:
+            index = len(LATENCY_BUCKETS)
+        self.counts[index] += 1
+
+    def cumulative_counts(self):
+        # (upper bound, count) pairs; the last bound is infinity
+        return list(zip(
+            LATENCY_BUCKETS + (float('inf'),),
+            itertools.accumulate(self.counts)))
+
+def is_throttled_response(response):
+    return response.code[0] in THROTTLED_CODES
+
+class ConnectionBudget:
+    """
+    How many connections may be open at once, across the pools sharing
+    it, along with a factor by which callers scale their batch sizes;
+    both are adjusted AIMD-style from how commands fare. Whenever the
+    server throttles us (or drops a connection) they're halved, and
+    the command is retried after an exponential backoff; as commands
+    keep completing within TARGET_COMMAND_SECONDS they grow back a bit
+    at a time.
+    """
+
+    def __init__(self, size, log=None):
+        self.size = size
+        self.limit = float(size)
+        self.batch_factor = 1.0
+        self.in_use = 0
+        self.log = log or (lambda message: None)
+        self.backoff_delay = 0.0
+        self.latency = None
+        self.error_rate = 0.0
+        self.commands = 0
+        self.throttled = 0
+        self.errors = 0
+        # as they went over the wire (compressed or not) and as they
+        # were before compression (or after decompression)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.uncompressed_bytes_sent = 0
+        self.uncompressed_bytes_received = 0
+        self.reconnects = 0
+        self.command_latencies = {}
+        self._started = time.monotonic()
+        self._last_decrease = None
+        self._released = asyncio.Event()
+
+    def locked(self):
+        return self.in_use >= max(1, int(self.limit))
+
+    def over_limit(self):
+        return self.in_use > max(1, int(self.limit))
+
+    def try_acquire(self):
+        if self.locked():
+            return False
+        self.in_use += 1
+        return True
+
+    async def acquire(self):
+        while self.locked():
+            self._released.clear()
+            await self._released.wait()
+        self.in_use += 1
+
+    def release(self):
+        self.in_use -= 1
+        self._released.set()
+
+    def notify(self):
+        # wakes up whoever's in wait() without releasing anything,
+        # e.g. because a connection was opened elsewhere
+        self._released.set()
+
+    async def wait(self):
+        self._released.clear()
+        await self._released.wait()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+    def scaled(self, value):
+        return max(1, int(value * self.batch_factor))
+
+    def record_success(self, duration, command=None):
+        self.commands += 1
+        if command is not None:
+            if command not in self.command_latencies:
+                self.command_latencies[command] = LatencyHistogram()
+            self.command_latencies[command].observe(duration)
+        self.latency = duration if self.latency is None else (
+                (1 - EWMA_WEIGHT) * self.latency + EWMA_WEIGHT * duration)
+        self.error_rate *= 1 - EWMA_WEIGHT
+        self.backoff_delay = 0.0
+        if duration > TARGET_COMMAND_SECONDS:
+            self.batch_factor = max(MIN_BATCH_FACTOR, self.batch_factor / 2)
+        else:
+            self.batch_factor = min(
+                    1.0, self.batch_factor + BATCH_FACTOR_STEP)
+        if self.error_rate < MAX_ERROR_RATE_TO_GROW:
+            self.limit = min(self.size, self.limit + 1 / self.limit)
+
+    def record_error(self):
+        self.commands += 1
+        self.errors += 1
+        self.error_rate = (1 - EWMA_WEIGHT) * self.error_rate + EWMA_WEIGHT
+
+    def record_throttled(self, reason):
+        # returns how long to wait before retrying
+        self.record_error()
+        self.throttled += 1
+        now = time.monotonic()
+        if (self._last_decrease is None
+                or now - self._last_decrease > (self.latency or 0)):
+            # commands in flight when it happened will tell us about
+            # it as well; that's still one decrease
+            self._last_decrease = now
+            self.limit = max(1.0, self.limit / 2)
+            self.batch_factor = max(MIN_BATCH_FACTOR, self.batch_factor / 2)
+            self.backoff_delay = min(
+                    BACKOFF_MAX_DELAY,
+                    max(BACKOFF_INITIAL_DELAY, self.backoff_delay * 2))
+            self.log('throttled (%s); down to %d connection(s) and'
+                    ' %d%% of the batch size, backing off for %.1fs' % (
+                        reason, int(self.limit), 100 * self.batch_factor,
+                        self.backoff_delay))
+        return self.backoff_delay * random.uniform(0.5, 1.0)
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        return ('%d commands (%d throttled, %d other errors),'
+                ' %.3fs average latency, %.1f KiB/s received%s;'
+                ' ended at %d connection(s) and %d%% of the batch size' % (
+                    self.commands, self.throttled,
+                    self.errors - self.throttled, self.latency or 0,
+                    self.bytes_received / 1024 / elapsed,
+                    (' (deflated from %.1f KiB/s)' % (
+                        self.uncompressed_bytes_received / 1024 / elapsed))
+                    if self.uncompressed_bytes_received > self.bytes_received
+                    else '',
+                    int(self.limit), 100 * self.batch_factor))
+
+    def stats(self):
+        return {
+                'commands': self.commands,
+                # throttled and failed commands get retried (up to
+                # MAX_THROTTLED_ATTEMPTS and MAX_COMMAND_ATTEMPTS)
+                'retries': self.errors,
+                'throttled': self.throttled,
+                'reconnects': self.reconnects,
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'uncompressed_bytes_sent': self.uncompressed_bytes_sent,
+                'uncompressed_bytes_received':
+                    self.uncompressed_bytes_received,
+                'command_latencies': dict(
+                    sorted(self.command_latencies.items())),
+                }
+
+class ConnectionPool:
+    """
+    Logged in connections, all with the same folder selected, over
+    which commands get spread; each connection carries up to
+    `pipeline_depth` commands at once. Connections that are lost get
+    replaced and the commands they were carrying retried.
+
+    Every connection takes a unit of the `budget` (a ConnectionBudget,
+    possibly shared with other pools): the pool waits for one when
+    starting, opens up to `size` connections as long as the budget
+    allows it, and closes idle ones whenever the budget shrinks.
+
+    Those of the `enable` extensions which the server supports get
+    enabled on every connection before the folder is selected; what
+    the server last said about the folder when selecting it is kept
+    in `folder_status`, and what it advertised after logging in, in
+    `capabilities`. With `compress`, connections to servers that
+    advertise COMPRESS=DEFLATE get it turned on right after logging in.
+    """
+
+    def __init__(self, hostname, username, password, folder_name,
+            size, readonly=False, pipeline_depth=DEFAULT_PIPELINE_DEPTH,
+            port=None, budget=None, enable=(), compress=False):
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+        self.folder_name = folder_name
+        self.size = size
+        self.readonly = readonly
+        self.pipeline_depth = pipeline_depth
+        self.port = port
+        self.budget = budget or ConnectionBudget(size)
+        self.enable = enable
+        self.enabled = frozenset()
+        self.compress = compress
+        self.folder_status = None
+        self.capabilities = frozenset()
+        self.connections = []
+        self._slot_released = None
+
+    async def open_connection(self):
+        throttled_attempt = 0
+        while True:
+            connection = Connection(
+                    self.hostname, self.port, budget=self.budget)
+            try:
+                await connection.connect()
+                await connection.login(self.username, self.password)
+                self.capabilities = connection.capabilities
+                await self._compress(connection)
+                await self._enable(connection)
+                self.folder_status = await connection.select(
+                        self.folder_name, readonly=self.readonly)
+                return connection
+            except IMAPConnectionLost:
+                connection.close()
+                throttled_attempt += 1
+                if (connection.bye is None
+                        or throttled_attempt >= MAX_THROTTLED_ATTEMPTS):
+                    raise
+                await asyncio.sleep(self.budget.record_throttled(
+                    'BYE ' + str(connection.bye, 'utf-8', 'replace')))
+
+    async def _compress(self, connection):
+        if (not self.compress
+                or 'COMPRESS=DEFLATE' not in connection.capabilities):
+            return
+        try:
+            await connection.compress()
+        except IMAPCommandError as e:
+            self.budget.log('couldn\'t enable compression: %s' % repr(e))
+
+    async def _enable(self, connection):
+        extensions = [
+                extension for extension in self.enable
+                if extension in connection.capabilities]
+        if not extensions or 'ENABLE' not in connection.capabilities:
+            return
+        try:
+            self.enabled = await connection.enable(*extensions)
+        except IMAPCommandError as e:
+            self.budget.log('couldn\'t enable %s: %s' % (
+                ' '.join(extensions), repr(e)))
+
+    async def _open_budgeted_connection(self):
+        # the budget unit must have been taken already
+        try:
+            connection = await self.open_connection()
+        except BaseException:
+            self.budget.release()
+            raise
+        self.connections.append(connection)
+        self.budget.notify()
+        return connection
+
+    async def start(self):
+        # a single connection to begin with; _acquire() opens more (up
+        # to `size`, as long as the budget allows it) as commands pile up
+        self._slot_released = asyncio.Condition()
+        await self.budget.acquire()
+        await self._open_budgeted_connection()
+        return self
+
+    async def close(self):
+        connections, self.connections = self.connections, []
+        await asyncio.gather(
+                *[connection.logout() for connection in connections
+                    if not connection.closed],
+                return_exceptions=True)
+        for _ in connections:
+            self.budget.release()
+
+    def _shrink(self):
+        while self.budget.over_limit() and len(self.connections) > 1:
+            idle = [connection for connection in self.connections
+                    if connection.in_flight == 0]
+            if not idle:
+                break
+            self.connections.remove(idle[0])
+            asyncio.ensure_future(idle[0].logout())
+            self.budget.release()
+
+    async def _acquire(self):
+        while True:
+            async with self._slot_released:
+                self._shrink()
+                available = [
+                        connection for connection in self.connections
+                        if connection.in_flight < self.pipeline_depth]
+                if available:
+                    return min(available, key=lambda conn: conn.in_flight)
+                if (len(self.connections) < self.size
+                        and self.budget.try_acquire()):
+                    break
+                if self.connections:
+                    await self._slot_released.wait()
+                    continue
+            # every connection is gone and the budget is taken up (by
+            # other pools, or by connections being reopened): wait for
+            # either without holding up the pool meanwhile
+            await self.budget.wait()
+        return await self._open_budgeted_connection()
+
+    async def _release(self):
+        async with self._slot_released:
+            self._slot_released.notify()
+
+    async def _replace(self, connection):
+        if connection in self.connections:
+            self.connections.remove(connection)
+            connection.close()
+            if self.budget.over_limit() and self.connections:
+                self.budget.release()
+                return
+            self.budget.reconnects += 1
+            try:
+                await self._open_budgeted_connection()
+            except (OSError, IMAPError):
+                # _acquire() will try again once it needs to
+                pass
+
+    async def check(self, max_idle=0):
+        # sends a NOOP down every connection that has been idle for
+        # longer than `max_idle` seconds, replacing those that turn out
+        # to have been lost in the meantime
+        now = time.monotonic()
+        idle = [connection for connection in self.connections
+                if connection.in_flight == 0
+                and now - connection.last_active > max_idle]
+        results = await asyncio.gather(
+                *[connection.command(b'NOOP', check=False)
+                    for connection in idle],
+                return_exceptions=True)
+        for connection, result in zip(idle, results):
+            if isinstance(result, (OSError, IMAPError)):
+                await self._replace(connection)
+            elif isinstance(result, BaseException):
+                raise result
+
+    async def command(self, name, *args, check=True, literal_sink=None):
+        attempt = throttled_attempt = 0
+        while True:
+            connection = await self._acquire()
+            try:
+                return await connection.command(
+                        name, *args, check=check, literal_sink=literal_sink)
+            except IMAPConnectionLost:
+                if connection.bye is not None:
+                    # the server hanging up on us is as much of a hint
+                    # to slow down as an explicit [THROTTLED]
+                    throttled_attempt += 1
+                    delay = self.budget.record_throttled(
+                            'BYE ' + str(connection.bye, 'utf-8', 'replace'))
+                else:
+                    attempt += 1
+                    self.budget.record_error()
+                    delay = 0
+                if (attempt >= MAX_COMMAND_ATTEMPTS
+                        or throttled_attempt >= MAX_THROTTLED_ATTEMPTS):
+                    raise
+                await asyncio.sleep(delay)
+                await self._replace(connection)
+            finally:
+                await self._release()
@@ -1,28 +1,92 @@
 #!/usr/bin/env python3
+import array
+import asyncio
+import bisect
+import contextlib
+import datetime
 import email
 import email.header
 import email.utils
-from functools import reduce
+import functools
 import getpass
-from imaplib import IMAP4_SSL
-import itertools
+import hashlib
+import io
+import json
 from multiprocessing import Pool
-import operator
+from multiprocessing.pool import ThreadPool
 import os
-import pickle
 import random
+import resource
+import shutil
 import signal
 import string
 import sys
+import threading
 import re
+import sqlite3
 import time
 import traceback
 import unicodedata
+import zlib
+
+import aioimap
+
+try:
+    import zstandard
+except ImportError:
+    # packed storage falls back to gzip
+    zstandard = None
 
 IMAP_FETCH_LIMIT = 10 ** 15
 MAX_IMAP_WORKERS = 5
+IMAP_PIPELINE_DEPTH = 4
+IMAP_IDLE_CHECK_SECONDS = 60
+DOWNLOAD_BATCH_MAX_BYTES = 1024 * 1024
+DOWNLOAD_BATCH_MAX_MESSAGES = 100
+REFID_BATCH_MAX_MESSAGES = 1000
+# uids per lookup, within SQLite's limit on query parameters
+LOOKUP_CHUNK_SIZE = 500
 MAX_LOCAL_WORKERS = 17
+LOCAL_CHUNK_SIZE = 64
+LOCAL_WINDOW_TASKS = 4 * MAX_LOCAL_WORKERS
+LOCAL_COMMIT_FILES = 10000
+# how long to wait for the index while something else writes into it
+# (the local scan and the remote discovery go on at the same time)
+INDEX_BUSY_SECONDS = 600
+PROGRESS_LOG_SECONDS = 30
 TEMP_PREFIX = u'._'
+TEMP_FILENAME_RE = re.compile(r'^\._[\w-]*_[A-Z0-9]+\.eml$')
+HEADER_READ_SIZE = 8192
+MAX_HEADER_BLOCK_SIZE = 1024 * 1024
+# hashed, along with the size, into the fingerprint that stands in for
+# the Message-ID of messages without one
+FINGERPRINT_FIELDS = ('date', 'from', 'to', 'cc', 'subject')
+FINGERPRINT_READ_SIZE = 1024 * 1024
+INDEX_FILENAME = u'.imap2dir.sqlite'
+# where downloaded messages go: 'files' (an .eml file each) or 'packed'
+# (into compressed segment files; see PackedMessageStorage)
+STORAGE = os.environ.get('IMAP2DIR_STORAGE', 'files')
+SEGMENTS_DIRNAME = u'.imap2dir.segments'
+SEGMENT_FILENAME_RE = re.compile(r'^(\d+)\.eml\.(zst|gz)$')
+SEGMENT_MAX_BYTES = 256 * 1024 * 1024
+SEGMENT_ZSTD_LEVEL = 3
+SEGMENT_GZIP_LEVEL = 1
+SEGMENT_COPY_SIZE = 64 * 1024
+# how message files get laid out: 'flat' (all of them right in the local
+# directory), 'date' (into YYYY/MM/ subdirectories, by their Date) or
+# 'hash' (into 2 hex digit subdirectories, by their Message-ID)
+LAYOUT = os.environ.get('IMAP2DIR_LAYOUT', 'flat')
+LAYOUTS = ('flat', 'date', 'hash')
+# names of the subdirectories above, which folder subdirectories steer
+# clear of
+SHARD_DIRNAME_RE = re.compile(r'^(\d{2}|\d{4}|[0-9a-f]{2})$')
+MAX_SCAN_THREADS = 8
+METRICS_DIRNAME = os.environ.get('IMAP2DIR_METRICS_DIR')
+# COMPRESS=DEFLATE, whenever the server supports it; on unless set to 0
+IMAP_COMPRESS = os.environ.get('IMAP2DIR_COMPRESS') != '0'
+# X-GM-MSGID rather than Message-ID as the key to remote messages,
+# whenever the server supports it (Gmail); off unless set to 1
+IMAP_GMAIL = os.environ.get('IMAP2DIR_GMAIL') == '1'
 
 def decode_header(value):
     # from 'maildir2gmail.py'
@@ -39,9 +103,10 @@ def decode_header(value):
         result.append(v)
     return u' '.join(result)
 
-def parse_date_header(value):
+def parse_date_header(value, fallback=None):
     # based on 'maildir2gmail.py'
     # @ http://scott.yang.id.au/2009/01/migrate-emails-maildir-gmail.html
+    # (fallback, or the current time, if it can't be parsed)
     try:
         if value:
             value = decode_header(value)
@@ -55,7 +120,16 @@ def parse_date_header(value):
                 return timestamp
     except Exception as e:
         log_error('couldn\'t parse %s as date: %s' % (repr(value), repr(e)))
-    return time.time()
+    return time.time() if fallback is None else fallback
+
+def parse_internaldate(value):
+    # seconds since the epoch out of an INTERNALDATE (e.g.
+    # b'17-Jul-1996 02:44:25 -0700'), or None
+    try:
+        return datetime.datetime.strptime(
+                str(value, 'ascii').strip(), '%d-%b-%Y %H:%M:%S %z').timestamp()
+    except (TypeError, ValueError):
+        return None
 
 PRINTABLE_UNICODE_SUPER_CATEGORIES = set(['L', 'M', 'N', 'P', 'S', 'Z'])
 
@@ -98,120 +172,702 @@ def log(message):
     sys.stderr.write('[%s]: %s\n' % (
         time.strftime('%H:%M:%S'), message))
 
-IMAP_WORKER_OBJ = None
-IMAP_WORKER_FOLDER = None
-IMAP_WORKER_HOSTNAME = None
-IMAP_WORKER_USERNAME = None
-IMAP_WORKER_PASSWORD = None
-def imap_worker_init(hostname, username, password, folder_name):
-    global IMAP_WORKER_FOLDER, IMAP_WORKER_HOSTNAME
-    global IMAP_WORKER_USERNAME, IMAP_WORKER_PASSWORD
-    IMAP_WORKER_FOLDER = folder_name
-    IMAP_WORKER_HOSTNAME = hostname
-    IMAP_WORKER_USERNAME = username
-    IMAP_WORKER_PASSWORD = password
-    signal.signal(signal.SIGINT, imap_worker_die)
-    imap_worker_setup()
-
-def imap_worker_setup():
-    global IMAP_WORKER_OBJ
-    if IMAP_WORKER_OBJ is not None:
-        try:
-            IMAP_WORKER_OBJ.close()
-        except Exception as e:
-            log_error("couldnt close previous imap connection: %s" % repr(e))
-    IMAP_WORKER_OBJ = IMAP4_SSL(IMAP_WORKER_HOSTNAME)
-    IMAP_WORKER_OBJ.login(IMAP_WORKER_USERNAME, IMAP_WORKER_PASSWORD)
-    log_info('connected \'%s\' to %s' % (
-        IMAP_WORKER_USERNAME, IMAP_WORKER_HOSTNAME))
-    IMAP_WORKER_OBJ.select(IMAP_WORKER_FOLDER, readonly=True)
-
-#def imap_worker_die(signum, frame):
-def imap_worker_die():
-    if IMAP_WORKER_OBJ is not None:
+def progress_logger(description, total, total_bytes=None):
+    # returns a function to be called with the count so far (and the
+    # bytes so far, if total_bytes is known); it logs it every
+    # PROGRESS_LOG_SECONDS, along with how long the rest should take
+    # going by the bytes
+    started = last_logged = time.monotonic()
+    def log_progress(count, byte_count=None):
+        nonlocal last_logged
+        now = time.monotonic()
+        if now - last_logged >= PROGRESS_LOG_SECONDS:
+            last_logged = now
+            if total is None:
+                message = '%s %d so far' % (description, count)
+            else:
+                message = '%s %d out of %d so far' % (
+                    description, count, total)
+            if total_bytes and byte_count:
+                message += ' (%.1f out of %.1f MiB, about %ds left)' % (
+                    byte_count / 1048576, total_bytes / 1048576,
+                    (now - started) * max(0, total_bytes - byte_count)
+                        / byte_count)
+            log_notice(message)
+    return log_progress
+
+class SyncError(Exception):
+    """
+    What a folder's sync gives up with once it can't go on (retries
+    run out, and the like), after logging why; whatever it got done
+    was committed as it went. The run (or, in account mode, just that
+    folder) ends there.
+    """
+
+class RunMetrics:
+    """
+    Where a run's time went, per phase (summed over folders, which
+    overlap in account mode), and how much it got through. Written out
+    at the end, along with the IMAP command stats, as a JSON summary
+    and a node_exporter textfile whenever METRICS_DIRNAME is set.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phase_seconds = {}
+        self.phase_max_rss_bytes = {}
+        self.counters = {}
+        self.succeeded = False
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.monotonic()
         try:
-            IMAP_WORKER_OBJ.close()
-        except Exception:
-            pass
-    sys.exit(-1)
-
-def imap_worker(worker_args):
-    (func, args) = worker_args
-    assert (IMAP_WORKER_OBJ != None)
-    val = func(*args)
-    return val
-
-def imap_worker_fetch_message_refids(message_refs):
-    log_info('attempting to fetch %d message ids' % len(message_refs))
-    if len(message_refs) < 1:
+            yield
+        finally:
+            self.phase_seconds[name] = (self.phase_seconds.get(name, 0.0)
+                    + time.monotonic() - started)
+            # the peak so far, that is
+            self.phase_max_rss_bytes[name] = max_rss_bytes()
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self, labels, budget):
+        imap_stats = budget.stats()
+        imap_stats['command_latencies'] = dict(
+                (command, {
+                    'buckets': dict(
+                        (prometheus_value(bound), count)
+                        for bound, count in histogram.cumulative_counts()),
+                    'sum': histogram.sum,
+                    })
+                for command, histogram
+                in imap_stats['command_latencies'].items())
+        return {
+                'labels': dict(labels),
+                'started': self.started,
+                'duration_seconds': time.time() - self.started,
+                'succeeded': self.succeeded,
+                'phase_seconds': self.phase_seconds,
+                'phase_max_rss_bytes': self.phase_max_rss_bytes,
+                'counters': self.counters,
+                'imap': imap_stats,
+                }
+
+    def write(self, labels, budget):
+        # labels: (name, value) pairs telling runs apart (and naming
+        # the files), e.g. the folder
+        summary = self.summary(labels, budget)
+        stem = os.path.join(METRICS_DIRNAME, 'imap2dir-' + re.sub(
+            r'[^\w.@-]+', '_', '-'.join(value for _name, value in labels)))
+        write_file_atomically(
+                stem + '.json', json.dumps(summary, indent=2) + '\n')
+        write_file_atomically(stem + '.prom', prometheus_textfile(summary))
+        log_info('wrote metrics to %s.{json,prom}' % stem)
+
+METRICS = RunMetrics()
+
+def max_rss_bytes():
+    # worker processes are only accounted for once they've exited
+    max_rss = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # KiB, except on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+def prometheus_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+def prometheus_labels(labels):
+    return ','.join(
+            '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                .replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in labels)
+
+def prometheus_textfile(summary):
+    # https://prometheus.io/docs/instrumenting/exposition_formats/;
+    # everything is about the last run, hence gauges
+    labels = list(summary['labels'].items())
+    lines = []
+
+    def add_metric(name, metric_type, description, samples):
+        lines.append('# HELP imap2dir_%s %s' % (name, description))
+        lines.append('# TYPE imap2dir_%s %s' % (name, metric_type))
+        for suffix, sample_labels, value in samples:
+            lines.append('imap2dir_%s%s{%s} %s' % (
+                name, suffix, prometheus_labels(labels + sample_labels),
+                prometheus_value(value)))
+
+    add_metric('last_run_timestamp_seconds', 'gauge',
+            'When the last run started.', [('', [], summary['started'])])
+    add_metric('last_run_duration_seconds', 'gauge',
+            'How long the last run took.',
+            [('', [], summary['duration_seconds'])])
+    add_metric('last_run_success', 'gauge',
+            'Whether the last run completed.',
+            [('', [], int(summary['succeeded']))])
+    add_metric('last_run_phase_seconds', 'gauge',
+            'Time spent in each phase of the last run.',
+            [('', [('phase', phase)], seconds)
+                for phase, seconds in summary['phase_seconds'].items()])
+    add_metric('last_run_phase_max_rss_bytes', 'gauge',
+            'Peak resident memory by the end of each phase of the last run.',
+            [('', [('phase', phase)], size)
+                for phase, size in summary['phase_max_rss_bytes'].items()])
+    for name, value in summary['counters'].items():
+        add_metric('last_run_%s' % name, 'gauge',
+                'Counted over the last run.', [('', [], value)])
+    imap_stats = summary['imap']
+    for name in ('commands', 'retries', 'throttled', 'reconnects',
+            'bytes_sent', 'bytes_received', 'uncompressed_bytes_sent',
+            'uncompressed_bytes_received'):
+        add_metric('last_run_imap_%s' % name, 'gauge',
+                'Counted over the last run.', [('', [], imap_stats[name])])
+    add_metric('last_run_imap_command_duration_seconds', 'histogram',
+            'IMAP command latencies over the last run.',
+            [sample
+                for command, histogram
+                in imap_stats['command_latencies'].items()
+                for sample in (
+                    [('_bucket', [('command', command), ('le', bound)], count)
+                        for bound, count in histogram['buckets'].items()]
+                    + [('_sum', [('command', command)], histogram['sum']),
+                        ('_count', [('command', command)],
+                            histogram['buckets']['+Inf'])])])
+    return '\n'.join(lines) + '\n'
+
+def write_file_atomically(filepath, content):
+    # so that whoever reads it (e.g. node_exporter) never sees it
+    # half-written
+    temp_filepath = '%s.%s.tmp' % (filepath, id_generator())
+    with open(temp_filepath, 'w', encoding='utf-8') as out_file:
+        out_file.write(content)
+    os.rename(temp_filepath, filepath)
+
+def imap_connection_budget():
+    # MAX_IMAP_WORKERS connections at most, fewer (along with smaller
+    # batches) while the server is throttling us
+    return aioimap.ConnectionBudget(MAX_IMAP_WORKERS, log_notice)
+
+def imap_worker_pool(hostname, username, password, folder_name, budget):
+    # as many connections as the budget allows, each pipelining up to
+    # IMAP_PIPELINE_DEPTH commands; the same ones carry the discovery
+    # of new messages, the fetching of their IDs and their download
+    return aioimap.ConnectionPool(
+            hostname, username, password, folder_name, MAX_IMAP_WORKERS,
+            readonly=True, pipeline_depth=IMAP_PIPELINE_DEPTH,
+            budget=budget, enable=('QRESYNC', 'CONDSTORE'),
+            compress=IMAP_COMPRESS)
+
+async def imap_worker_run(imap_pool, func, worker_args):
+    # runs func(imap_pool, *args) for every args out of worker_args,
+    # with no more commands queued than the pool can carry at once;
+    # results are yielded as they come
+    max_running = imap_pool.size * IMAP_PIPELINE_DEPTH
+    running = set()
+    try:
+        for args in worker_args:
+            if len(running) >= max_running:
+                done, running = await asyncio.wait(
+                        running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+            running.add(asyncio.ensure_future(func(imap_pool, *args)))
+        while running:
+            done, running = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in running:
+            task.cancel()
+
+REFID_FETCH_ATTRIBUTES = (
+        b'(UID RFC822.SIZE INTERNALDATE'
+        b' BODY.PEEK[HEADER.FIELDS (MESSAGE-ID DATE SUBJECT)])')
+
+async def imap_worker_fetch_message_refids(imap_pool, message_uids):
+    # (uid, message_id, size, None, None, timestamp, subject) for each
+    # of the messages; the last two are what downloads get named (and
+    # dated) after, so that they needn't be parsed
+    log_info('attempting to fetch %d message ids' % len(message_uids))
+    if len(message_uids) < 1:
         return []
-    _typ, data = IMAP_WORKER_OBJ.fetch(
-            b','.join(message_refs),
-            '(BODY[HEADER.FIELDS (MESSAGE-ID)])')
-    command_replies = [command_resp for _command, command_resp in data[::2]]
-    message_ids = []
-    for reply in command_replies:
+    response = await imap_pool.command(
+            b'UID', b'FETCH', uid_set(message_uids).encode('ascii'),
+            REFID_FETCH_ATTRIBUTES)
+    message_refids = []
+    for uid, attributes in requested_fetch_responses(
+            response, message_uids,
+            (b'RFC822.SIZE', b'BODY[HEADER.FIELDS')):
+        header_block = next(
+                value for name, value in attributes.items()
+                if name.startswith(b'BODY[HEADER.FIELDS')) or b''
+        header_fields = parse_header_fields(
+                header_block, ('message-id', 'date', 'subject'))
         message_id = None
-        if reply[:11].lower() == b'message-id:':
-            lines = str(reply[11:], 'UTF-8').splitlines()
-            stripped_of_repeated_headers = itertools.takewhile(
-                lambda line: not line.lower().startswith('message-id:'),
-                lines)
-            raw_message_id = '\n'.join(stripped_of_repeated_headers)
-            message_id = sane_message_id(raw_message_id)
+        if 'message-id' in header_fields:
+            message_id = sane_message_id(
+                    decode_header(header_fields['message-id']))
             if message_id is None:
-                log_error('bad message-id: "%s"', message_id)
-        message_ids.append(message_id)
+                log_error('bad message-id: %s' %
+                        repr(header_fields['message-id']))
+        message_refids.append((
+            uid, message_id, int(attributes[b'RFC822.SIZE']), None, None,
+            message_timestamp(
+                header_fields, attributes.get(b'INTERNALDATE')),
+            decode_header(header_fields.get('subject', ''))))
+
+    idless_uids = [
+            message_refid[0] for message_refid in message_refids
+            if message_refid[1] is None]
+    if len(idless_uids) > 0:
+        # ID-less messages get a fingerprint instead, or are kept (as
+        # None) if that can't be had, so that they're not fetched
+        # again on every run
+        fingerprints = await imap_worker_fetch_message_fingerprints(
+                imap_pool, idless_uids)
+        message_refids = [
+                (message_refid[0], fingerprints.get(message_refid[0])
+                    if message_refid[1] is None else message_refid[1])
+                + message_refid[2:]
+                for message_refid in message_refids]
+    return message_refids
+
+def requested_fetch_responses(response, message_uids, attribute_prefixes):
+    # (uid, attributes) for every FETCH response to one of the uids
+    # asked for that carries all of the attributes (going by the start
+    # of their names); whatever else the server slipped in, such as
+    # unsolicited flag updates under CONDSTORE/QRESYNC, is left out
+    requested_uids = frozenset(message_uids)
+    for fetch_response in response.filter(b'FETCH'):
+        attributes = fetch_response.fetch_attributes()
+        uid = attributes.get(b'UID')
+        if (uid is None or int(uid) not in requested_uids
+                or not all(
+                    any(name.startswith(prefix) for name in attributes)
+                    for prefix in attribute_prefixes)):
+            log_debug('ignoring fetch reply: %s' % repr(attributes))
+            continue
+        yield (int(uid), attributes)
+
+def message_timestamp(header_fields, internaldate=None):
+    # when the message was sent (as per its Date header field) or, if
+    # that's missing or can't be parsed, when it got to the server
+    timestamp = None if internaldate is None else parse_internaldate(
+            internaldate)
+    if 'date' in header_fields:
+        return parse_date_header(header_fields['date'], timestamp)
+    return timestamp
+
+FINGERPRINT_FETCH_ATTRIBUTES = (
+        b'(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (%s)])' %
+        b' '.join(field_name.upper().encode('ascii')
+            for field_name in FINGERPRINT_FIELDS))
+
+async def imap_worker_fetch_message_fingerprints(imap_pool, message_uids):
+    # {uid: fingerprint} for the messages that can be fingerprinted;
+    # what's needed for it is small, and the same whether it comes
+    # from the server or from the local files
+    response = await imap_pool.command(
+            b'UID', b'FETCH', uid_set(message_uids).encode('ascii'),
+            FINGERPRINT_FETCH_ATTRIBUTES)
+    fingerprints = {}
+    for uid, attributes in requested_fetch_responses(
+            response, message_uids,
+            (b'RFC822.SIZE', b'BODY[HEADER.FIELDS')):
+        header_block = next(
+                value for name, value in attributes.items()
+                if name.startswith(b'BODY[HEADER.FIELDS')) or b''
+        fingerprint = message_fingerprint(
+                int(attributes[b'RFC822.SIZE']), parse_header_fields(
+                    header_block, FINGERPRINT_FIELDS))
+        if fingerprint is not None:
+            fingerprints[uid] = fingerprint
+    return fingerprints
+
+async def imap_worker_fetch_gmail_refids(imap_pool, message_uids):
+    # (uid, None, size, gm_msgid, gm_thrid, timestamp, None) for each
+    # of the messages; there are no header fields to go through (the
+    # subject, and the Date, come along with the download), and messages
+    # without a Message-ID get a key all the same
+    log_info('attempting to fetch %d gmail message ids' % len(message_uids))
+    if len(message_uids) < 1:
+        return []
+    response = await imap_pool.command(
+            b'UID', b'FETCH', uid_set(message_uids).encode('ascii'),
+            b'(UID RFC822.SIZE INTERNALDATE X-GM-MSGID X-GM-THRID)')
+    message_refids = []
+    for uid, attributes in requested_fetch_responses(
+            response, message_uids, (b'RFC822.SIZE', b'X-GM-MSGID')):
+        thrid = attributes.get(b'X-GM-THRID')
+        internaldate = attributes.get(b'INTERNALDATE')
+        message_refids.append((
+            uid, None, int(attributes[b'RFC822.SIZE']),
+            signed_int64(int(attributes[b'X-GM-MSGID'])),
+            None if thrid is None else signed_int64(int(thrid)),
+            None if internaldate is None else parse_internaldate(internaldate),
+            None))
+    return message_refids
+
+def signed_int64(value):
+    # X-GM-MSGID and X-GM-THRID are unsigned 64-bit integers, while
+    # SQLite's are signed
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def imap_remote_key_type(imap_pool):
+    # what the remote messages get told apart by: KEY_GM_MSGID if
+    # asked for and the server supports it, KEY_MESSAGE_ID otherwise
+    if not IMAP_GMAIL:
+        return KEY_MESSAGE_ID
+    if 'X-GM-EXT-1' not in imap_pool.capabilities:
+        log_notice('X-GM-MSGID isn\'t supported by the server;'
+                ' going by Message-ID instead')
+        return KEY_MESSAGE_ID
+    return KEY_GM_MSGID
+
+def download_batches(message_refids, budget):
+    # groups messages into batches of up to DOWNLOAD_BATCH_MAX_BYTES (as
+    # per RFC822.SIZE) or DOWNLOAD_BATCH_MAX_MESSAGES, whichever comes
+    # first, both scaled down by the budget while we're being throttled;
+    # messages of unknown size count as half the byte budget
+    batch = []
+    batch_size = 0
+    max_bytes = budget.scaled(DOWNLOAD_BATCH_MAX_BYTES)
+    max_messages = budget.scaled(DOWNLOAD_BATCH_MAX_MESSAGES)
+    for message_refid in message_refids:
+        size = message_refid[2]
+        if size is None:
+            size = DOWNLOAD_BATCH_MAX_BYTES // 2
+        if batch and (batch_size + size > max_bytes
+                or len(batch) >= max_messages):
+            yield batch
+            batch = []
+            batch_size = 0
+            max_bytes = budget.scaled(DOWNLOAD_BATCH_MAX_BYTES)
+            max_messages = budget.scaled(DOWNLOAD_BATCH_MAX_MESSAGES)
+        batch.append(message_refid)
+        batch_size += size
+    if batch:
+        yield batch
+
+def refid_batches(message_uids, budget):
+    # up to REFID_BATCH_MAX_MESSAGES (scaled down by the budget while
+    # we're being throttled), spread over the workers if there are few
+    position = 0
+    while position < len(message_uids):
+        batch_size = min(
+                budget.scaled(REFID_BATCH_MAX_MESSAGES),
+                max(1, len(message_uids) // MAX_IMAP_WORKERS))
+        yield message_uids[position:position + batch_size]
+        position += batch_size
+
+DOWNLOAD_FETCH_ATTRIBUTES = b'(UID RFC822)'
+# for messages whose subject wasn't fetched along with their ID
+DOWNLOAD_HEADER_FETCH_ATTRIBUTES = (
+        b'(UID BODY.PEEK[HEADER.FIELDS (DATE SUBJECT MESSAGE-ID)] RFC822)')
+DOWNLOAD_LITERAL_RE = re.compile(rb'[ (]RFC822 \{\d+\}$', re.IGNORECASE)
+
+class DownloadedMessageFile:
+    """
+    Where a message gets streamed into as it's downloaded: a temporary
+    file inside the local directory, or nowhere at all on dry syncs.
+    The file gets closed as soon as the literal has been read (by the
+    connection), so that a batch of small messages doesn't hold a file
+    descriptor per message until the whole response is in.
+    """
+
+    def __init__(self, local_dirname, is_dry_sync):
+        self.size = 0
+        self.filepath = None
+        self._file = None
+        if not is_dry_sync:
+            self.filepath = local_message_filepath(
+                    local_dirname, u'', None, None, is_temp=True)
+            self._file = open(self.filepath, 'wb')
+
+    def write(self, data):
+        self.size += len(data)
+        if self._file is not None:
+            self._file.write(data)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def discard(self):
+        self.close()
+        if self.filepath is not None and os.path.exists(self.filepath):
+            os.remove(self.filepath)
+
+class PackedMessageStorage:
+    """
+    Messages appended one after the other into segment files (inside
+    SEGMENTS_DIRNAME) of up to SEGMENT_MAX_BYTES, each compressed on
+    its own: as a zstd frame if the zstandard package is around, as a
+    gzip member otherwise. Every segment is a valid .zst (or .gz) file,
+    and every message can be read back from its offset and length
+    within it, which the local index keeps.
+
+    Only a segment that ends right where its last indexed message does
+    gets appended to; anything past that (what an interrupted run left
+    behind) is left for the local scan to index or skip.
+    """
+
+    def __init__(self, local_dirname, db):
+        self.dirname = os.path.join(local_dirname, SEGMENTS_DIRNAME)
+        self.extension = u'zst' if zstandard is not None else u'gz'
+        self._file = None
+        self._segment = None
+        os.makedirs(self.dirname, exist_ok=True)
+        segments = list_segments(local_dirname)
+        self._next_number = (segments[-1][0] + 1) if segments else 1
+        if segments:
+            _number, segment, size = segments[-1]
+            if (segment.endswith(self.extension) and size < SEGMENT_MAX_BYTES
+                    and size == indexed_segment_end(db, segment)):
+                self._file = open(os.path.join(self.dirname, segment), 'ab')
+                self._segment = segment
+
+    def append(self, message_file):
+        # compresses the rest of message_file onto the current segment;
+        # returns (segment, offset, length)
+        if self._file is None or self._file.tell() >= SEGMENT_MAX_BYTES:
+            self.close()
+            self._segment = u'%06d.eml.%s' % (self._next_number, self.extension)
+            self._next_number += 1
+            self._file = open(os.path.join(self.dirname, self._segment), 'ab')
+        offset = self._file.tell()
+        compressor = segment_compressor(self._segment)
+        while True:
+            chunk = message_file.read(SEGMENT_COPY_SIZE)
+            if not chunk:
+                break
+            self._file.write(compressor.compress(chunk))
+        self._file.write(compressor.flush())
+        # before it gets into the index
+        self._file.flush()
+        return (self._segment, offset, self._file.tell() - offset)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def list_segments(local_dirname):
+    # (number, filename, size) for every segment, in order
+    dirname = os.path.join(local_dirname, SEGMENTS_DIRNAME)
+    if not os.path.isdir(dirname):
+        return []
+    segments = []
+    with os.scandir(dirname) as entries:
+        for entry in entries:
+            match = SEGMENT_FILENAME_RE.match(entry.name)
+            if match is not None and entry.is_file():
+                segments.append(
+                        (int(match.group(1)), entry.name, entry.stat().st_size))
+    return sorted(segments)
+
+def indexed_segment_end(db, segment):
+    # where the last indexed message within the segment ends
+    row = db.execute(
+            'SELECT segment_offset + segment_length FROM local_messages'
+            ' WHERE segment = ? ORDER BY segment_offset DESC LIMIT 1',
+            (segment,)).fetchone()
+    return 0 if row is None else row[0]
+
+def segment_compressor(segment):
+    if segment.endswith(u'.zst'):
+        return zstandard.ZstdCompressor(
+                level=SEGMENT_ZSTD_LEVEL).compressobj()
+    return zlib.compressobj(SEGMENT_GZIP_LEVEL, zlib.DEFLATED, 31)
 
-    message_refids = zip(message_refs, message_ids)
-    valid_message_refids = list(filter(
-            lambda refmid: refmid[1] is not None, message_refids))
-    return valid_message_refids
+def segment_decompressor(segment):
+    if segment.endswith(u'.zst'):
+        if zstandard is None:
+            raise Exception('the zstandard package is needed to read %s' %
+                    repr(segment))
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(31)
 
-def imap_worker_download_message(message_ref_and_id, local_dirname, is_dry_sync):
-    message_ref, message_id = message_ref_and_id
+def copy_packed_message(local_dirname, segment, offset, length, out_file):
+    filepath = os.path.join(local_dirname, SEGMENTS_DIRNAME, segment)
+    decompressor = segment_decompressor(segment)
+    with open(filepath, 'rb') as segment_file:
+        segment_file.seek(offset)
+        while length > 0:
+            chunk = segment_file.read(min(SEGMENT_COPY_SIZE, length))
+            if not chunk:
+                raise Exception('%s is cut short' % repr(segment))
+            length -= len(chunk)
+            out_file.write(decompressor.decompress(chunk))
+    out_file.write(decompressor.flush())
+
+async def imap_worker_download_messages(
+        imap_pool, message_refids, local_dirname, is_dry_sync, journal,
+        storage):
+    # journal(downloaded_files) gets called with whatever was stored,
+    # right away, and even if something goes wrong part-way through
+    # the response (so that the files stored so far don't go
+    # unindexed); messages go into storage if given
+    # (a PackedMessageStorage) rather than into files of their own.
+    # Returns (how many, how many bytes) got downloaded.
+    message_refid_per_uid = dict(
+            (message_refid[0], message_refid)
+            for message_refid in message_refids)
+    fetch_attributes = (
+            DOWNLOAD_FETCH_ATTRIBUTES
+            if all(message_refid[6] is not None
+                for message_refid in message_refids)
+            else DOWNLOAD_HEADER_FETCH_ATTRIBUTES)
+    message_files = []
+    downloaded_files = []
+    downloaded_bytes = 0
+
+    def open_message_file(line, _size):
+        # only the message itself gets streamed to disk (and closed
+        # once it's in); the header fields used for its filename are
+        # small enough to keep around
+        if DOWNLOAD_LITERAL_RE.search(line) is None:
+            return None
+        message_file = DownloadedMessageFile(local_dirname, is_dry_sync)
+        message_files.append(message_file)
+        return message_file
+
+    try:
+        try:
+            response = await imap_pool.command(
+                    b'UID', b'FETCH',
+                    uid_set(message_refid_per_uid.keys()).encode('ascii'),
+                    fetch_attributes,
+                    literal_sink=open_message_file)
+        except Exception:
+            log_error('failed to download %d messages: %s' % (
+                len(message_refids), traceback.format_exc()))
+            raise
+
+        for fetch_response in response.filter(b'FETCH'):
+            attributes = fetch_response.fetch_attributes()
+            content = attributes.get(b'RFC822')
+            if content is None or b'UID' not in attributes:
+                continue
+            message_refid = message_refid_per_uid.pop(
+                    int(attributes[b'UID']), None)
+            if message_refid is None:
+                continue
+            if isinstance(content, bytes):
+                # sent as a quoted string rather than as a literal
+                message_file = DownloadedMessageFile(local_dirname, is_dry_sync)
+                message_files.append(message_file)
+                message_file.write(content)
+                content = message_file
+            header_block = next(
+                    (value for name, value in attributes.items()
+                        if name.startswith(b'BODY[HEADER.FIELDS')),
+                    None) or b''
+            downloaded_files.append(store_downloaded_message(
+                    content, header_block, message_refid, local_dirname,
+                    storage))
+            downloaded_bytes += content.size
+    finally:
+        # leftovers of failed attempts or of messages we didn't ask for
+        for message_file in message_files:
+            message_file.discard()
+        if downloaded_files:
+            journal(downloaded_files)
+
+    for uid, message_refid in message_refid_per_uid.items():
+        log_error('failed to download \'%s\': message %d not returned' % (
+            repr(message_refid[1]), uid))
+    return (len(downloaded_files), downloaded_bytes)
+
+def store_downloaded_message(message_file, header_block, message_refid,
+        local_dirname, storage=None):
+    # returns (filename, (inode, size, mtime_ns), message_id, gm_msgid,
+    # gm_thrid, (segment, offset, length)), with neither of the first
+    # two on dry syncs. It's named and dated after what was fetched
+    # along with its ID, or else after the header fields fetched along
+    # with it (header_block), where the Message-ID also comes from if
+    # it wasn't fetched. Packed messages get the filename they'd have
+    # had otherwise (for exporting them), and no inode.
+    (_uid, message_id, _size, gm_msgid, gm_thrid, timestamp,
+        subject) = message_refid
+    filename = stat_key = None
+    segment_ref = (None, None, None)
     try:
-        _typ, data = IMAP_WORKER_OBJ.fetch(message_ref, '(RFC822)')
-        content = data[0][1]
-        message = email.message_from_bytes(content)
-        subject = decode_header(message.get('subject', ''))
+        message_file.close()
+        if subject is None:
+            header_fields = parse_header_fields(
+                    header_block, ('date', 'subject', 'message-id'))
+            if message_id is None and 'message-id' in header_fields:
+                message_id = sane_message_id(
+                        decode_header(header_fields['message-id']))
+            if 'date' in header_fields:
+                timestamp = parse_date_header(header_fields['date'], timestamp)
+            subject = decode_header(header_fields.get('subject', ''))
         safe_subject = unicode_replace_nonprintable(subject)
-        log_info('downloaded \'%s\' (%d bytes)' % (safe_subject, len(content)))
+        log_info('downloaded \'%s\' (%d bytes)' % (safe_subject, message_file.size))
 
-        if not is_dry_sync:
-            temp_filepath = local_message_filepath(
-                    local_dirname, '', message, is_temp=True)
-            with open(temp_filepath, 'wb') as msg_file:
-                msg_file.write(content)
+        if message_file.filepath is not None and message_id is None:
+            # as it would be indexed if it were parsed
+            message_id = parse_and_append_local_message_id(
+                    message_file.filepath)[0]
+
+        if message_file.filepath is not None and storage is not None:
+            filename = os.path.basename(local_message_filepath(
+                    local_dirname, message_id, timestamp, subject))
+            with open(message_file.filepath, 'rb') as packed_file:
+                segment_ref = storage.append(packed_file)
+            os.remove(message_file.filepath)
+            message_file.filepath = None
+            mtime = time.time() if timestamp is None else timestamp
+            stat_key = (0, message_file.size, int(mtime * 1e9))
 
-            filepath = local_message_filepath(
-                    local_dirname, message_id, message)
+        elif message_file.filepath is not None:
+            basename = os.path.basename(local_message_filepath(
+                    local_dirname, message_id, timestamp, subject))
+            filename = os.path.join(
+                    local_message_shard(
+                        LAYOUT, message_id, timestamp, basename),
+                    basename)
+            filepath = os.path.join(local_dirname, filename)
             if os.path.exists(filepath):
                 # nondeterministic, only a best effort
                 raise Exception('can\'t overwrite %s' % filepath)
-            os.rename(temp_filepath, filepath)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            os.rename(message_file.filepath, filepath)
+            message_file.filepath = None
+
+            if timestamp is not None:
+                os.utime(filepath, (time.time(), timestamp))
 
-            if 'date' in message:
-                mtime = parse_date_header(message['date'])
-                os.utime(filepath, (time.time(), mtime))
-        return True
+            stat = os.stat(filepath)
+            stat_key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        METRICS.count('downloaded_bytes', message_file.size)
 
     except Exception:
         log_error('failed to download \'%s\': %s' % (
             repr(message_id), traceback.format_exc()))
         raise
+    return (filename, stat_key, message_id, gm_msgid, gm_thrid, segment_ref)
 
-def local_message_filepath(local_dirname, mid, message, is_temp=False):
-    if 'date' in message:
-        timestamp = parse_date_header(message['date'])
+def local_message_filepath(local_dirname, mid, timestamp, subject,
+        is_temp=False):
+    # after the message's (already parsed) date and (decoded) subject,
+    # either of which may be None
+    if timestamp is not None:
         filename_part1 = u'%s ' % int(timestamp)
     else:
         filename_part1 = u''
 
-    if 'subject' in message:
-        filename_part2 = decode_header(message['subject'])
+    if subject:
+        filename_part2 = subject
     else:
-        filename_part2 = mid
+        filename_part2 = mid or u''
 
     suffix = (u'_%s.eml' % id_generator(6 + max(0, 16 - len(filename_part2))))
     prefix = TEMP_PREFIX if is_temp else u''
@@ -221,6 +877,24 @@ def local_message_filepath(local_dirname, mid, message, is_temp=False):
             max_filename_length, suffix)
     return os.path.join(local_dirname, prefix + filename)
 
+def local_message_shard(layout, message_id, mtime, basename):
+    # the subdirectory (relative to the local directory) a message file
+    # (named basename) goes into; undated messages are filed under when
+    # they arrived
+    if layout == 'flat':
+        return u''
+    elif layout == 'date':
+        return time.strftime(
+                u'%Y/%m',
+                time.gmtime(time.time() if mtime is None else mtime))
+    elif layout == 'hash':
+        # messages without a Message-ID go by their filename, which
+        # they keep when migrated (so that they stay put)
+        digest = message_id_digest(
+                message_id if message_id is not None else basename)
+        return u'%02x' % (digest & 0xff)
+    raise Exception('unknown layout: %s' % layout)
+
 def id_generator(size=6, chars=string.ascii_uppercase + string.digits):
     # from: https://stackoverflow.com/questions/2257441/\
     #           random-string-generation-with-upper-case-\
@@ -246,122 +920,1090 @@ def chunks(l, n):
     for i in range(0, len(l), n):
         yield l[i:i+n]
 
-def fetch_imap_message_refids(
-        hostname, username, password, folder_name, limit = IMAP_FETCH_LIMIT):
-    imap_obj = IMAP4_SSL(hostname)
-    imap_obj.login(username, password)
-    log_notice('connected \'%s\' to %s' % (username, hostname))
-    imap_obj.select(folder_name, readonly=True)
-    _typ, data = imap_obj.search(None, 'ALL')
-    imap_obj.close()
-    all_message_refs = [datum for datum in data[0].split()]
-    log_notice('found %d message refs; fetching up to %d message ids' % (
-        len(all_message_refs), min(len(all_message_refs), limit)))
-    message_refs = all_message_refs[:limit]
-    worker_pool = Pool(
-            MAX_IMAP_WORKERS, imap_worker_init,
-            [hostname, username, password, folder_name])
-    worker_pool_args = [
-            (imap_worker_fetch_message_refids, [chunk])
-            for chunk in chunks(
-                message_refs,
-                min(1000, max(1, len(message_refs) // MAX_IMAP_WORKERS)))]
+def uid_set(uids):
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and ranges[-1][1] + 1 == uid:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(
+            ('%d' % first) if first == last else ('%d:%d' % (first, last))
+            for first, last in ranges)
+
+def parse_uid_set(value):
+    # yields (first, last) inclusive ranges
+    for part in value.split(','):
+        if ':' in part:
+            first, last = sorted(map(int, part.split(':')))
+        else:
+            first = last = int(part)
+        yield (first, last)
+
+# columns that indices created by earlier versions lack
+INDEX_ADDED_COLUMNS = [
+        ('remote_messages', 'size', 'INTEGER'),
+        ('remote_messages', 'message_digest', 'INTEGER'),
+        ('local_messages', 'message_digest', 'INTEGER'),
+        ('remote_folders', 'key_type', 'TEXT'),
+        ('remote_messages', 'gm_msgid', 'INTEGER'),
+        ('remote_messages', 'gm_thrid', 'INTEGER'),
+        ('local_messages', 'gm_msgid', 'INTEGER'),
+        ('local_messages', 'gm_thrid', 'INTEGER'),
+        ('local_messages', 'segment', 'TEXT'),
+        ('local_messages', 'segment_offset', 'INTEGER'),
+        ('local_messages', 'segment_length', 'INTEGER'),
+        ('remote_messages', 'timestamp', 'REAL'),
+        ('remote_messages', 'subject', 'TEXT'),
+        ]
+
+# bumped whenever rows written by earlier versions have to be redone
+INDEX_VERSION = 1
+INDEX_SETUP_LOCK = threading.Lock()
+
+# what remote messages are told apart by, and the column (in both
+# remote_messages and local_messages) holding it as a 64-bit integer
+KEY_MESSAGE_ID = 'message-id'
+KEY_GM_MSGID = 'x-gm-msgid'
+KEY_COLUMNS = {
+        KEY_MESSAGE_ID: 'message_digest',
+        KEY_GM_MSGID: 'gm_msgid',
+        }
+
+def message_id_digest(message_id):
+    # 64 bits worth of hashed Message-ID, as a (signed) SQLite integer
+    if message_id is None:
+        return None
+    return int.from_bytes(
+            hashlib.blake2b(
+                message_id.encode('utf-8', 'surrogatepass'),
+                digest_size=8).digest(),
+            'big', signed=True)
+
+def open_index_db(local_dirname):
+    db = sqlite3.connect(
+            os.path.join(local_dirname, INDEX_FILENAME),
+            timeout=INDEX_BUSY_SECONDS)
+    # the local scan's thread and the remote side can both get here
+    # first on a new (or older) index: one at a time gets to set it up
+    with INDEX_SETUP_LOCK:
+        setup_index_db(db)
+    return db
+
+def setup_index_db(db):
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS remote_folders (
+            folder_key INTEGER PRIMARY KEY,
+            hostname TEXT NOT NULL,
+            username TEXT NOT NULL,
+            folder_name TEXT NOT NULL,
+            uidvalidity INTEGER,
+            highest_uid INTEGER NOT NULL DEFAULT 0,
+            highestmodseq INTEGER,
+            UNIQUE (hostname, username, folder_name));
+        CREATE TABLE IF NOT EXISTS remote_messages (
+            folder_key INTEGER NOT NULL,
+            uid INTEGER NOT NULL,
+            message_id TEXT,
+            size INTEGER,
+            PRIMARY KEY (folder_key, uid));
+        CREATE TABLE IF NOT EXISTS local_messages (
+            filename TEXT PRIMARY KEY,
+            inode INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            message_id TEXT);
+        """)
+    for table, column, column_type in INDEX_ADDED_COLUMNS:
+        table_columns = [
+                row[1] for row in db.execute('PRAGMA table_info(%s)' % table)]
+        if column not in table_columns:
+            db.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                table, column, column_type))
+    if db.execute('PRAGMA user_version').fetchone()[0] < 1:
+        # ID-less messages used to be indexed as such; they get a
+        # fingerprint now, so they're fetched (or parsed) again
+        db.execute(
+                'UPDATE remote_folders SET highest_uid = 0,'
+                ' highestmodseq = NULL WHERE folder_key IN ('
+                'SELECT folder_key FROM remote_messages'
+                ' WHERE message_id IS NULL AND gm_msgid IS NULL)')
+        for table in ('remote_messages', 'local_messages'):
+            db.execute(
+                    'DELETE FROM %s'
+                    ' WHERE message_id IS NULL AND gm_msgid IS NULL' % table)
+    db.execute('PRAGMA user_version = %d' % INDEX_VERSION)
+    db.create_function('message_id_digest', 1, message_id_digest)
+    for table in ('remote_messages', 'local_messages'):
+        db.execute(
+                'UPDATE %s SET message_digest = message_id_digest(message_id)'
+                ' WHERE message_digest IS NULL AND message_id IS NOT NULL'
+                % table)
+    db.executescript("""
+        CREATE INDEX IF NOT EXISTS remote_messages_by_digest
+            ON remote_messages (folder_key, message_digest);
+        CREATE INDEX IF NOT EXISTS local_messages_by_digest
+            ON local_messages (message_digest);
+        CREATE INDEX IF NOT EXISTS remote_messages_by_gm_msgid
+            ON remote_messages (folder_key, gm_msgid);
+        CREATE INDEX IF NOT EXISTS local_messages_by_gm_msgid
+            ON local_messages (gm_msgid);
+        CREATE INDEX IF NOT EXISTS local_messages_by_segment
+            ON local_messages (segment, segment_offset);
+        """)
+    db.commit()
+
+def load_message_digests(rows, ref_typecode):
+    # (digests, refs) arrays out of (digest, ref) rows sorted by digest;
+    # repeated digests are only kept once
+    digests = array.array('q')
+    refs = array.array(ref_typecode)
+    for digest, ref in rows:
+        if digests and digests[-1] == digest:
+            continue
+        digests.append(digest)
+        refs.append(ref)
+    return (digests, refs)
+
+def diff_message_digests(digests_a, digests_b):
+    # merges two sorted digest arrays; returns the positions of those
+    # only in a, the positions of those only in b and the common count
+    only_a = array.array('L')
+    only_b = array.array('L')
+    common_count = 0
+    index_a = index_b = 0
+    length_a = len(digests_a)
+    length_b = len(digests_b)
+    while index_a < length_a and index_b < length_b:
+        digest_a = digests_a[index_a]
+        digest_b = digests_b[index_b]
+        if digest_a < digest_b:
+            only_a.append(index_a)
+            index_a += 1
+        elif digest_b < digest_a:
+            only_b.append(index_b)
+            index_b += 1
+        else:
+            common_count += 1
+            index_a += 1
+            index_b += 1
+    only_a.extend(range(index_a, length_a))
+    only_b.extend(range(index_b, length_b))
+    return (only_a, only_b, common_count)
+
+def load_remote_folder_state(db, hostname, username, folder_name):
+    db.execute(
+            'INSERT OR IGNORE INTO remote_folders'
+            ' (hostname, username, folder_name) VALUES (?, ?, ?)',
+            (hostname, username, folder_name))
+    # right away: callers go on to wait on the network, and a write
+    # transaction left open meanwhile would hold up the local scan
+    db.commit()
+    # indices from before key_type was recorded went by Message-ID
+    return db.execute(
+            'SELECT folder_key, uidvalidity, highest_uid, highestmodseq,'
+            ' COALESCE(key_type, ?) FROM remote_folders'
+            ' WHERE hostname = ? AND username = ? AND folder_name = ?',
+            (KEY_MESSAGE_ID, hostname, username, folder_name)).fetchone()
+
+def imap_enabled_condstore(imap_pool):
+    for extension in ('QRESYNC', 'CONDSTORE'):
+        if extension in imap_pool.enabled:
+            return extension
+    return None
+
+async def purge_expunged_message_refids(
+        imap_pool, db, folder_key, highest_uid, highestmodseq,
+        enabled_extension, known_count, new_uids_count, exists_count):
+    if known_count + new_uids_count == exists_count:
+        # every message we already knew about is still there
+        return 0
+
+    if enabled_extension == 'QRESYNC' and highestmodseq is not None:
+        response = await imap_pool.command(
+                b'UID', b'FETCH', b'1:%d' % highest_uid, b'(UID)',
+                b'(CHANGEDSINCE %d VANISHED)' % highestmodseq)
+        purged_count = 0
+        for vanished_response in response.filter(b'VANISHED'):
+            uid_set_value = vanished_response.text.split()[-1].decode('ascii')
+            for first, last in parse_uid_set(uid_set_value):
+                purged_count += db.execute(
+                        'DELETE FROM remote_messages WHERE folder_key = ?'
+                        ' AND uid BETWEEN ? AND ?',
+                        (folder_key, first, last)).rowcount
+        return purged_count
+
+    response = await imap_pool.command(
+            b'UID', b'SEARCH', b'UID', b'1:%d' % highest_uid)
+    remaining_uids = frozenset(response.search_results())
+    known_uids = [uid for (uid,) in db.execute(
+        'SELECT uid FROM remote_messages WHERE folder_key = ?',
+        (folder_key,))]
+    expunged_uids = [
+            (folder_key, uid) for uid in known_uids
+            if uid not in remaining_uids]
+    db.executemany(
+            'DELETE FROM remote_messages WHERE folder_key = ? AND uid = ?',
+            expunged_uids)
+    return len(expunged_uids)
+
+async def discover_new_message_uids(
+        imap_pool, db, hostname, username, folder_name, key_type):
+    # brings the index up to date with expunges and UIDVALIDITY (or
+    # key type) changes, committing each before waiting on the server
+    # again (so as not to hold up the local scan), and returns the folder's
+    # state along with the uids of the messages we don't know about
+    # yet; the folder's status is the one the (freshly started) pool
+    # got when selecting it
+    (folder_key, known_uidvalidity, highest_uid,
+            known_highestmodseq, known_key_type) = load_remote_folder_state(
+                    db, hostname, username, folder_name)
+    enabled_extension = imap_enabled_condstore(imap_pool)
+    folder_status = imap_pool.folder_status
+    exists_count = folder_status['exists']
+    uidvalidity = folder_status['uidvalidity']
+    highestmodseq = folder_status['highestmodseq']
+
+    if (uidvalidity is None or uidvalidity != known_uidvalidity
+            or key_type != known_key_type):
+        if known_uidvalidity is not None and key_type != known_key_type:
+            log_notice('remote key changed (%s -> %s); rescanning folder' % (
+                known_key_type, key_type))
+        elif known_uidvalidity is not None:
+            log_notice('uidvalidity changed (%s -> %s); rescanning folder' % (
+                known_uidvalidity, uidvalidity))
+        db.execute(
+                'DELETE FROM remote_messages WHERE folder_key = ?',
+                (folder_key,))
+        db.execute(
+                'UPDATE remote_folders SET uidvalidity = ?, highest_uid = 0,'
+                ' highestmodseq = NULL, key_type = ? WHERE folder_key = ?',
+                (uidvalidity, key_type, folder_key))
+        highest_uid = 0
+        known_highestmodseq = None
+        # an interrupted run just fetches them all again
+        db.commit()
+
+    known_count = db.execute(
+            'SELECT COUNT(*) FROM remote_messages WHERE folder_key = ?',
+            (folder_key,)).fetchone()[0]
+    if (highestmodseq is not None and highestmodseq == known_highestmodseq
+            and known_count == exists_count):
+        log_notice('folder unchanged since last run (highestmodseq %d)' %
+                highestmodseq)
+        new_uids = []
+    else:
+        response = await imap_pool.command(
+                b'UID', b'SEARCH', b'UID', b'%d:*' % (highest_uid + 1))
+        # "n:*" always matches the highest uid, even if below n; and
+        # an interrupted run might have fetched some of them already
+        known_new_uids = frozenset(uid for (uid,) in db.execute(
+            'SELECT uid FROM remote_messages'
+            ' WHERE folder_key = ? AND uid > ?', (folder_key, highest_uid)))
+        new_uids = sorted(
+                uid for uid in response.search_results()
+                if uid > highest_uid and uid not in known_new_uids)
+        if highest_uid > 0:
+            purged_count = await purge_expunged_message_refids(
+                    imap_pool, db, folder_key, highest_uid,
+                    known_highestmodseq, enabled_extension,
+                    known_count, len(new_uids), exists_count)
+            log_notice('%d message refs were expunged since last run' %
+                    purged_count)
+            db.commit()
+    return (folder_key, uidvalidity, highestmodseq, highest_uid, new_uids)
+
+async def fetch_imap_message_refids(
+        imap_pool, hostname, username, folder_name, local_dirname,
+        key_type, limit = IMAP_FETCH_LIMIT, on_fetched = None):
+    # returns the (keys, uids) arrays of the folder's messages, as per
+    # key_type; on_fetched(db, folder_key, message_refids) gets called
+    # with every batch of new message
+    # refids as soon as it's been indexed
+    db = open_index_db(local_dirname)
     try:
-        message_refids = reduce(
-                operator.concat,
-                worker_pool.map(imap_worker, worker_pool_args), [])
-        message_refs, message_ids = zip(*message_refids)
-        message_idrefs_dict = dict(zip(message_ids, message_refs))
-        valid_message_ids = filter(lambda mid: mid is not None, message_ids)
-        unique_message_ids = set(valid_message_ids)
-        repeated_count = len(message_refids) - len(unique_message_ids)
-        unique_message_refids = [
-                (message_idrefs_dict[mid], mid)
-                for mid in unique_message_ids]
-        del message_refids
-        del message_idrefs_dict
-        del valid_message_ids
-        del unique_message_ids
-        log_notice('successfully fetched %d message ids (%d repeated)' % (
-            len(unique_message_refids), repeated_count))
-        worker_pool.terminate()
-        return unique_message_refids
-    except Exception as e:
-        log_error('rage quitting on fetch_imap_message_ids: %s' % repr(e))
-        worker_pool.terminate()
-        worker_pool.join()
-        traceback.print_exc()
-        sys.exit(-1)
+        (folder_key, uidvalidity, highestmodseq, highest_uid,
+                new_uids) = await discover_new_message_uids(
+                        imap_pool, db, hostname, username, folder_name,
+                        key_type)
+    except BaseException:
+        db.rollback()
+        db.close()
+        raise
+
+    log_notice('found %d new message refs; fetching up to %d message ids' % (
+        len(new_uids), min(len(new_uids), limit)))
+    message_uids = new_uids[:limit]
+    if len(message_uids) > 0:
+        # cut as they're sent out, so that they follow the budget
+        worker_args = (
+                (batch,) for batch in refid_batches(
+                    message_uids, imap_pool.budget))
+        fetched_count = 0
+        log_progress = progress_logger('fetched', len(message_uids))
+        worker_func = (
+                imap_worker_fetch_gmail_refids if key_type == KEY_GM_MSGID
+                else imap_worker_fetch_message_refids)
+        try:
+            async for message_refids in imap_worker_run(
+                    imap_pool, worker_func, worker_args):
+                db.executemany(
+                        'INSERT OR REPLACE INTO remote_messages'
+                        ' (folder_key, uid, message_id, size, message_digest,'
+                        ' gm_msgid, gm_thrid, timestamp, subject)'
+                        ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        [(folder_key, uid, mid, size, message_id_digest(mid),
+                            gm_msgid, gm_thrid, timestamp, subject)
+                            for uid, mid, size, gm_msgid, gm_thrid, timestamp,
+                                subject in message_refids])
+                # so that an interrupted run needn't fetch them again
+                db.commit()
+                if on_fetched is not None:
+                    on_fetched(db, folder_key, message_refids)
+                fetched_count += len(message_refids)
+                METRICS.count('remote_ids_fetched', len(message_refids))
+                log_progress(fetched_count)
+        except Exception as e:
+            log_error('rage quitting on fetch_imap_message_ids: %s' % repr(e))
+            traceback.print_exc()
+            db.close()
+            raise SyncError('fetching message ids failed') from e
+        highest_uid = max(highest_uid, message_uids[-1])
+
+    db.execute(
+            'UPDATE remote_folders SET uidvalidity = ?, highest_uid = ?,'
+            ' highestmodseq = ? WHERE folder_key = ?',
+            (uidvalidity, highest_uid, highestmodseq, folder_key))
+    db.commit()
+
+    total_count = db.execute(
+            'SELECT COUNT(*) FROM remote_messages WHERE folder_key = ?',
+            (folder_key,)).fetchone()[0]
+    key_column = KEY_COLUMNS[key_type]
+    digests, uids = load_message_digests(
+            db.execute(
+                'SELECT %s, uid FROM remote_messages'
+                ' WHERE folder_key = ? AND %s IS NOT NULL'
+                ' ORDER BY %s' % (key_column, key_column, key_column),
+                (folder_key,)),
+            'I')
+    db.close()
+    log_notice('successfully fetched %d message ids (%d repeated or missing)' % (
+        len(digests), total_count - len(digests)))
+    return (digests, uids)
 
-def sync(local_file_per_id, remote_refids, hostname,
-        username, password, folder_name, local_dirname,
-        purge_deleted, is_dry_sync
-        ):
-    local_ids = frozenset(local_file_per_id.keys())
-    only_remote_refids = list(filter(
-            lambda refmid: refmid[1] not in local_ids,
-            remote_refids))
-
-    log_notice('trying to download %d messages' % len(only_remote_refids))
-    worker_pool = Pool(
-            MAX_IMAP_WORKERS, imap_worker_init,
-            [hostname, username, password, folder_name])
-    worker_pool_args = [
-            (imap_worker_download_message,
-                [message_refid, local_dirname, is_dry_sync])
-            for message_refid in only_remote_refids]
+def record_downloaded_messages(db, downloaded_files):
+    db.executemany(
+            'INSERT OR REPLACE INTO local_messages'
+            ' (filename, inode, size, mtime_ns, message_id, message_digest,'
+            ' gm_msgid, gm_thrid, segment, segment_offset, segment_length)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(filename,) + stat_key + (
+                message_id, message_id_digest(message_id), gm_msgid, gm_thrid)
+                + segment_ref
+                for (filename, stat_key, message_id, gm_msgid, gm_thrid,
+                    segment_ref) in downloaded_files
+                if filename is not None])
+    db.commit()
+
+def load_local_message_keys(local_dirname, key_type):
+    # the (keys, rowids) arrays of the indexed local files, as per
+    # key_type
+    key_column = KEY_COLUMNS[key_type]
+    db = open_index_db(local_dirname)
     try:
-        results = list(filter(
-                lambda v: v,
-                worker_pool.map(imap_worker, worker_pool_args)))
-        log_notice('downloaded %d messages (out of %d)' % (
-            len(results), len(only_remote_refids)))
-        worker_pool.terminate()
+        return load_message_digests(
+                db.execute(
+                    'SELECT %s, rowid FROM local_messages'
+                    ' WHERE %s IS NOT NULL ORDER BY %s' % (
+                        key_column, key_column, key_column)),
+                'q')
+    finally:
+        db.close()
+
+async def adopt_local_messages(imap_pool, hostname, username, folder_name,
+        local_dirname, only_remote_uids):
+    # Going by X-GM-MSGID, local files indexed by their Message-ID alone
+    # (synced before the switch, or parsed again since) would be seen
+    # as missing; their Message-IDs get matched against those of the
+    # remote-only messages, fetched for the purpose, and the files that
+    # match take on the X-GM-MSGID rather than being downloaded again.
+    # Returns the uids left to download and how many files matched.
+    db = open_index_db(local_dirname)
+    try:
+        rowids_per_digest = {}
+        for digest, rowid in db.execute(
+                'SELECT message_digest, rowid FROM local_messages'
+                ' WHERE gm_msgid IS NULL AND message_digest IS NOT NULL'):
+            rowids_per_digest.setdefault(digest, []).append(rowid)
+        if len(rowids_per_digest) == 0 or len(only_remote_uids) == 0:
+            return (only_remote_uids, 0)
+
+        folder_key = load_remote_folder_state(
+                db, hostname, username, folder_name)[0]
+        # joined against, rather than looked up one at a time
+        db.execute(
+                'CREATE TEMP TABLE only_remote_uids'
+                ' (uid INTEGER PRIMARY KEY)')
+        db.executemany(
+                'INSERT INTO temp.only_remote_uids (uid) VALUES (?)',
+                ((uid,) for uid in only_remote_uids))
+        db.commit()
+        unfetched_uids = [uid for (uid,) in db.execute(
+                'SELECT uid FROM temp.only_remote_uids'
+                ' JOIN remote_messages USING (uid)'
+                ' WHERE folder_key = ? AND message_digest IS NULL'
+                ' ORDER BY uid', (folder_key,))]
+        log_notice('matching %d local files without a gmail message id'
+                ' (fetching %d message ids)' % (
+                    sum(map(len, rowids_per_digest.values())),
+                    len(unfetched_uids)))
+        worker_args = (
+                (batch,) for batch in refid_batches(
+                    unfetched_uids, imap_pool.budget))
+        async for message_refids in imap_worker_run(
+                imap_pool, imap_worker_fetch_message_refids, worker_args):
+            db.executemany(
+                    'UPDATE remote_messages'
+                    ' SET message_id = ?, message_digest = ?,'
+                    ' timestamp = ?, subject = ?'
+                    ' WHERE folder_key = ? AND uid = ?',
+                    [(mid, message_id_digest(mid), timestamp, subject,
+                        folder_key, uid)
+                        for uid, mid, _size, _gm_msgid, _gm_thrid, timestamp,
+                            subject in message_refids])
+            db.commit()
+            METRICS.count('remote_ids_fetched', len(message_refids))
+
+        remaining_uids = array.array('I')
+        adopted_keys = []
+        for uid, digest, gm_msgid, gm_thrid in db.execute(
+                'SELECT uid, message_digest, gm_msgid, gm_thrid'
+                ' FROM temp.only_remote_uids JOIN remote_messages USING (uid)'
+                ' WHERE folder_key = ? ORDER BY uid', (folder_key,)):
+            rowids = rowids_per_digest.get(digest)
+            if rowids:
+                adopted_keys.append((gm_msgid, gm_thrid, rowids.pop()))
+            else:
+                remaining_uids.append(uid)
+        db.executemany(
+                'UPDATE local_messages SET gm_msgid = ?, gm_thrid = ?'
+                ' WHERE rowid = ?', adopted_keys)
+        db.commit()
+    finally:
+        db.close()
+    METRICS.count('local_files_adopted', len(adopted_keys))
+    log_notice('%d local files matched remote-only messages' %
+            len(adopted_keys))
+    return (remaining_uids, len(adopted_keys))
+
+def remove_temporary_files(local_dirname):
+    # whatever was being downloaded when a previous run was cut short
+    with os.scandir(local_dirname) as entries:
+        for entry in entries:
+            if TEMP_FILENAME_RE.match(entry.name) and entry.is_file():
+                log_info('removing leftover %s' % repr(entry.name))
+                os.remove(entry.path)
+
+def remote_messages_size(db, folder_key, uids):
+    # the sum of their RFC822.SIZE, as fetched along with their IDs
+    total_size = 0
+    for position in range(0, len(uids), LOOKUP_CHUNK_SIZE):
+        chunk = uids[position:position + LOOKUP_CHUNK_SIZE]
+        total_size += db.execute(
+                'SELECT TOTAL(size) FROM remote_messages'
+                ' WHERE folder_key = ? AND uid IN (%s)' % (
+                    ', '.join('?' * len(chunk))),
+                (folder_key,) + tuple(chunk)).fetchone()[0]
+    return int(total_size)
+
+def lookup_remote_message_refids(db, folder_key, uids):
+    # (uid, message_id, size, gm_msgid, gm_thrid, timestamp, subject)
+    # for each of the (sorted) uids
+    for uid in uids:
+        row = db.execute(
+                'SELECT message_id, size, gm_msgid, gm_thrid, timestamp,'
+                ' subject FROM remote_messages'
+                ' WHERE folder_key = ? AND uid = ?', (folder_key, uid)).fetchone()
+        if row is not None:
+            yield (uid,) + row
+
+async def download_messages(imap_pool, db, folder_key, uid_batches,
+        total_count, local_dirname, is_dry_sync, journal=None,
+        total_bytes=None):
+    # downloads the messages of every (sorted) batch of uids out of
+    # uid_batches, an iterable or an asyncio queue (ending with None);
+    # returns how many got downloaded
+    if not is_dry_sync:
+        remove_temporary_files(local_dirname)
+    # every message stored gets recorded in the index as it comes,
+    # so that an interrupted run leaves it indexed (and it needn't
+    # be parsed again)
+    if journal is None:
+        journal = functools.partial(record_downloaded_messages, db)
+    storage = None
+    if STORAGE == 'packed' and not is_dry_sync:
+        storage = PackedMessageStorage(local_dirname, db)
+    downloaded_count = downloaded_bytes = 0
+    log_progress = progress_logger('downloaded', total_count, total_bytes)
+    try:
+        if isinstance(uid_batches, asyncio.Queue):
+            uid_batches = queued_items(uid_batches)
+        else:
+            uid_batches = aiter_items(uid_batches)
+        async for uids in uid_batches:
+            # cut as they're sent out, so that they follow the budget
+            worker_args = (
+                    (batch, local_dirname, is_dry_sync, journal, storage)
+                    for batch in download_batches(
+                        lookup_remote_message_refids(db, folder_key, uids),
+                        imap_pool.budget))
+            async for batch_downloaded_count, batch_downloaded_bytes in (
+                    imap_worker_run(
+                        imap_pool, imap_worker_download_messages,
+                        worker_args)):
+                downloaded_count += batch_downloaded_count
+                downloaded_bytes += batch_downloaded_bytes
+                METRICS.count('messages_downloaded', batch_downloaded_count)
+                log_progress(downloaded_count, downloaded_bytes)
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
         log_error('rage quitting on sync: %s' % repr(e))
-        worker_pool.terminate()
-        worker_pool.join()
         traceback.print_exc()
-        sys.exit(-1)
+        raise SyncError('downloading messages failed') from e
+    finally:
+        if storage is not None:
+            storage.close()
+    return downloaded_count
+
+async def queued_items(queue):
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        yield item
+
+async def aiter_items(items):
+    for item in items:
+        yield item
+
+async def download_confirmed_messages(imap_pool, confirmed_uids, hostname,
+        username, folder_name, local_dirname):
+    # downloads the remote messages confirmed missing (see
+    # sync_folder_over_pool) while the folder's discovery goes on;
+    # returns how many got downloaded, all of which are in the local
+    # index by then
+    # nothing until the local scan is over; nor is the index opened
+    # before then, while discovery might be in the middle of writing
+    uids = await confirmed_uids.get()
+    if uids is None:
+        return 0
+    confirmed_uids.put_nowait(uids)
+    db = open_index_db(local_dirname)
+    folder_key = load_remote_folder_state(
+            db, hostname, username, folder_name)[0]
+    log_notice('downloading messages confirmed missing'
+            ' while discovery goes on')
+    try:
+        with METRICS.phase('transfer'):
+            return await download_messages(
+                    imap_pool, db, folder_key, confirmed_uids, None,
+                    local_dirname, False)
+    finally:
+        db.close()
+
+def sorted_contains(values, value):
+    position = bisect.bisect_left(values, value)
+    return position < len(values) and values[position] == value
 
+async def sync(imap_pool, only_remote_uids, only_local_rowids, hostname,
+        username, folder_name, local_dirname, purge_deleted, is_dry_sync):
+    # message ids (and sizes) are only looked up for the messages
+    # that are going to be transferred or deleted
+    db = open_index_db(local_dirname)
+    folder_key = load_remote_folder_state(
+            db, hostname, username, folder_name)[0]
+
+    total_bytes = remote_messages_size(db, folder_key, only_remote_uids)
+    log_notice('trying to download %d messages (%.1f MiB)' % (
+        len(only_remote_uids), total_bytes / 1048576))
+    downloaded_count = 0
+    if len(only_remote_uids) > 0:
+        try:
+            # the connections sat idle while the diff was worked out
+            await imap_pool.check(IMAP_IDLE_CHECK_SECONDS)
+            downloaded_count = await download_messages(
+                    imap_pool, db, folder_key, [sorted(only_remote_uids)],
+                    len(only_remote_uids), local_dirname, is_dry_sync,
+                    total_bytes=total_bytes)
+        except asyncio.CancelledError:
+            db.close()
+            raise
+    log_notice('downloaded %d messages (out of %d)' % (
+        downloaded_count, len(only_remote_uids)))
+
+    purged_count = 0
     if purge_deleted:
-        to_delete = local_ids - frozenset([v for k,v in remote_refids])
-        log_notice('purging %d local message(s) not found remotely' % len(to_delete))
+        log_notice('purging %d local message(s) not found remotely' %
+                len(only_local_rowids))
         if not is_dry_sync:
-            for message_id in to_delete:
-                filename = local_file_per_id[message_id]
-                os.remove(filename)
+            for rowid in only_local_rowids:
+                (filename, segment) = db.execute(
+                        'SELECT filename, segment FROM local_messages'
+                        ' WHERE rowid = ?', (rowid,)).fetchone()
+                if segment is None:
+                    os.remove(os.path.join(local_dirname, filename))
+                else:
+                    # what it takes up within the segment stays taken
+                    db.execute(
+                            'DELETE FROM local_messages WHERE rowid = ?',
+                            (rowid,))
+                    db.commit()
+                purged_count += 1
+                METRICS.count('messages_purged')
+    db.close()
+    return (downloaded_count, purged_count)
 
+async def sync_folder(run_type, hostname, username, password, folder_name,
+        local_dirname, local_scan, purge_deleted, budget=None):
+    # returns this folder's counts (see ACCOUNT_COUNTS; all but 'failed')
+    is_own_budget = budget is None
+    if is_own_budget:
+        budget = imap_connection_budget()
+    imap_pool = imap_worker_pool(
+            hostname, username, password, folder_name, budget)
+    try:
+        counts = await sync_folder_over_pool(
+                imap_pool, run_type, hostname, username, folder_name,
+                local_dirname, local_scan, purge_deleted)
+    finally:
+        await imap_pool.close()
+    if is_own_budget:
+        log_notice('imap: %s' % budget.summary())
+    return counts
 
-LOCAL_WORKER_CACHE = None
-def local_worker_init(cached_id_per_file):
-    global LOCAL_WORKER_CACHE
-    LOCAL_WORKER_CACHE = cached_id_per_file
-    signal.signal(signal.SIGINT, local_worker_die)
+async def sync_folder_over_pool(imap_pool, run_type, hostname, username,
+        folder_name, local_dirname, local_scan, purge_deleted):
+    # a single pool of connections, logged in and with the folder
+    # selected, from discovery to the end of the transfer. The local
+    # scan (a future; see start_local_scans) goes on meanwhile; once
+    # it's over, newly discovered messages that are confirmed missing
+    # get downloaded right away, rather than after the diff (which then
+    # goes by the local index, where they've been recorded)
+    confirmed_uids = asyncio.Queue()
 
-def parse_and_append_local_message_id(filepath):
-    cached_message_id = LOCAL_WORKER_CACHE.get(filepath)
-    if cached_message_id != None:
-        return (cached_message_id, filepath)
+    def confirm_missing(db, folder_key, message_refids):
+        if (not local_scan.done() or local_scan.cancelled()
+                or local_scan.exception() is not None):
+            # left to the diff
+            return
+        local_digests = local_scan.result()[0]
+        uids = array.array('I')
+        for uid, message_id, *_rest in message_refids:
+            digest = message_id_digest(message_id)
+            if digest is None or sorted_contains(local_digests, digest):
+                continue
+            # copies of the same message only get downloaded once: the
+            # one with the lowest uid (as per the index, which the batch
+            # is in already) is, and the rest are left out; if that one
+            # wasn't confirmed itself, the diff will deal with it
+            first_uid = db.execute(
+                    'SELECT MIN(uid) FROM remote_messages'
+                    ' WHERE folder_key = ? AND message_digest = ?',
+                    (folder_key, digest)).fetchone()[0]
+            if first_uid == uid:
+                uids.append(uid)
+        if len(uids) > 0:
+            confirmed_uids.put_nowait(uids)
+
+    downloading = None
+    try:
+        with METRICS.phase('remote_scan'):
+            await imap_pool.start()
+            log_notice('connected \'%s\' to %s' % (username, hostname))
+            key_type = imap_remote_key_type(imap_pool)
+            # those going by X-GM-MSGID have local files to adopt first;
+            # dry syncs, which don't index what they download, leave it
+            # all to the diff
+            if run_type == 'sync' and key_type == KEY_MESSAGE_ID:
+                downloading = asyncio.ensure_future(
+                        download_confirmed_messages(
+                            imap_pool, confirmed_uids, hostname, username,
+                            folder_name, local_dirname))
+            remote_digests, remote_uids = await fetch_imap_message_refids(
+                    imap_pool, hostname, username, folder_name,
+                    local_dirname, key_type,
+                    on_fetched=(
+                        confirm_missing if downloading is not None
+                        else None))
+        confirmed_uids.put_nowait(None)
+        local_digests, local_rowids = await local_scan
+        downloaded_count = 0
+        if downloading is not None:
+            downloaded_count = await downloading
+            downloading = None
+    finally:
+        if downloading is not None:
+            downloading.cancel()
+    if key_type != KEY_MESSAGE_ID or downloaded_count > 0:
+        # the local scan went by Message-ID, or is missing whatever
+        # got downloaded since
+        del local_digests, local_rowids
+        local_digests, local_rowids = load_local_message_keys(
+                local_dirname, key_type)
+    only_remote, only_local, common_count = diff_message_digests(
+            remote_digests, local_digests)
+    remote_count = len(remote_digests)
+    # those downloaded while discovery went on were remote-only too
+    remote_only_count = len(only_remote) + downloaded_count
+    common_count -= downloaded_count
+    del local_digests
+    del remote_digests
+    only_remote_uids = array.array(
+            'I', (remote_uids[position] for position in only_remote))
+    only_local_rowids = array.array(
+            'q', (local_rowids[position] for position in only_local))
+    del remote_uids
+    del local_rowids
+    if key_type == KEY_GM_MSGID:
+        with METRICS.phase('remote_scan'):
+            only_remote_uids, adopted_count = await adopt_local_messages(
+                    imap_pool, hostname, username, folder_name,
+                    local_dirname, only_remote_uids)
+        common_count += adopted_count
+        remote_only_count = len(only_remote_uids)
+
+    purged_count = 0
+    if run_type == 'dry':
+        log_notice('found %d remote-only, %d local-only (delete? %s), %d common IDs' % (
+            remote_only_count, len(only_local_rowids), purge_deleted,
+            common_count))
+    else:
+        if downloaded_count > 0:
+            log_notice('downloaded %d messages while discovery went on' %
+                    downloaded_count)
+        with METRICS.phase('transfer'):
+            sync_downloaded_count, purged_count = await sync(
+                    imap_pool, only_remote_uids, only_local_rowids,
+                    hostname, username, folder_name,
+                    local_dirname, purge_deleted, run_type == 'dry_sync')
+        downloaded_count += sync_downloaded_count
+    return (remote_count, remote_only_count, len(only_local_rowids),
+            common_count, downloaded_count, purged_count)
+
+ACCOUNT_COUNTS = ('remote', 'remote-only', 'local-only', 'common',
+        'downloaded', 'purged', 'failed')
+MODIFIED_UTF7_RE = re.compile(r'&([^-]*)-')
+
+def decode_folder_name(folder_name):
+    # folder names come in IMAP's modified UTF-7 (RFC 3501, 5.1.3)
+    def decode_part(match):
+        if not match.group(1):
+            return u'&'
+        return (u'+%s-' % match.group(1).replace(u',', u'/')).encode(
+                'ascii').decode('utf-7')
+    try:
+        return MODIFIED_UTF7_RE.sub(decode_part, folder_name)
+    except UnicodeError:
+        return folder_name
+
+def local_folder_dirname(local_dirname, folder_name, delimiter):
+    # a (sub)directory per level of the folder hierarchy
+    decoded_name = decode_folder_name(folder_name)
+    name_parts = decoded_name.split(delimiter) if delimiter else [decoded_name]
+    safe_parts = []
+    for part in name_parts:
+        part = unicode_replace_nonprintable(part).replace(os.sep, u'_')
+        # names that look like shards get escaped whatever the layout,
+        # which local scans go by regardless (and which may change)
+        if (len(part) == 0 or part.startswith(u'.')
+                or SHARD_DIRNAME_RE.match(part)):
+            part = u'_' + part
+        safe_parts.append(part)
+    return os.path.join(local_dirname, *safe_parts)
+
+async def list_imap_folders(hostname, username, password, folder_pattern):
+    # (folder_name, delimiter, message_count) for every selectable
+    # folder matching the pattern, smallest first
+    connection = aioimap.Connection(hostname)
+    await connection.connect()
+    await connection.login(username, password)
+    log_notice('connected \'%s\' to %s' % (username, hostname))
+    folders = [
+            (folder_name, delimiter)
+            for attributes, delimiter, folder_name in await connection.list(
+                u'', folder_pattern)
+            if not attributes & {'\\noselect', '\\nonexistent'}]
+    # pipelined on the same connection
+    statuses = await asyncio.gather(
+            *[connection.status(folder_name, 'MESSAGES')
+                for folder_name, _delimiter in folders])
+    await connection.logout()
+    return sorted(
+            ((folder_name, delimiter, status.get('MESSAGES') or 0)
+                for (folder_name, delimiter), status in zip(folders, statuses)),
+            key=lambda folder: folder[2])
+
+async def sync_account(run_type, hostname, username, password,
+        folder_dirnames, worker_pool, purge_deleted, budget=None):
+    # folders are synced concurrently, in the order given, over a
+    # single budget of MAX_IMAP_WORKERS connections; their local
+    # directories get scanned (by worker_pool) in the same order
+    is_own_budget = budget is None
+    if is_own_budget:
+        budget = imap_connection_budget()
+    folder_slots = asyncio.Semaphore(MAX_IMAP_WORKERS)
+    local_scans = dict(zip(
+        (folder_name for folder_name, _folder_dirname in folder_dirnames),
+        start_local_scans(
+            [folder_dirname for _folder_name, folder_dirname
+                in folder_dirnames],
+            worker_pool)))
+
+    async def sync_account_folder(folder_name, folder_dirname):
+        async with folder_slots:
+            log_notice('syncing folder \'%s\' into %s' % (
+                folder_name, repr(folder_dirname)))
+            # a folder that fails is logged and counted as such; the
+            # others carry on (what it got done so far was committed
+            # as it went, so the next run picks up from there)
+            try:
+                counts = await sync_folder(
+                        run_type, hostname, username, password, folder_name,
+                        folder_dirname, local_scans.pop(folder_name),
+                        purge_deleted, budget)
+            except SyncError as e:
+                # the details got logged already
+                log_error('failed to sync folder \'%s\': %s' % (
+                    folder_name, e))
+                return (0,) * (len(ACCOUNT_COUNTS) - 1) + (1,)
+            except Exception:
+                log_error('failed to sync folder \'%s\': %s' % (
+                    folder_name, traceback.format_exc()))
+                return (0,) * (len(ACCOUNT_COUNTS) - 1) + (1,)
+            counts = tuple(counts) + (0,)
+            log_notice('done with folder \'%s\' (%s)' % (
+                folder_name, ', '.join(
+                    '%d %s' % (count, name)
+                    for name, count in zip(ACCOUNT_COUNTS, counts[:-1]))))
+            return counts
+
+    folder_counts = await asyncio.gather(
+            *[sync_account_folder(folder_name, folder_dirname)
+                for folder_name, folder_dirname in folder_dirnames])
+    if is_own_budget:
+        log_notice('imap: %s' % budget.summary())
+    return ([sum(counts) for counts in zip(*folder_counts)]
+            or [0] * len(ACCOUNT_COUNTS))
+
+
+def local_worker_init():
+    # interrupts are dealt with by the parent, which terminates us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+HEADER_FIELD_LINE_RE = re.compile(rb'[\041-\071\073-\176]+:')
+
+def find_header_block_end(data, start=0):
+    # returns the offset right after the last header line, or -1
+    if data[:1] == b'\n' or data[:2] == b'\r\n':
+        return 0
+    ends = [end for end in (
+        data.find(b'\n\n', start), data.find(b'\n\r\n', start))
+        if end >= 0]
+    return (min(ends) + 1) if ends else -1
+
+def read_header_block(msg_file):
+    # reads no further than needed to find the first blank line;
+    # returns None if it's not there (or too far in)
+    data = bytearray()
+    while len(data) < MAX_HEADER_BLOCK_SIZE:
+        chunk = msg_file.read(HEADER_READ_SIZE)
+        if not chunk:
+            return None
+        previous_size = len(data)
+        data.extend(chunk)
+        end = find_header_block_end(data, max(0, previous_size - 2))
+        if end >= 0:
+            return bytes(data[:end])
+    return None
+
+def scan_header_fields(header_block, field_names):
+    # Returns the raw values of the first occurrence of each of the
+    # (lowercase) field names, unfolded exactly as the email package
+    # would; or None if the block looks odd enough to require the
+    # full parser.
+    if b'\r' in header_block.replace(b'\r\n', b''):
+        return None
+    values = {}
+    collecting = None
+    for line in header_block.splitlines(True):
+        if line[:1] in (b' ', b'\t'):
+            if collecting is False:
+                continue
+            elif collecting is None:
+                return None
+            values[collecting].append(line)
+            continue
+        match = HEADER_FIELD_LINE_RE.match(line)
+        if match is None:
+            return None
+        name = str(line[:match.end() - 1], 'ascii').lower()
+        if name in field_names and name not in values:
+            values[name] = [line[match.end():].lstrip(b' \t')]
+            collecting = name
+        else:
+            collecting = False
+
+    decoded_values = {}
+    for name, value_lines in values.items():
+        value = b''.join(value_lines)
+        if not value.isascii():
+            # the email package goes through surrogates for these
+            return None
+        decoded_values[name] = str(value, 'ascii').rstrip('\r\n')
+    return decoded_values
+
+def parse_header_fields(content, field_names):
+    # same as read_header_fields(), for content already in memory
+    end = find_header_block_end(content)
+    if end >= 0:
+        values = scan_header_fields(content[:end], field_names)
+        if values is not None:
+            return values
+    message = email.message_from_bytes(content)
+    return dict((name, message[name]) for name in field_names
+            if message[name] is not None)
+
+def read_header_fields(msg_file, field_names):
+    # header fields out of the header block alone, falling back to
+    # the full parser whenever the scan isn't conclusive
+    header_block = read_header_block(msg_file)
+    if header_block is not None:
+        values = scan_header_fields(header_block, field_names)
+        if values is not None:
+            return values
+    msg_file.seek(0)
+    message = email.message_from_bytes(msg_file.read())
+    return dict((name, message[name]) for name in field_names
+            if message[name] is not None)
 
+def is_corrupted_message_file(msg_file):
+    msg_file.seek(0, os.SEEK_END)
+    if msg_file.tell() < 3:
+        return False
+    msg_file.seek(-3, os.SEEK_END)
+    return msg_file.read(3) == b'\x00\x00\x00'
+
+def parse_and_append_local_message_id(filepath):
     with open(filepath, 'rb') as msg_file:
-        content = msg_file.read()
-        if content.endswith(b'\x00\x00\x00'):
+        if is_corrupted_message_file(msg_file):
             log_error('cannot parse %s: corrupted' %
                     repr(os.path.basename(filepath)))
-            return
-        message = email.message_from_bytes(content)
-        message_id = message['message-id']
-        del message
-        del content
-        if message_id is not None:
-            message_id = sane_message_id(decode_header(message_id))
+            return (None, filepath)
+        msg_file.seek(0)
+        header_fields = read_header_fields(
+                msg_file, ('message-id',) + FINGERPRINT_FIELDS)
+        message_id = local_message_id(msg_file, header_fields)
 
         if (message_id is None) or (len(message_id) == 0):
             log_error('cannot sync %s: invalid message id (%s)' %
                     (repr(filepath), repr(message_id)))
-        else:
-            return (message_id, filepath)
+            return (None, filepath)
+        return (message_id, filepath)
+
+def local_message_id(msg_file, header_fields):
+    # its Message-ID, or else its fingerprint; header_fields must
+    # include FINGERPRINT_FIELDS
+    message_id = header_fields.get('message-id')
+    if message_id is not None:
+        return sane_message_id(decode_header(message_id))
+    return read_message_fingerprint(msg_file, header_fields)
+
+def local_worker_scan_segment(dirname, segment_tail):
+    # (filename, stat_key, message_id, (segment, offset, length)) for
+    # every complete message in the segment from `offset` on, which is
+    # where the indexed ones end; a message cut short or corrupted (by
+    # an interrupted run) ends the scan
+    segment, offset = segment_tail
+    filepath = os.path.join(dirname, SEGMENTS_DIRNAME, segment)
+    segment_mtime = os.stat(filepath).st_mtime
+    scanned_messages = []
+    with open(filepath, 'rb') as segment_file:
+        segment_file.seek(offset)
+        data = b''
+        while True:
+            decompressor = segment_decompressor(segment)
+            content = bytearray()
+            length = 0
+            try:
+                while not decompressor.eof:
+                    if not data:
+                        data = segment_file.read(SEGMENT_COPY_SIZE)
+                        if not data:
+                            break
+                    content += decompressor.decompress(data)
+                    length += len(data) - len(decompressor.unused_data)
+                    data = decompressor.unused_data
+            except Exception as e:
+                log_error('%s is corrupted after offset %d: %s' % (
+                    repr(segment), offset, repr(e)))
+                return scanned_messages
+            if not decompressor.eof:
+                if length > 0:
+                    log_error('%s is cut short after offset %d' % (
+                        repr(segment), offset))
+                return scanned_messages
+
+            content = bytes(content)
+            header_fields = parse_header_fields(
+                    content, ('message-id', 'date', 'subject')
+                    + FINGERPRINT_FIELDS)
+            message_id = local_message_id(io.BytesIO(content), header_fields)
+            timestamp = message_timestamp(header_fields)
+            filename = os.path.basename(local_message_filepath(
+                    dirname, message_id, timestamp,
+                    decode_header(header_fields.get('subject', ''))))
+            mtime = segment_mtime if timestamp is None else timestamp
+            scanned_messages.append((
+                filename, (0, len(content), int(mtime * 1e9)), message_id,
+                (segment, offset, length)))
+            offset += length
+
+def local_worker_parse_files(dirname, unindexed_files):
+    # results come back out of order; they carry what they're about
+    parsed_files = []
+    for filename, stat_key in unindexed_files:
+        message_id, _filepath = parse_and_append_local_message_id(
+                os.path.join(dirname, filename))
+        parsed_files.append((filename, stat_key, message_id))
+    return parsed_files
+
+def pool_imap_unordered(worker_pool, func, tasks, window):
+    # same as worker_pool.imap_unordered(), except that no more than
+    # `window` tasks are handed out (and held in memory) at once; the
+    # pool would otherwise go through all of `tasks` right away, no
+    # matter how lazily they're generated
+    slots = threading.Semaphore(window)
+    stopped = threading.Event()
+
+    def windowed_tasks():
+        # iterated over from within the pool's own task handler thread
+        for task in tasks:
+            slots.acquire()
+            if stopped.is_set():
+                return
+            yield task
+
+    try:
+        for result in worker_pool.imap_unordered(func, windowed_tasks()):
+            slots.release()
+            yield result
+    finally:
+        # the task handler mustn't be left waiting for a slot, or the
+        # pool will never finish terminating
+        stopped.set()
+        slots.release()
 
 def sane_message_id(raw_value):
     separate = list(filter(len, re.split(r'\s+', raw_value)))
@@ -370,92 +2012,496 @@ def sane_message_id(raw_value):
         return None
     return rejoined
 
-#def imap_worker_die(signum, frame):
-def local_worker_die():
-    sys.exit(-1)
+def message_fingerprint(size, header_fields):
+    # '<fp:...>', a stand-in for the Message-ID of messages without
+    # one, out of what the server can tell without sending them over:
+    # their size (with CRLF line endings, as per RFC822.SIZE) and the
+    # (raw) values of FINGERPRINT_FIELDS; None if they have none of
+    # those. Copies of the same message get the same one, and so
+    # would two different messages the same in all of that.
+    if not any(name in header_fields for name in FINGERPRINT_FIELDS):
+        return None
+    fingerprint = hashlib.sha1(b'%d' % size)
+    for name in FINGERPRINT_FIELDS:
+        value = ' '.join(str(header_fields.get(name, '')).split())
+        fingerprint.update(b'\n%s:%s' % (
+            name.encode('ascii'), value.encode('utf-8', 'surrogatepass')))
+    return u'<fp:%s>' % fingerprint.hexdigest()
+
+def read_crlf_size(msg_file):
+    # the size of the message with every CR, LF or CRLF made into a
+    # CRLF, which is how servers store (and count) them
+    msg_file.seek(0)
+    size = 0
+    previous_chunk = b''
+    while True:
+        chunk = msg_file.read(FINGERPRINT_READ_SIZE)
+        if not chunk:
+            return size
+        size += (len(chunk) + chunk.count(b'\r') + chunk.count(b'\n')
+                - 2 * chunk.count(b'\r\n'))
+        if previous_chunk[-1:] == b'\r' and chunk[:1] == b'\n':
+            # a CRLF split across chunks
+            size -= 2
+        previous_chunk = chunk
 
+def read_message_fingerprint(msg_file, header_fields):
+    return message_fingerprint(read_crlf_size(msg_file), header_fields)
 
-def fetch_local_message_ids(dirname):
-    filepaths = []
-    filenames = os.listdir(dirname)
+
+def list_local_files(dirname):
+    # returns (filename, (inode, size, mtime_ns)) pairs, the filenames of
+    # sharded messages (see LAYOUT) being relative paths; whatever the
+    # layout, so that flat and sharded files can live side by side.
+    # Shard subdirectories get listed in parallel, a level at a time.
+    local_files, shard_dirnames = scan_local_dir(dirname, u'')
+    if len(shard_dirnames) > 0:
+        with ThreadPool(MAX_SCAN_THREADS) as thread_pool:
+            while len(shard_dirnames) > 0:
+                scanned_dirs = thread_pool.map(
+                        functools.partial(scan_local_dir, dirname),
+                        shard_dirnames)
+                shard_dirnames = []
+                for scanned_files, scanned_dirnames in scanned_dirs:
+                    local_files.extend(scanned_files)
+                    shard_dirnames.extend(scanned_dirnames)
     log_info('listed %s' % dirname)
-    for filename in filenames:
-        filepath = os.path.join(dirname, filename)
-        if os.path.isfile(filepath) and filepath[:2] != TEMP_PREFIX:
-            filepaths.append(filepath)
+    return local_files
 
-    cache_filepath = 'cached_local_message_ids.pickle'
-    try:
-        with open(cache_filepath, 'rb') as cache_f:
-            cached_id_per_file = pickle.load(cache_f)
-    except Exception:
-        cached_id_per_file = {}
+def scan_local_dir(dirname, relative_dirname):
+    # the files and shard subdirectories within relative_dirname
+    local_files = []
+    shard_dirnames = []
+    with os.scandir(os.path.join(dirname, relative_dirname)) as entries:
+        for entry in entries:
+            # skips temporary files as well as the index and segments
+            if entry.name.startswith(u'.'):
+                continue
+            filename = os.path.join(relative_dirname, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                # subdirectories with an index of their own are folders
+                if (SHARD_DIRNAME_RE.match(entry.name) and
+                        not os.path.exists(
+                            os.path.join(entry.path, INDEX_FILENAME))):
+                    shard_dirnames.append(filename)
+            elif entry.is_file():
+                stat = entry.stat()
+                local_files.append(
+                        (filename,
+                            (stat.st_ino, stat.st_size, stat.st_mtime_ns)))
+    return (local_files, shard_dirnames)
+
+def record_local_message_ids(db, parsed_rows):
+    db.executemany(
+            'INSERT OR REPLACE INTO local_messages'
+            ' (filename, inode, size, mtime_ns,'
+            ' message_id, message_digest)'
+            ' VALUES (?, ?, ?, ?, ?, ?)', parsed_rows)
+    db.commit()
+
+def start_local_scans(dirnames, worker_pool):
+    # scans (see fetch_local_message_ids) the local directories one
+    # after the other, in a thread of their own, while the remote side
+    # gets scanned; returns a future per directory. worker_pool has to
+    # be started beforehand, so that it isn't forked off a thread
+    loop = asyncio.get_running_loop()
+    local_scans = [loop.create_future() for _dirname in dirnames]
+
+    def scan_local_dirs():
+        for dirname, local_scan in zip(dirnames, local_scans):
+            try:
+                with METRICS.phase('local_scan'):
+                    result = fetch_local_message_ids(dirname, worker_pool)
+            except Exception as e:
+                # SyncError included; it's raised wherever it's awaited,
+                # and the other directories still get scanned
+                loop.call_soon_threadsafe(
+                        set_future_exception, local_scan, e)
+                continue
+            except BaseException as e:
+                for failed_scan in local_scans:
+                    loop.call_soon_threadsafe(
+                            set_future_exception, failed_scan, e)
+                return
+            loop.call_soon_threadsafe(local_scan.set_result, result)
+
+    # a daemon, so that an interrupted run needn't wait for it to finish
+    threading.Thread(target=scan_local_dirs, daemon=True).start()
+    return local_scans
+
+def set_future_exception(future, e):
+    if not future.done():
+        future.set_exception(e)
+
+def fetch_local_message_ids(dirname, worker_pool=None):
+    # returns the (digests, rowids) arrays of the indexed local files;
+    # worker_pool is left running if given (see start_local_scans)
+    local_files = list_local_files(dirname)
+    METRICS.count('local_files', len(local_files))
+    db = open_index_db(dirname)
+    # packed messages aren't files of their own
+    indexed_stat_keys = dict(
+            (filename, (inode, size, mtime_ns))
+            for filename, inode, size, mtime_ns in db.execute(
+                'SELECT filename, inode, size, mtime_ns FROM local_messages'
+                ' WHERE segment IS NULL'))
+
+    # cache hits are settled here; the workers share no state with us
+    # and only ever get the (filename, stat key) of the files to parse
+    unindexed_files = []
+    for filename, stat_key in local_files:
+        if indexed_stat_keys.pop(filename, None) != stat_key:
+            unindexed_files.append((filename, stat_key))
+    db.executemany(
+            'DELETE FROM local_messages WHERE filename = ?',
+            [(filename,) for filename in indexed_stat_keys])
+    db.commit()
+    del indexed_stat_keys
+    # segments that go on past their last indexed message
+    segment_tails = [
+            (segment, indexed_end)
+            for segment, size, indexed_end in (
+                (segment, size, indexed_segment_end(db, segment))
+                for _number, segment, size in list_segments(dirname))
+            if size > indexed_end]
 
-    log_notice('attempting to fetch message ids out of %d files' %
-            len(filepaths))
-    worker_pool = Pool(
-            MAX_LOCAL_WORKERS, local_worker_init, [cached_id_per_file])
+    log_notice('attempting to fetch message ids out of %d files'
+            ' (%d already indexed)' % (
+                len(local_files), len(local_files) - len(unindexed_files)))
+    is_own_pool = worker_pool is None
+    if is_own_pool:
+        worker_pool = Pool(MAX_LOCAL_WORKERS, local_worker_init)
     try:
-        file_per_id_pairs = worker_pool.map(
-                parse_and_append_local_message_id, filepaths)
-        defined_file_per_id_pairs = list(filter(
-                lambda v: v is not None, file_per_id_pairs))
-        new_cached_id_per_file = dict(
-                [(v, k) for k, v in defined_file_per_id_pairs])
-        file_per_id = dict(defined_file_per_id_pairs)
-
-        invalid_count = len(file_per_id_pairs) - len(defined_file_per_id_pairs)
-        del file_per_id_pairs
-        repeated_count = len(defined_file_per_id_pairs) - len(file_per_id)
-        del defined_file_per_id_pairs
+        # indexed as they come, LOCAL_COMMIT_FILES at a time, so that an
+        # interrupted run needn't parse them again; they're written all
+        # at once, so as not to keep the remote discovery waiting for
+        # the index
+        parsed_count = 0
+        parsed_rows = []
+        log_progress = progress_logger('parsed', len(unindexed_files))
+        for parsed_files in pool_imap_unordered(
+                worker_pool,
+                functools.partial(local_worker_parse_files, dirname),
+                chunks(unindexed_files, LOCAL_CHUNK_SIZE),
+                LOCAL_WINDOW_TASKS):
+            parsed_rows.extend(
+                    (filename, inode, size, mtime_ns,
+                        message_id, message_id_digest(message_id))
+                    for filename, (inode, size, mtime_ns), message_id
+                    in parsed_files)
+            parsed_count += len(parsed_files)
+            METRICS.count('local_files_parsed', len(parsed_files))
+            METRICS.count('local_bytes_parsed', sum(
+                stat_key[1] for _filename, stat_key, _mid in parsed_files))
+            log_progress(parsed_count)
+            if len(parsed_rows) >= LOCAL_COMMIT_FILES:
+                record_local_message_ids(db, parsed_rows)
+                parsed_rows = []
+        record_local_message_ids(db, parsed_rows)
+        del parsed_rows
+        if len(segment_tails) > 0:
+            log_notice('scanning %d segments for unindexed messages' %
+                    len(segment_tails))
+        for scanned_messages in pool_imap_unordered(
+                worker_pool,
+                functools.partial(local_worker_scan_segment, dirname),
+                segment_tails, LOCAL_WINDOW_TASKS):
+            db.executemany(
+                    'INSERT OR REPLACE INTO local_messages'
+                    ' (filename, inode, size, mtime_ns,'
+                    ' message_id, message_digest,'
+                    ' segment, segment_offset, segment_length)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(filename,) + stat_key + (
+                        message_id, message_id_digest(message_id))
+                        + segment_ref
+                        for filename, stat_key, message_id, segment_ref
+                        in scanned_messages])
+            db.commit()
+            METRICS.count('local_files_parsed', len(scanned_messages))
+            METRICS.count('local_bytes_parsed', sum(
+                stat_key[1] for _filename, stat_key, _mid, _segment_ref
+                in scanned_messages))
+        if is_own_pool:
+            worker_pool.terminate()
+        del unindexed_files
+
+        indexed_count = db.execute(
+                'SELECT COUNT(*) FROM local_messages').fetchone()[0]
+        packed_count = db.execute(
+                'SELECT COUNT(*) FROM local_messages'
+                ' WHERE segment IS NOT NULL').fetchone()[0]
+        invalid_count = db.execute(
+                'SELECT COUNT(*) FROM local_messages'
+                ' WHERE message_digest IS NULL').fetchone()[0]
+        digests, rowids = load_message_digests(
+                db.execute(
+                    'SELECT message_digest, rowid FROM local_messages'
+                    ' WHERE message_digest IS NOT NULL'
+                    ' ORDER BY message_digest'),
+                'q')
+        db.close()
+        repeated_count = indexed_count - invalid_count - len(digests)
 
         log_notice(
                 'successfully fetched %d message ids'
-                ' (%d were invalid, %d were repeated) out of %d files' %
-                (len(file_per_id), invalid_count,
-                    repeated_count, len(filepaths)))
-        worker_pool.terminate()
-        with open(cache_filepath, 'wb') as cache_f:
-            cached_id_per_file.update(new_cached_id_per_file)
-            pickle.dump(cached_id_per_file, cache_f)
-        del new_cached_id_per_file
-        del cached_id_per_file
-        return file_per_id
+                ' (%d were invalid, %d were repeated) out of %d files'
+                ' and %d packed messages' %
+                (len(digests), invalid_count, repeated_count,
+                    len(local_files), packed_count))
+        return (digests, rowids)
     except Exception as e:
         log_error("rage quitting on fetch_local_message_ids: %s" % repr(e))
-        worker_pool.terminate()
-        worker_pool.join()
+        if is_own_pool:
+            worker_pool.terminate()
+            worker_pool.join()
         traceback.print_exc()
-        sys.exit(-1)
+        raise SyncError('fetching local message ids failed') from e
 
 def run(run_type, hostname, username, imap_folder_name, local_dirname, purge_deleted):
     if run_type not in ['dry', 'dry_sync', 'sync']:
         raise Exception('unknown run type: %s' % run_type)
+    if LAYOUT not in LAYOUTS:
+        raise Exception('unknown layout: %s' % LAYOUT)
     password = getpass.getpass('Password for "%s@%s": ' % (username, hostname))
-    local_file_per_id = fetch_local_message_ids(local_dirname)
-    remote_refids = fetch_imap_message_refids(
-            hostname, username, password, imap_folder_name)
-    remote_ids = frozenset([mid for _ref,mid in remote_refids])
-    if run_type == 'dry':
-        local_ids = frozenset(local_file_per_id.keys())
-        only_remote_refids = list(filter(
-                lambda refmid: refmid[1] not in local_ids,
-                remote_refids))
-        only_local = local_ids - remote_ids
-        common = remote_ids & local_ids
-        log_notice('found %d remote-only, %d local-only (delete? %s), %d common IDs' % (
-            len(only_remote_refids), len(only_local), purge_deleted, len(common)))
-
-        # log_notice('REMOTE IDS EXAMPLE: %s' % (sorted(list(remote_ids))[:10],))
-        # log_notice('LOCAL IDS EXAMPLE: %s' % (sorted(list(only_local))[:10],))
-    elif run_type == 'dry_sync':
-        sync(local_file_per_id, remote_refids,
-                hostname, username, password, imap_folder_name,
-                local_dirname, purge_deleted, True)
-    elif run_type == 'sync':
-        sync(local_file_per_id, remote_refids,
-                hostname, username, password, imap_folder_name,
-                local_dirname, purge_deleted, False)
+    global METRICS
+    METRICS = RunMetrics()
+    budget = imap_connection_budget()
+    worker_pool = Pool(MAX_LOCAL_WORKERS, local_worker_init)
+    try:
+        asyncio.run(sync_folder_scanning_locally(
+            run_type, hostname, username, password, imap_folder_name,
+            local_dirname, worker_pool, purge_deleted, budget))
+        METRICS.succeeded = True
+    finally:
+        worker_pool.terminate()
+        log_notice('imap: %s' % budget.summary())
+        write_metrics(hostname, username, imap_folder_name, budget)
+
+async def sync_folder_scanning_locally(run_type, hostname, username, password,
+        folder_name, local_dirname, worker_pool, purge_deleted, budget):
+    (local_scan,) = start_local_scans([local_dirname], worker_pool)
+    return await sync_folder(
+            run_type, hostname, username, password, folder_name,
+            local_dirname, local_scan, purge_deleted, budget)
+
+def write_metrics(hostname, username, folder_name, budget):
+    if METRICS_DIRNAME is None:
+        return
+    try:
+        METRICS.write(
+                [('hostname', hostname), ('username', username),
+                    ('folder', folder_name)],
+                budget)
+    except Exception as e:
+        log_error('couldn\'t write metrics: %s' % repr(e))
+
+def export_messages(local_dirname, target_dirname, is_maildir):
+    # every indexed message, packed or not, as an .eml file of its own
+    # (named as it would have been downloaded) or into a maildir's cur/;
+    # subdirectories (from syncing several folders) get exported into
+    # subdirectories of their own. Messages exported already are skipped.
+    exported_count = 0
+    for dirname in indexed_dirnames(local_dirname):
+        export_dirname = os.path.join(
+                target_dirname, os.path.relpath(dirname, local_dirname))
+        exported_count += export_folder_messages(
+                dirname, export_dirname, is_maildir)
+    log_notice('exported %d messages into %s' % (
+        exported_count, repr(target_dirname)))
+
+def indexed_dirnames(local_dirname):
+    # local_dirname and those of its subdirectories which have an index
+    # of their own (from syncing several folders), leaving shards out
+    for dirname, subdirnames, _filenames in os.walk(local_dirname):
+        subdirnames[:] = sorted(
+                subdirname for subdirname in subdirnames
+                if subdirname != SEGMENTS_DIRNAME and (
+                    not SHARD_DIRNAME_RE.match(subdirname) or
+                    os.path.exists(os.path.join(
+                        dirname, subdirname, INDEX_FILENAME))))
+        if os.path.exists(os.path.join(dirname, INDEX_FILENAME)):
+            yield dirname
+
+def export_folder_messages(local_dirname, target_dirname, is_maildir):
+    if is_maildir:
+        for subdirname in ('cur', 'new', 'tmp'):
+            os.makedirs(os.path.join(target_dirname, subdirname),
+                    exist_ok=True)
+    else:
+        os.makedirs(target_dirname, exist_ok=True)
+    if zstandard is None and any(
+            segment.endswith(u'.zst')
+            for _number, segment, _size in list_segments(local_dirname)):
+        raise Exception('the zstandard package is needed to export %s' %
+                repr(local_dirname))
+    db = open_index_db(local_dirname)
+    total_count = db.execute(
+            'SELECT COUNT(*) FROM local_messages').fetchone()[0]
+    log_progress = progress_logger('exported', total_count)
+    exported_count = 0
+    # packed messages in the order they were written
+    for (rowid, filename, mtime_ns, segment, offset,
+            length) in db.execute(
+                'SELECT rowid, filename, mtime_ns, segment, segment_offset,'
+                ' segment_length FROM local_messages'
+                ' ORDER BY segment, segment_offset'):
+        mtime = mtime_ns / 1e9
+        if is_maildir:
+            filepath = os.path.join(
+                    target_dirname, 'cur',
+                    u'%d.R%d.imap2dir:2,S' % (mtime, rowid))
+        else:
+            # sharded the same way
+            filepath = os.path.join(target_dirname, filename)
+        if os.path.exists(filepath):
+            continue
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        temp_filepath = local_message_filepath(
+                target_dirname, u'', None, None, is_temp=True)
+        try:
+            if segment is None:
+                with open(os.path.join(local_dirname, filename), 'rb') as (
+                        in_file), open(temp_filepath, 'wb') as out_file:
+                    shutil.copyfileobj(in_file, out_file, SEGMENT_COPY_SIZE)
+            else:
+                with open(temp_filepath, 'wb') as out_file:
+                    copy_packed_message(
+                            local_dirname, segment, offset, length, out_file)
+            os.utime(temp_filepath, (time.time(), mtime))
+            os.rename(temp_filepath, filepath)
+        except Exception:
+            log_error('failed to export %s: %s' % (
+                repr(filename), traceback.format_exc()))
+            if os.path.exists(temp_filepath):
+                os.remove(temp_filepath)
+            continue
+        exported_count += 1
+        log_progress(exported_count)
+    db.close()
+    log_info('exported %d messages out of %s' % (
+        exported_count, repr(local_dirname)))
+    return exported_count
+
+def migrate_messages(local_dirname, layout):
+    # moves the message files of every folder (see export_messages) into
+    # the given layout, e.g. those of a flat backup made before sharding,
+    # updating their index as it goes; packed messages stay put
+    if layout not in LAYOUTS:
+        raise Exception('unknown layout: %s' % layout)
+    global METRICS
+    METRICS = RunMetrics()
+    moved_count = 0
+    for dirname in indexed_dirnames(local_dirname):
+        moved_count += migrate_folder_messages(dirname, layout)
+    log_notice('moved %d messages into the \'%s\' layout' % (
+        moved_count, layout))
+
+def migrate_folder_messages(local_dirname, layout):
+    # whatever isn't indexed yet would otherwise be left behind
+    fetch_local_message_ids(local_dirname)
+    db = open_index_db(local_dirname)
+    local_messages = db.execute(
+            'SELECT rowid, filename, mtime_ns, message_id FROM local_messages'
+            ' WHERE segment IS NULL').fetchall()
+    log_progress = progress_logger('moved', len(local_messages))
+    moved_count = uncommitted_count = 0
+    left_dirnames = set()
+    for rowid, filename, mtime_ns, message_id in local_messages:
+        basename = os.path.basename(filename)
+        new_filename = os.path.join(
+                local_message_shard(
+                    layout, message_id, mtime_ns / 1e9, basename),
+                basename)
+        if new_filename == filename:
+            continue
+        new_filepath = os.path.join(local_dirname, new_filename)
+        if os.path.exists(new_filepath):
+            log_error('can\'t move %s: %s already exists' % (
+                repr(filename), repr(new_filename)))
+            continue
+        os.makedirs(os.path.dirname(new_filepath), exist_ok=True)
+        # were it interrupted in between, the next scan would index the
+        # file under its new name
+        os.rename(os.path.join(local_dirname, filename), new_filepath)
+        db.execute(
+                'UPDATE local_messages SET filename = ? WHERE rowid = ?',
+                (new_filename, rowid))
+        left_dirnames.add(os.path.dirname(filename))
+        moved_count += 1
+        uncommitted_count += 1
+        log_progress(moved_count)
+        if uncommitted_count >= LOCAL_COMMIT_FILES:
+            db.commit()
+            uncommitted_count = 0
+    db.commit()
+    db.close()
+
+    # shards emptied out, deepest first
+    for dirname in sorted(left_dirnames, reverse=True):
+        while dirname:
+            try:
+                os.rmdir(os.path.join(local_dirname, dirname))
+            except OSError:
+                break
+            dirname = os.path.dirname(dirname)
+    log_info('moved %d messages within %s' % (
+        moved_count, repr(local_dirname)))
+    return moved_count
+
+def is_folder_pattern(imap_folder_name):
+    return u'*' in imap_folder_name or u'%' in imap_folder_name
+
+def run_account(run_type, hostname, username, folder_pattern, local_dirname, purge_deleted):
+    # every folder matching the LIST pattern gets synced into its own
+    # subdirectory of local_dirname
+    if run_type not in ['dry', 'dry_sync', 'sync']:
+        raise Exception('unknown run type: %s' % run_type)
+    if LAYOUT not in LAYOUTS:
+        raise Exception('unknown layout: %s' % LAYOUT)
+    password = getpass.getpass('Password for "%s@%s": ' % (username, hostname))
+    global METRICS
+    METRICS = RunMetrics()
+    budget = imap_connection_budget()
+    try:
+        run_account_folders(
+                run_type, hostname, username, password, folder_pattern,
+                local_dirname, purge_deleted, budget)
+        METRICS.succeeded = True
+    finally:
+        log_notice('imap: %s' % budget.summary())
+        write_metrics(hostname, username, folder_pattern, budget)
+
+def run_account_folders(run_type, hostname, username, password,
+        folder_pattern, local_dirname, purge_deleted, budget):
+    folders = asyncio.run(list_imap_folders(
+        hostname, username, password, folder_pattern))
+    log_notice('found %d folders matching \'%s\' (%d messages)' % (
+        len(folders), folder_pattern,
+        sum(message_count for _name, _delimiter, message_count in folders)))
+
+    folder_dirnames = []
+    for folder_name, delimiter, _message_count in folders:
+        folder_dirname = local_folder_dirname(
+                local_dirname, folder_name, delimiter)
+        os.makedirs(folder_dirname, exist_ok=True)
+        folder_dirnames.append((folder_name, folder_dirname))
+
+    worker_pool = Pool(MAX_LOCAL_WORKERS, local_worker_init)
+    try:
+        totals = asyncio.run(sync_account(
+            run_type, hostname, username, password,
+            folder_dirnames, worker_pool, purge_deleted, budget))
+    finally:
+        worker_pool.terminate()
+    log_notice('account totals over %d folders: %s' % (
+        len(folders), ', '.join(
+            '%d %s' % (count, name)
+            for name, count in zip(ACCOUNT_COUNTS, totals))))
+    failed_count = totals[ACCOUNT_COUNTS.index('failed')]
+    if failed_count > 0:
+        raise SyncError('%d of %d folders failed' % (
+            failed_count, len(folders)))
 
 if __name__ == '__main__':
     # Dry run:
@@ -470,8 +2516,34 @@ if __name__ == '__main__':
     #   ./imap2dir.py sync imap.gmail.com \
     #       user@gmail.com '[Gmail]/All Mail' ~/email_backup/
     #
-    run(
-        *(sys.argv[1:6]
+    # Sync every folder (LIST pattern) into its own subdirectory:
+    #   ./imap2dir.py sync imap.gmail.com \
+    #       user@gmail.com '*' ~/email_backup/
+    #
+    # Export (packed messages included) as .eml files, or as a maildir:
+    #   ./imap2dir.py export ~/email_backup/ ~/email_export/ [maildir]
+    #
+    # Move the files of a backup into another layout (flat, date or hash):
+    #   ./imap2dir.py migrate ~/email_backup/ date
+    #
+    args = (sys.argv[1:6]
           + [False] #[(bool(sys.argv[6]) if len(sys.argv) >= 7 else False)]
-        )
-    )
+          )
+    try:
+        if args[0] == 'export':
+            export_messages(args[1], args[2], sys.argv[4:5] == ['maildir'])
+        elif args[0] == 'migrate':
+            migrate_messages(args[1], args[2])
+        elif is_folder_pattern(args[3]):
+            run_account(*args)
+        else:
+            run(*args)
+    except SyncError as e:
+        # logged already; so are the metrics, if asked for
+        log_error('giving up: %s' % e)
+        sys.exit(-1)
+    except KeyboardInterrupt:
+        # whatever got transferred (or indexed) so far was committed
+        # as it went, so the next run picks up from there
+        log_notice('interrupted')
+        sys.exit(-1)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Benchmark scenarios for imap2dir and maildir2imap, run against the
+local stand-in server (`fakeimap.py`) with synthetic messages
+(`genmail.py`).
+
+Every scenario starts a server of its own and runs one or more steps
+against it, one after the other, e.g. a first sync followed by one
+with nothing left to do. Each step runs the tool as it would be run
+from the command line and with its metrics enabled; what it reports
+for every phase (see the tools' READMEs) is what ends up in the
+results: seconds, messages/s, MiB/s and peak RSS, along with how many
+bytes went over the wire (both ways) against how many there were
+before compression.
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import genmail
+
+BENCH_DIRNAME = os.path.dirname(os.path.abspath(__file__))
+FAKEIMAP_FILEPATH = os.path.join(BENCH_DIRNAME, 'fakeimap.py')
+IMAP2DIR_FILEPATH = os.path.join(
+        os.path.dirname(BENCH_DIRNAME), 'imap2dir', 'imap2dir.py')
+MAILDIR2IMAP_FILEPATH = os.path.join(
+        os.path.dirname(BENCH_DIRNAME), 'maildir2imap', 'maildir2imap.py')
+USERNAME = 'bench'
+PASSWORD = 'bench'
+FOLDER_NAME = 'INBOX'
+THROTTLE_EVERY = 25
+BYE_EVERY = 101
+
+# name: (description, whether the server folder starts out populated
+# (rather than the local maildir), extra server arguments, extra
+# environment for the tools, steps); each step being (name, tool, run
+# type, index file or directory to remove beforehand, relative to the
+# working directory, which is also the tools' HOME)
+SCENARIOS = {
+        'imap2dir': (
+            'download a folder, then sync it again and reindex it',
+            True, [], {}, [
+                ('first sync', 'imap2dir', 'sync', None),
+                ('resync', 'imap2dir', 'sync', None),
+                ('reindex', 'imap2dir', 'dry',
+                    os.path.join('backup', '.imap2dir.sqlite')),
+                ]),
+        'imap2dir-gmail': (
+            'the same as imap2dir, going by X-GM-MSGID',
+            True, [], {'IMAP2DIR_GMAIL': '1'}, [
+                ('first sync', 'imap2dir', 'sync', None),
+                ('resync', 'imap2dir', 'sync', None),
+                ('reindex', 'imap2dir', 'dry',
+                    os.path.join('backup', '.imap2dir.sqlite')),
+                ]),
+        'imap2dir-packed': (
+            'the same as imap2dir, into packed storage',
+            True, [], {'IMAP2DIR_STORAGE': 'packed'}, [
+                ('first sync', 'imap2dir', 'sync', None),
+                ('resync', 'imap2dir', 'sync', None),
+                ('reindex', 'imap2dir', 'dry',
+                    os.path.join('backup', '.imap2dir.sqlite')),
+                ]),
+        'imap2dir-throttled': (
+            'download a folder from a server that throttles and hangs up',
+            True, ['--throttle-every', str(THROTTLE_EVERY),
+                '--bye-every', str(BYE_EVERY)], {}, [
+                ('first sync', 'imap2dir', 'sync', None),
+                ]),
+        'maildir2imap': (
+            'upload a maildir, then sync it again and reindex it',
+            False, [], {}, [
+                ('first sync', 'maildir2imap', 'sync', None),
+                ('resync', 'maildir2imap', 'sync', None),
+                ('reindex', 'maildir2imap', 'dry',
+                    os.path.join('.cache', 'maildir2imap', 'local')),
+                ]),
+        'maildir2imap-throttled': (
+            'upload a maildir to a server that throttles and hangs up',
+            False, ['--throttle-every', str(THROTTLE_EVERY),
+                '--bye-every', str(BYE_EVERY)], {}, [
+                ('first sync', 'maildir2imap', 'sync', None),
+                ]),
+        }
+SCENARIO_ORDER = [
+        'imap2dir', 'imap2dir-gmail', 'imap2dir-packed', 'imap2dir-throttled',
+        'maildir2imap', 'maildir2imap-throttled']
+PHASES = ('local_scan', 'remote_scan', 'transfer')
+
+
+def log(message):
+    sys.stderr.write('[%s]: %s\n' % (time.strftime('%H:%M:%S'), message))
+
+
+def generate_certificate(dirname):
+    # self-signed, for 127.0.0.1 only; it's what the clients are told
+    # to trust (through SSL_CERT_FILE)
+    certfile = os.path.join(dirname, 'cert.pem')
+    keyfile = os.path.join(dirname, 'key.pem')
+    subprocess.run(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                '-days', '2', '-subj', '/CN=127.0.0.1',
+                '-addext', 'subjectAltName=IP:127.0.0.1',
+                '-keyout', keyfile, '-out', certfile],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (certfile, keyfile)
+
+
+def start_server(args, certfile, keyfile, message_count, extra_args):
+    # returns (process, address)
+    command = [args.python3, FAKEIMAP_FILEPATH, certfile, keyfile,
+            '--port', '0', '--seed', str(args.seed),
+            '--folder', '%s=%d' % (FOLDER_NAME, message_count),
+            '--latency', str(args.latency)]
+    if args.bandwidth:
+        command.extend(['--bandwidth', str(args.bandwidth)])
+    server = subprocess.Popen(
+            command + extra_args, stdout=subprocess.PIPE, text=True,
+            cwd=BENCH_DIRNAME)
+    address = server.stdout.readline().strip()
+    if not address:
+        raise Exception('the server didn\'t start')
+    return (server, address)
+
+
+def stop_server(server):
+    # returns its stats
+    server.send_signal(signal.SIGTERM)
+    stats_line = server.stdout.read().strip()
+    server.wait()
+    return json.loads(stats_line) if stats_line else {}
+
+
+def run_step(args, workdir, certfile, address, tool, run_type, extra_env):
+    # returns (seconds, metrics summary, exit code)
+    metrics_dirname = tempfile.mkdtemp(dir=workdir, prefix='metrics-')
+    env = dict(os.environ, SSL_CERT_FILE=certfile, HOME=workdir, **extra_env)
+    if tool == 'imap2dir':
+        command = [args.python3, IMAP2DIR_FILEPATH, run_type, address,
+                USERNAME, FOLDER_NAME, os.path.join(workdir, 'backup')]
+        env['IMAP2DIR_METRICS_DIR'] = metrics_dirname
+        env['IMAP2DIR_COMPRESS'] = '0' if args.no_compress else '1'
+    else:
+        command = [args.python2, MAILDIR2IMAP_FILEPATH, run_type, address,
+                USERNAME, PASSWORD, FOLDER_NAME,
+                os.path.join(workdir, 'maildir')]
+        env['MAILDIR2IMAP_METRICS_DIR'] = metrics_dirname
+        env['MAILDIR2IMAP_COMPRESS'] = '0' if args.no_compress else '1'
+    started = time.monotonic()
+    with open(os.path.join(workdir, tool + '.log'), 'a') as log_file:
+        # with no terminal of its own, imap2dir reads its password
+        # from stdin
+        process = subprocess.run(
+                command, input=PASSWORD + '\n', text=True, env=env,
+                stdout=log_file, stderr=log_file, start_new_session=True)
+    seconds = time.monotonic() - started
+    summary = None
+    for filepath in glob.glob(os.path.join(metrics_dirname, '*.json')):
+        with open(filepath) as metrics_file:
+            summary = json.load(metrics_file)
+    return (seconds, summary, process.returncode)
+
+
+def phase_totals(tool, summary, phase):
+    # (messages, bytes) dealt with by the phase; None if unknown
+    counters = summary['counters']
+    if phase == 'local_scan':
+        return (counters.get('local_files_parsed', 0),
+                counters.get('local_bytes_parsed', 0))
+    if phase == 'remote_scan':
+        return (counters.get('remote_ids_fetched', 0), None)
+    if tool == 'imap2dir':
+        return (counters.get('messages_downloaded', 0),
+                counters.get('downloaded_bytes', 0))
+    return (counters.get('messages_appended', 0),
+            summary['imap'].get('bytes_appended', 0))
+
+
+def step_results(tool, seconds, summary):
+    # a row per phase, and one for the whole step
+    rows = []
+    for phase in PHASES:
+        if phase not in summary['phase_seconds']:
+            continue
+        phase_seconds = summary['phase_seconds'][phase]
+        messages, size = phase_totals(tool, summary, phase)
+        rows.append({
+            'phase': phase,
+            'seconds': phase_seconds,
+            'messages': messages,
+            'bytes': size,
+            'messages_per_second': messages / max(phase_seconds, 1e-6),
+            'bytes_per_second': None if size is None else (
+                size / max(phase_seconds, 1e-6)),
+            'max_rss_bytes': summary['phase_max_rss_bytes'].get(phase),
+            })
+    imap_stats = summary['imap']
+    rows.append({
+        'phase': 'total',
+        'seconds': seconds,
+        'max_rss_bytes': max(
+            summary['phase_max_rss_bytes'].values(), default=None),
+        'imap_commands': imap_stats['commands'],
+        'imap_retries': imap_stats['retries'],
+        'imap_reconnects': imap_stats['reconnects'],
+        'wire_bytes': imap_stats['bytes_sent'] + imap_stats['bytes_received'],
+        'uncompressed_bytes': (imap_stats['uncompressed_bytes_sent']
+            + imap_stats['uncompressed_bytes_received']),
+        })
+    return rows
+
+
+def run_scenario(args, name):
+    (description, is_remote_populated, server_args, extra_env,
+            steps) = SCENARIOS[name]
+    workdir = tempfile.mkdtemp(prefix='imapbench-%s-' % name)
+    log('%s: %s (in %s)' % (name, description, workdir))
+    certfile, keyfile = generate_certificate(workdir)
+    os.makedirs(os.path.join(workdir, 'backup'))
+    if not is_remote_populated:
+        size = genmail.write_maildir(
+                os.path.join(workdir, 'maildir'), args.messages, args.seed)
+        log('%s: generated %d messages (%.1f MiB)' % (
+            name, args.messages, size / 1024 / 1024))
+    server, address = start_server(
+            args, certfile, keyfile,
+            args.messages if is_remote_populated else 0, server_args)
+    log('%s: server listening on %s' % (name, address))
+
+    results = []
+    try:
+        for step_name, tool, run_type, index_path in steps:
+            if index_path is not None:
+                index_path = os.path.join(workdir, index_path)
+                if os.path.isdir(index_path):
+                    shutil.rmtree(index_path)
+                elif os.path.exists(index_path):
+                    os.remove(index_path)
+            seconds, summary, exit_code = run_step(
+                    args, workdir, certfile, address, tool, run_type,
+                    extra_env)
+            if exit_code != 0 or summary is None or not summary['succeeded']:
+                log('%s: %s failed (exit code %s); see %s' % (
+                    name, step_name, exit_code,
+                    os.path.join(workdir, tool + '.log')))
+                results.append({'step': step_name, 'failed': True})
+                break
+            log('%s: %s took %.1fs' % (name, step_name, seconds))
+            results.append({
+                'step': step_name,
+                'failed': False,
+                'phases': step_results(tool, seconds, summary),
+                })
+    finally:
+        server_stats = stop_server(server)
+        if not args.keep:
+            shutil.rmtree(workdir)
+    return {
+            'scenario': name,
+            'messages': args.messages,
+            'latency': args.latency,
+            'compress': not args.no_compress,
+            'steps': results,
+            'server': server_stats,
+            }
+
+
+def format_rate(value, scale=1):
+    return '-' if value is None else '%.1f' % (value / scale)
+
+
+def print_results(all_results):
+    # wire and IMAP (i.e. uncompressed) MiB are for the whole step
+    print('%-24s %-11s %-12s %9s %9s %9s %9s %9s %9s' % (
+        'scenario', 'step', 'phase', 'seconds', 'msgs/s', 'MiB/s',
+        'RSS MiB', 'wire MiB', 'IMAP MiB'))
+    for results in all_results:
+        for step in results['steps']:
+            if step['failed']:
+                print('%-24s %-11s %s' % (
+                    results['scenario'], step['step'], 'FAILED'))
+                continue
+            for row in step['phases']:
+                print('%-24s %-11s %-12s %9.2f %9s %9s %9s %9s %9s' % (
+                    results['scenario'], step['step'], row['phase'],
+                    row['seconds'],
+                    format_rate(row.get('messages_per_second')),
+                    format_rate(row.get('bytes_per_second'), 1024 * 1024),
+                    format_rate(row['max_rss_bytes'], 1024 * 1024),
+                    format_rate(row.get('wire_bytes'), 1024 * 1024),
+                    format_rate(row.get('uncompressed_bytes'), 1024 * 1024)))
+
+
+if __name__ == '__main__':
+    # Every scenario, with 5000 messages 20ms away:
+    #   ./bench.py --messages 5000 --latency 0.02
+    #
+    # Just some, keeping the results:
+    #   ./bench.py --json results.json imap2dir maildir2imap
+    #
+    parser = argparse.ArgumentParser(
+            description='Benchmarks for imap2dir and maildir2imap.')
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+            help='any of: %s (defaults to all of them)' % ', '.join(
+                SCENARIO_ORDER))
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.02,
+            help='seconds by which the server holds back every response')
+    parser.add_argument('--bandwidth', type=float,
+            help='bytes per second the server sends, per connection')
+    parser.add_argument('--no-compress', action='store_true',
+            help='have the tools leave COMPRESS=DEFLATE off')
+    parser.add_argument('--python3', default=sys.executable,
+            help='interpreter for imap2dir (and the server)')
+    parser.add_argument('--python2', default='python2',
+            help='interpreter for maildir2imap')
+    parser.add_argument('--json', help='where to write the results')
+    parser.add_argument('--keep', action='store_true',
+            help='keep the working directories around')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario: %s' % name)
+
+    all_results = [
+            run_scenario(args, name)
+            for name in (args.scenarios or SCENARIO_ORDER)]
+    print_results(all_results)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(all_results, json_file, indent=2)
@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for an IMAPS server, for benchmarking imap2dir and
+maildir2imap without going anywhere near a real account.
+
+It keeps its folders in memory (populated with synthetic messages, see
+`genmail.py`) and implements just as much of IMAP4rev1 as the two tools
+use: LOGIN, LIST, STATUS, SELECT/EXAMINE, SEARCH, FETCH, APPEND (with
+MULTIAPPEND, LITERAL+ and UIDPLUS) along with CONDSTORE, QRESYNC,
+COMPRESS=DEFLATE and Gmail's X-GM-MSGID and X-GM-THRID (out of a hash
+of each message; every message is a thread of its own). Any login is
+accepted.
+
+Responses are held back by `latency` seconds (without holding up the
+commands pipelined behind them), which is what a distant server looks
+like; `bandwidth` caps how fast each connection gets them. Servers
+that throttle clients can be imitated as well: every `throttle_every`
+commands one is answered with `NO [THROTTLED]`, and every `bye_every`
+commands the connection gets dropped with a `BYE`.
+"""
+import argparse
+import asyncio
+import email.utils
+import hashlib
+import json
+import random
+import re
+import signal
+import ssl
+import sys
+import time
+import zlib
+
+import genmail
+
+CAPABILITIES = (b'IMAP4rev1 ENABLE CONDSTORE QRESYNC UIDPLUS MULTIAPPEND'
+        b' LITERAL+ COMPRESS=DEFLATE X-GM-EXT-1')
+UNTHROTTLED_COMMANDS = frozenset([b'CAPABILITY', b'LOGIN', b'LOGOUT'])
+LITERAL_RE = re.compile(rb'\{(\d+)(\+?)\}$')
+ATOM_RE = re.compile(rb'[^\s()"{}\[\]]+(?:\[[^\]]*\](?:<[\d.]+>)?)?')
+HEADER_FIELDS_RE = re.compile(
+        rb'^BODY(?:\.PEEK)?\[HEADER\.FIELDS \(([^)]*)\)\]$')
+MAX_LINE_LENGTH = 1024 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+# queued after COMPRESS's OK, for what follows to be deflated
+START_COMPRESSION = object()
+
+
+class Literal(bytes):
+    pass
+
+
+class Message:
+    def __init__(self, uid, content, internaldate, modseq):
+        self.uid = uid
+        self.content = content
+        self.internaldate = internaldate
+        self.modseq = modseq
+        # the same for the same message in every folder, as in Gmail
+        self.gm_msgid = int.from_bytes(
+                hashlib.blake2b(content, digest_size=8).digest(), 'big') >> 1
+
+
+class Folder:
+    def __init__(self, name, uidvalidity):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.messages = []
+        self.uidnext = 1
+        self.highestmodseq = 1
+
+    def append(self, content, internaldate=None):
+        self.highestmodseq += 1
+        message = Message(
+                self.uidnext, content, internaldate or time.time(),
+                self.highestmodseq)
+        self.uidnext += 1
+        self.messages.append(message)
+        return message
+
+
+def parse_sequence_set(value, maximum):
+    # (first, last) ranges; '*' stands for the maximum
+    ranges = []
+    for part in value.split(b','):
+        first, _, last = part.partition(b':')
+        first = maximum if first == b'*' else int(first)
+        last = first if not last else (maximum if last == b'*' else int(last))
+        ranges.append((min(first, last), max(first, last)))
+    return ranges
+
+
+def in_sequence_set(number, ranges):
+    return any(first <= number <= last for first, last in ranges)
+
+
+def tokenize(data, literals):
+    # nested lists of byte strings; literals had been replaced with
+    # \0<index>\0 placeholders, which are swapped back in here
+    position = 0
+    stack = [[]]
+    while position < len(data):
+        char = data[position:position + 1]
+        if char == b' ':
+            position += 1
+        elif char == b'(':
+            stack.append([])
+            position += 1
+        elif char == b')':
+            tokens = stack.pop()
+            stack[-1].append(tokens)
+            position += 1
+        elif char == b'"':
+            value = bytearray()
+            position += 1
+            while data[position:position + 1] != b'"':
+                if data[position:position + 1] == b'\\':
+                    position += 1
+                value += data[position:position + 1]
+                position += 1
+            stack[-1].append(bytes(value))
+            position += 1
+        elif char == b'\0':
+            end = data.index(b'\0', position + 1)
+            stack[-1].append(Literal(literals[int(data[position + 1:end])]))
+            position = end + 1
+        else:
+            match = ATOM_RE.match(data, position)
+            stack[-1].append(match.group(0))
+            position = match.end()
+    return stack[0]
+
+
+def quoted(value):
+    return b'"' + value.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+
+
+def header_fields(content, field_names):
+    end = content.find(b'\r\n\r\n')
+    header_block = content if end < 0 else content[:end + 2]
+    lines = []
+    is_wanted = False
+    for line in header_block.splitlines(True):
+        if line[:1] not in (b' ', b'\t'):
+            is_wanted = line.split(b':', 1)[0].strip().upper() in field_names
+        if is_wanted:
+            lines.append(line)
+    return b''.join(lines) + b'\r\n'
+
+
+def internaldate(timestamp):
+    return time.strftime(
+            '%d-%b-%Y %H:%M:%S +0000', time.gmtime(timestamp)).encode('ascii')
+
+
+class Session:
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.folder = None
+        self.outgoing = asyncio.Queue()
+        self.compressor = None
+        self.inflater = None
+
+    def send(self, data):
+        # delivered `latency` seconds from now, in order
+        self.outgoing.put_nowait(
+                (time.monotonic() + self.server.latency, data))
+
+    async def deliver(self):
+        while True:
+            due, data = await self.outgoing.get()
+            if data is None:
+                break
+            if data is START_COMPRESSION:
+                self.compressor = zlib.compressobj(
+                        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                        -zlib.MAX_WBITS)
+                continue
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.server.stats['bytes_sent'] += len(data)
+            if self.compressor is not None:
+                data = (self.compressor.compress(data)
+                        + self.compressor.flush(zlib.Z_SYNC_FLUSH))
+                self.server.stats['compressed_bytes_sent'] += len(data)
+            self.writer.write(data)
+            await self.writer.drain()
+            if self.server.bandwidth:
+                await asyncio.sleep(len(data) / self.server.bandwidth)
+
+    async def run(self):
+        stats = self.server.stats
+        stats['connections'] += 1
+        stats['open_connections'] += 1
+        stats['max_open_connections'] = max(
+                stats['max_open_connections'], stats['open_connections'])
+        deliverer = asyncio.ensure_future(self.deliver())
+        try:
+            self.send(b'* OK [CAPABILITY ' + CAPABILITIES + b'] ready\r\n')
+            while await self.read_and_handle_command():
+                pass
+        except (OSError, asyncio.IncompleteReadError):
+            deliverer.cancel()
+        finally:
+            stats['open_connections'] -= 1
+            self.outgoing.put_nowait((0, None))
+            try:
+                await deliverer
+            except (OSError, asyncio.CancelledError):
+                pass
+            if self.inflater is not None:
+                self.inflater.cancel()
+            self.writer.close()
+
+    async def read_and_handle_command(self):
+        line = await self.reader.readuntil(b'\r\n')
+        self.server.stats['bytes_received'] += len(line)
+        line = line[:-2]
+        literals = []
+        while True:
+            match = LITERAL_RE.search(line)
+            if match is None:
+                break
+            if not match.group(2):
+                self.send(b'+ go ahead\r\n')
+            literal = await self.reader.readexactly(int(match.group(1)))
+            rest = await self.reader.readuntil(b'\r\n')
+            self.server.stats['bytes_received'] += len(literal) + len(rest)
+            line = (line[:match.start()]
+                    + b'\0%d\0' % len(literals) + rest[:-2])
+            literals.append(literal)
+        return self.handle_command(line, literals)
+
+    def handle_command(self, line, literals):
+        # whether to go on with the next command
+        tag, _, line = line.partition(b' ')
+        command, _, arguments = line.partition(b' ')
+        command = command.upper()
+        stats = self.server.stats
+        stats['commands'] += 1
+        if command not in UNTHROTTLED_COMMANDS:
+            if (self.server.throttle_every
+                    and stats['commands'] % self.server.throttle_every == 0):
+                stats['throttled'] += 1
+                self.send(tag + b' NO [THROTTLED] slow down\r\n')
+                return True
+            if (self.server.bye_every
+                    and stats['commands'] % self.server.bye_every == 0):
+                stats['byes'] += 1
+                self.send(b'* BYE [UNAVAILABLE] come back later\r\n')
+                return False
+        is_uid = command == b'UID'
+        if is_uid:
+            command, _, arguments = arguments.partition(b' ')
+            command = command.upper()
+        handler = getattr(
+                self, 'command_' + str(command, 'ascii', 'replace').lower(),
+                None)
+        if handler is None:
+            self.send(tag + b' BAD unknown command\r\n')
+            return True
+        try:
+            return handler(tag, tokenize(arguments, literals), is_uid)
+        except Exception as e:
+            self.send(tag + b' BAD %s\r\n' % repr(e).encode('utf-8'))
+            return True
+
+    def command_capability(self, tag, arguments, is_uid):
+        self.send(b'* CAPABILITY ' + CAPABILITIES + b'\r\n'
+                + tag + b' OK done\r\n')
+        return True
+
+    def command_noop(self, tag, arguments, is_uid):
+        self.send(tag + b' OK done\r\n')
+        return True
+
+    def command_login(self, tag, arguments, is_uid):
+        self.server.stats['logins'] += 1
+        self.send(tag + b' OK logged in\r\n')
+        return True
+
+    def command_logout(self, tag, arguments, is_uid):
+        self.send(b'* BYE logging out\r\n' + tag + b' OK done\r\n')
+        return False
+
+    def command_compress(self, tag, arguments, is_uid):
+        if self.inflater is not None:
+            self.send(tag + b' NO [COMPRESSIONACTIVE] already\r\n')
+            return True
+        if [argument.upper() for argument in arguments] != [b'DEFLATE']:
+            self.send(tag + b' BAD unknown algorithm\r\n')
+            return True
+        self.send(tag + b' OK deflating from now on\r\n')
+        self.outgoing.put_nowait((0, START_COMPRESSION))
+        # clients aren't to send anything else until they get the OK
+        raw_reader = self.reader
+        self.reader = asyncio.StreamReader(limit=MAX_LINE_LENGTH)
+        self.inflater = asyncio.ensure_future(
+                self.inflate(raw_reader, self.reader))
+        return True
+
+    async def inflate(self, raw_reader, reader):
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        try:
+            while True:
+                data = await raw_reader.read(READ_CHUNK_SIZE)
+                if not data:
+                    break
+                self.server.stats['compressed_bytes_received'] += len(data)
+                reader.feed_data(decompressor.decompress(data))
+        except OSError:
+            pass
+        finally:
+            reader.feed_eof()
+
+    def command_enable(self, tag, arguments, is_uid):
+        self.send(b'* ENABLED ' + b' '.join(arguments) + b'\r\n'
+                + tag + b' OK done\r\n')
+        return True
+
+    def command_list(self, tag, arguments, is_uid):
+        for name in sorted(self.server.folders):
+            self.send(b'* LIST (\\HasNoChildren) "/" '
+                    + quoted(name.encode('utf-8')) + b'\r\n')
+        self.send(tag + b' OK done\r\n')
+        return True
+
+    def command_status(self, tag, arguments, is_uid):
+        folder = self.server.folders[str(arguments[0], 'utf-8')]
+        self.send(b'* STATUS ' + quoted(arguments[0])
+                + b' (MESSAGES %d UIDNEXT %d UIDVALIDITY %d)\r\n' % (
+                    len(folder.messages), folder.uidnext, folder.uidvalidity)
+                + tag + b' OK done\r\n')
+        return True
+
+    def command_select(self, tag, arguments, is_uid, readonly=False):
+        folder = self.server.folders.get(str(arguments[0], 'utf-8'))
+        if folder is None:
+            self.send(tag + b' NO no such folder\r\n')
+            return True
+        self.folder = folder
+        self.send(b'* %d EXISTS\r\n* 0 RECENT\r\n' % len(folder.messages)
+                + b'* OK [UIDVALIDITY %d] ok\r\n' % folder.uidvalidity
+                + b'* OK [UIDNEXT %d] ok\r\n' % folder.uidnext
+                + b'* OK [HIGHESTMODSEQ %d] ok\r\n' % folder.highestmodseq
+                + tag + (b' OK [READ-ONLY] done\r\n' if readonly
+                    else b' OK [READ-WRITE] done\r\n'))
+        return True
+
+    def command_examine(self, tag, arguments, is_uid):
+        return self.command_select(tag, arguments, is_uid, readonly=True)
+
+    def command_close(self, tag, arguments, is_uid):
+        self.folder = None
+        self.send(tag + b' OK done\r\n')
+        return True
+
+    def command_search(self, tag, arguments, is_uid):
+        numbered = list(enumerate(self.folder.messages, 1))
+        if len(arguments) >= 2 and arguments[0].upper() == b'UID':
+            ranges = parse_sequence_set(
+                    arguments[1], numbered[-1][1].uid if numbered else 0)
+            numbered = [(number, message) for number, message in numbered
+                    if in_sequence_set(message.uid, ranges)]
+        self.send(b'* SEARCH' + b''.join(
+                    b' %d' % (message.uid if is_uid else number)
+                    for number, message in numbered)
+                + b'\r\n' + tag + b' OK done\r\n')
+        return True
+
+    def command_fetch(self, tag, arguments, is_uid):
+        messages = self.folder.messages
+        items = arguments[1] if isinstance(arguments[1], list) else [
+                arguments[1]]
+        modifiers = arguments[2] if len(arguments) > 2 else []
+        changed_since = None
+        if b'CHANGEDSINCE' in modifiers:
+            changed_since = int(
+                    modifiers[modifiers.index(b'CHANGEDSINCE') + 1])
+        maximum = (messages[-1].uid if is_uid else len(messages)) if (
+                messages) else 0
+        ranges = parse_sequence_set(arguments[0], maximum)
+        for number, message in enumerate(messages, 1):
+            if not in_sequence_set(message.uid if is_uid else number, ranges):
+                continue
+            if changed_since is not None and message.modseq <= changed_since:
+                continue
+            attributes = [b'UID %d' % message.uid] if is_uid else []
+            for item in items:
+                attributes.extend(self.fetch_attribute(item.upper(), message))
+            self.send(b'* %d FETCH (' % number + b' '.join(attributes)
+                    + b')\r\n')
+        self.send(tag + b' OK done\r\n')
+        return True
+
+    def fetch_attribute(self, item, message):
+        if item == b'UID':
+            return [b'UID %d' % message.uid]
+        if item in (b'RFC822', b'BODY[]', b'BODY.PEEK[]'):
+            name = b'RFC822' if item == b'RFC822' else b'BODY[]'
+            return [name + b' {%d}\r\n' % len(message.content)
+                    + message.content]
+        if item == b'RFC822.SIZE':
+            return [b'RFC822.SIZE %d' % len(message.content)]
+        if item == b'INTERNALDATE':
+            return [b'INTERNALDATE "%s"' % internaldate(message.internaldate)]
+        if item == b'FLAGS':
+            return [b'FLAGS (\\Seen)']
+        if item == b'MODSEQ':
+            return [b'MODSEQ (%d)' % message.modseq]
+        if item in (b'X-GM-MSGID', b'X-GM-THRID'):
+            return [item + b' %d' % message.gm_msgid]
+        match = HEADER_FIELDS_RE.match(item)
+        if match is not None:
+            data = header_fields(message.content, set(match.group(1).split()))
+            return [b'BODY[HEADER.FIELDS (%s)] {%d}\r\n' % (
+                match.group(1), len(data)) + data]
+        return []
+
+    def command_append(self, tag, arguments, is_uid):
+        folder = self.server.folders.get(str(arguments[0], 'utf-8'))
+        if folder is None:
+            self.send(tag + b' NO [TRYCREATE] no such folder\r\n')
+            return True
+        # flags and dates come before each message (as a literal)
+        uids = []
+        timestamp = None
+        for argument in arguments[1:]:
+            if isinstance(argument, list):
+                continue
+            if isinstance(argument, Literal):
+                uids.append(folder.append(bytes(argument), timestamp).uid)
+                timestamp = None
+            else:
+                parsed = email.utils.parsedate_tz(
+                        str(argument, 'ascii', 'replace'))
+                timestamp = parsed and email.utils.mktime_tz(parsed)
+        self.server.stats['appended'] += len(uids)
+        self.send(tag + b' OK [APPENDUID %d %s] done\r\n' % (
+            folder.uidvalidity, b','.join(b'%d' % uid for uid in uids)))
+        return True
+
+    def command_expunge(self, tag, arguments, is_uid):
+        self.send(tag + b' OK done\r\n')
+        return True
+
+
+class Server:
+    def __init__(self, latency=0.0, bandwidth=None, throttle_every=0,
+            bye_every=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.throttle_every = throttle_every
+        self.bye_every = bye_every
+        self.folders = {}
+        self.stats = dict.fromkeys([
+            'connections', 'open_connections', 'max_open_connections',
+            'logins', 'commands', 'throttled', 'byes', 'appended',
+            'bytes_received', 'bytes_sent', 'compressed_bytes_received',
+            'compressed_bytes_sent'], 0)
+
+    def add_folder(self, name, message_count=0, seed=0):
+        folder = Folder(
+                name, uidvalidity=random.Random(name).randint(1, 2 ** 31))
+        for content, timestamp in genmail.generate_messages(
+                message_count, '%s/%s' % (seed, name)):
+            folder.append(content.replace(b'\n', b'\r\n'), timestamp)
+        self.folders[name] = folder
+        return folder
+
+    async def serve(self, host, port, certfile, keyfile):
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(certfile, keyfile)
+
+        async def on_connection(reader, writer):
+            await Session(self, reader, writer).run()
+
+        return await asyncio.start_server(
+                on_connection, host, port, ssl=ssl_context,
+                limit=MAX_LINE_LENGTH)
+
+
+async def main(args):
+    server = Server(
+            latency=args.latency, bandwidth=args.bandwidth,
+            throttle_every=args.throttle_every, bye_every=args.bye_every)
+    for folder in args.folder or ['INBOX=0']:
+        name, _, message_count = folder.rpartition('=')
+        server.add_folder(name, int(message_count), args.seed)
+    listener = await server.serve(
+            args.host, args.port, args.certfile, args.keyfile)
+    host, port = listener.sockets[0].getsockname()[:2]
+    # the first line out is where we're listening; whoever started us
+    # may be waiting for it
+    print('%s:%d' % (host, port), flush=True)
+
+    stopped = asyncio.get_running_loop().create_future()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(
+                signum, lambda: stopped.done() or stopped.set_result(None))
+    await stopped
+    listener.close()
+    # and the last line is how it went
+    print(json.dumps(server.stats), flush=True)
+
+
+if __name__ == '__main__':
+    # A folder with 10000 messages, 50ms away:
+    #   ./fakeimap.py cert.pem key.pem --folder INBOX=10000 --latency 0.05
+    #
+    # Then, e.g.:
+    #   SSL_CERT_FILE=cert.pem ../imap2dir/imap2dir.py sync \
+    #       127.0.0.1:9993 user INBOX ~/bench_backup/
+    #
+    # (the certificate must be valid for 127.0.0.1; see bench.py)
+    parser = argparse.ArgumentParser(
+            description='Local stand-in IMAPS server for benchmarking.')
+    parser.add_argument('certfile')
+    parser.add_argument('keyfile')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9993,
+            help='0 picks any free port')
+    parser.add_argument('--folder', action='append',
+            help='NAME=MESSAGE_COUNT (repeatable; defaults to an empty INBOX)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0,
+            help='seconds by which every response is held back')
+    parser.add_argument('--bandwidth', type=float,
+            help='bytes per second, per connection')
+    parser.add_argument('--throttle-every', type=int, default=0,
+            help='answer every Nth command with NO [THROTTLED]')
+    parser.add_argument('--bye-every', type=int, default=0,
+            help='drop the connection on every Nth command')
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        sys.exit(-1)
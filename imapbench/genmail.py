@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Synthetic email for benchmarking, generated deterministically out of
+a seed: the same seed always gives the same messages.
+
+Message sizes follow a log-normal distribution (most messages are a
+few KiB of text; a tail of them carry attachments of up to several
+MiB), which is roughly what real mailboxes look like. A few messages
+come without a Message-ID, and a few more repeat an earlier one, as
+both happen in the wild.
+"""
+import email.base64mime
+import email.utils
+import os
+import random
+import sys
+import time
+
+MEDIAN_BODY_SIZE = 3 * 1024
+BODY_SIZE_SIGMA = 1.0
+MAX_BODY_SIZE = 1024 * 1024
+ATTACHMENT_RATE = 0.08
+MEDIAN_ATTACHMENT_SIZE = 150 * 1024
+ATTACHMENT_SIZE_SIGMA = 1.2
+MAX_ATTACHMENT_SIZE = 20 * 1024 * 1024
+MISSING_MESSAGE_ID_RATE = 0.005
+REPEATED_MESSAGE_ID_RATE = 0.005
+FIRST_DATE = time.mktime((2005, 1, 1, 0, 0, 0, 0, 0, -1))
+LAST_DATE = time.mktime((2024, 1, 1, 0, 0, 0, 0, 0, -1))
+WORDS = (
+        'the of and to in is that for it as was with be by on not he this'
+        ' are or his from at which but have an they you were her she all'
+        ' there would their we him been has when who will more no if out'
+        ' so said what up its about into than them can only other new some'
+        ' could time these two may then do first any my now such like our'
+        ' over man me even most made after also did many before must'
+        ' through back years where much your way well down should because'
+        ' each just those people how too little state good very make world'
+        ' still own see men work long get here between both life being under'
+        ' never day same another know while last might us great old year'
+        ' off come since against go came right used take three meeting'
+        ' invoice report backup server release draft budget schedule').split()
+
+
+def lognormal_size(rng, median, sigma, maximum):
+    return min(maximum, max(1, int(rng.lognormvariate(0, sigma) * median)))
+
+
+def generate_text(rng, size):
+    # words are about 5 characters long (plus a space), a dozen a line
+    words = rng.choices(WORDS, k=max(1, size // 6))
+    return ''.join(
+            ' '.join(words[offset:offset + 12]) + '\n'
+            for offset in range(0, len(words), 12))
+
+
+def generate_attachment(rng, size):
+    # base64'd, as it would be in a real message
+    data = email.base64mime.body_encode(rng.randbytes(size), 76)
+    return ('Content-Type: application/octet-stream; name="file%d.bin"\n'
+            'Content-Transfer-Encoding: base64\n'
+            'Content-Disposition: attachment; filename="file%d.bin"\n'
+            '\n%s' % (size, size, data))
+
+
+def generate_message(rng, index, message_id):
+    # (content, timestamp); lines end in LF
+    timestamp = rng.uniform(FIRST_DATE, LAST_DATE)
+    sender = rng.randrange(1000)
+    subject = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 9)))
+    headers = [
+            'Return-Path: <sender%d@example.com>' % sender,
+            'Received: from mx%d.example.com (mx%d.example.com [192.0.2.%d])'
+                % (sender % 7, sender % 7, sender % 250 + 1),
+            '\tby mail.example.net with ESMTPS; %s'
+                % email.utils.formatdate(timestamp),
+            'From: "Sender %d" <sender%d@example.com>' % (sender, sender),
+            'To: bench@example.net',
+            'Subject: %s (#%d)' % (subject.capitalize(), index),
+            'Date: %s' % email.utils.formatdate(timestamp),
+            ]
+    if message_id is not None:
+        headers.append('Message-ID: %s' % message_id)
+    headers.append('MIME-Version: 1.0')
+    body = generate_text(rng, lognormal_size(
+        rng, MEDIAN_BODY_SIZE, BODY_SIZE_SIGMA, MAX_BODY_SIZE))
+    if rng.random() < ATTACHMENT_RATE:
+        boundary = '=_bench_%d' % index
+        headers.append(
+                'Content-Type: multipart/mixed; boundary="%s"' % boundary)
+        body = ('--%s\nContent-Type: text/plain; charset=utf-8\n\n%s'
+                '--%s\n%s--%s--\n' % (
+                    boundary, body, boundary,
+                    generate_attachment(rng, lognormal_size(
+                        rng, MEDIAN_ATTACHMENT_SIZE, ATTACHMENT_SIZE_SIGMA,
+                        MAX_ATTACHMENT_SIZE)),
+                    boundary))
+    else:
+        headers.append('Content-Type: text/plain; charset=utf-8')
+    content = '\n'.join(headers) + '\n\n' + body
+    return (content.encode('utf-8'), timestamp)
+
+
+def generate_messages(count, seed=0):
+    # (content, timestamp) for each of `count` messages
+    rng = random.Random(seed)
+    message_ids = []
+    for index in range(count):
+        draw = rng.random()
+        if draw < MISSING_MESSAGE_ID_RATE:
+            message_id = None
+        elif draw < MISSING_MESSAGE_ID_RATE + REPEATED_MESSAGE_ID_RATE and (
+                message_ids):
+            message_id = rng.choice(message_ids)
+        else:
+            message_id = '<%d.%08x@bench.example.com>' % (
+                    index, rng.getrandbits(32))
+            message_ids.append(message_id)
+        yield generate_message(rng, index, message_id)
+
+
+def write_maildir(dirname, count, seed=0):
+    # a new maildir (cur/, new/ and tmp/) with `count` messages in cur/;
+    # returns their total size
+    for subdirname in ('cur', 'new', 'tmp'):
+        os.makedirs(os.path.join(dirname, subdirname), exist_ok=True)
+    total_size = 0
+    for index, (content, timestamp) in enumerate(
+            generate_messages(count, seed)):
+        filepath = os.path.join(
+                dirname, 'cur', '%d.M%dP%d.bench:2,S' % (
+                    timestamp, index, os.getpid()))
+        with open(filepath, 'wb') as message_file:
+            message_file.write(content)
+        os.utime(filepath, (timestamp, timestamp))
+        total_size += len(content)
+    return total_size
+
+
+if __name__ == '__main__':
+    # A maildir with 10000 messages:
+    #   ./genmail.py ~/bench_maildir 10000 [seed]
+    #
+    dirname, count = sys.argv[1], int(sys.argv[2])
+    seed = int(sys.argv[3]) if len(sys.argv) >= 4 else 0
+    total_size = write_maildir(dirname, count, seed)
+    print('wrote %d messages (%.1f MiB) into %s' % (
+        count, total_size / 1024 / 1024, os.path.join(dirname, 'cur')))
@@ -1,19 +1,78 @@
+import array
+import bisect
+from collections import OrderedDict, deque
+import contextlib
 import email
 import email.Header
 import email.Utils
+import hashlib
+import heapq
+import itertools
+import json
 import os
+import Queue
+import random
+import resource
 import sys
 import re
 import time
 import signal
-import operator
-import pickle
+import socket
+import sqlite3
+import stat
+import struct
+import threading
+import zlib
+import imaplib
 from imaplib import IMAP4_SSL
-from multiprocessing import Pool
+from multiprocessing import Condition, Pool, RawArray, RawValue
+from multiprocessing.pool import ThreadPool
+
+try:
+    from scandir import scandir
+except ImportError:
+    # directories get listed with os.listdir() and a stat() per entry
+    scandir = None
 
 IMAP_FETCH_LIMIT = 1000000000
 MAX_IMAP_WORKERS = 5
+IMAP_IDLE_CHECK_SECONDS = 60
 MAX_LOCAL_WORKERS = 1
+APPEND_BATCH_MAX_BYTES = 4 * 1024 * 1024
+APPEND_BATCH_MAX_MESSAGES = 50
+LITERAL_MINUS_MAX_SIZE = 4096
+FETCH_BATCH_MAX_MESSAGES = 1000
+MAX_THROTTLED_ATTEMPTS = 10
+BACKOFF_INITIAL_DELAY = 1.0
+BACKOFF_MAX_DELAY = 120.0
+TARGET_COMMAND_SECONDS = 10.0
+MIN_BATCH_FACTOR = 1.0 / 32
+BATCH_FACTOR_STEP = 1.0 / 32
+IMAP_WINDOW_TASKS = 4 * MAX_IMAP_WORKERS
+LOCAL_CHUNK_SIZE = 64
+MAX_WALKER_THREADS = 16
+LOCAL_WINDOW_TASKS = 4 * MAX_LOCAL_WORKERS
+LOCAL_COMMIT_FILES = 10000
+POOL_RESULT_TIMEOUT = 365 * 24 * 3600
+PROGRESS_LOG_SECONDS = 30
+METRICS_DIRNAME = os.environ.get('MAILDIR2IMAP_METRICS_DIR')
+# COMPRESS=DEFLATE, whenever the server supports it; on unless set to 0
+IMAP_COMPRESS = os.environ.get('MAILDIR2IMAP_COMPRESS') != '0'
+IMAP_READ_CHUNK_SIZE = 64 * 1024
+METRICS_COMMANDS = ('UID FETCH', 'APPEND')
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+HEADER_READ_SIZE = 8192
+MAX_HEADER_BLOCK_SIZE = 1024 * 1024
+# hashed, along with the size, into the fingerprint that stands in for
+# the Message-ID of messages without one
+FINGERPRINT_FIELDS = ('date', 'from', 'to', 'cc', 'subject')
+FINGERPRINT_READ_SIZE = 1024 * 1024
+# local indices are kept apart from the mail directories, which may be
+# read-only (archives, snapshots) or being delivered to
+LOCAL_INDEX_DIRPATH = os.path.join(
+        os.path.expanduser('~'), '.cache', 'maildir2imap', 'local')
+REMOTE_INDEX_FILEPATH = os.path.join(
+        os.path.expanduser('~'), '.cache', 'maildir2imap', 'remote_index.sqlite')
 
 def encode_unicode(value):
     # from 'maildir2gmail.py'
@@ -88,273 +147,1745 @@ def log(message):
     sys.stderr.write('[%s]: %s\n' % (
         time.strftime('%H:%M:%S'), encode_unicode(message)))
 
+class SyncError(Exception):
+    """
+    What a run gives up with once it can't go on (retries run out, and
+    the like), after logging why; whatever it got done was committed
+    as it went.
+    """
+
+class RunMetrics(object):
+    """
+    Where a run's time went, per phase (the local scan overlapping the
+    others), and how much it got through. Written out at the end, along
+    with the IMAP workers' stats (see ImapWorkerBudget), as a JSON
+    summary and a node_exporter textfile whenever METRICS_DIRNAME is set.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phase_seconds = OrderedDict()
+        self.phase_max_rss_bytes = OrderedDict()
+        self.counters = OrderedDict()
+        self.succeeded = False
+        # counted into from the local scan's thread as well
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phase_seconds[name] = (
+                        self.phase_seconds.get(name, 0.0)
+                        + time.time() - started)
+                # the peak so far, that is
+                self.phase_max_rss_bytes[name] = max_rss_bytes()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self, labels, budget):
+        return OrderedDict([
+                ('labels', OrderedDict(labels)),
+                ('started', self.started),
+                ('duration_seconds', time.time() - self.started),
+                ('succeeded', self.succeeded),
+                ('phase_seconds', self.phase_seconds),
+                ('phase_max_rss_bytes', self.phase_max_rss_bytes),
+                ('counters', self.counters),
+                ('imap', budget.stats()),
+                ])
+
+    def write(self, labels, budget):
+        # labels: (name, value) pairs telling runs apart (and naming
+        # the files), e.g. the folder
+        summary = self.summary(labels, budget)
+        stem = os.path.join(METRICS_DIRNAME, 'maildir2imap-' + re.sub(
+            r'[^\w.@-]+', '_', '-'.join(value for _name, value in labels)))
+        write_file_atomically(
+                stem + '.json', json.dumps(summary, indent=2) + '\n')
+        write_file_atomically(stem + '.prom', prometheus_textfile(summary))
+        log_info('wrote metrics to %s.{json,prom}' % stem)
+
+METRICS = RunMetrics()
+
+def max_rss_bytes():
+    # worker processes are only accounted for once they've exited
+    max_rss = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # KiB, except on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+def prometheus_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+def prometheus_labels(labels):
+    return ','.join(
+            '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                .replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in labels)
+
+def prometheus_textfile(summary):
+    # https://prometheus.io/docs/instrumenting/exposition_formats/;
+    # everything is about the last run, hence gauges
+    labels = summary['labels'].items()
+    lines = []
+
+    def add_metric(name, metric_type, description, samples):
+        lines.append('# HELP maildir2imap_%s %s' % (name, description))
+        lines.append('# TYPE maildir2imap_%s %s' % (name, metric_type))
+        for suffix, sample_labels, value in samples:
+            lines.append('maildir2imap_%s%s{%s} %s' % (
+                name, suffix, prometheus_labels(labels + sample_labels),
+                prometheus_value(value)))
+
+    add_metric('last_run_timestamp_seconds', 'gauge',
+            'When the last run started.', [('', [], summary['started'])])
+    add_metric('last_run_duration_seconds', 'gauge',
+            'How long the last run took.',
+            [('', [], summary['duration_seconds'])])
+    add_metric('last_run_success', 'gauge',
+            'Whether the last run completed.',
+            [('', [], int(summary['succeeded']))])
+    add_metric('last_run_phase_seconds', 'gauge',
+            'Time spent in each phase of the last run.',
+            [('', [('phase', phase)], seconds)
+                for phase, seconds in summary['phase_seconds'].items()])
+    add_metric('last_run_phase_max_rss_bytes', 'gauge',
+            'Peak resident memory by the end of each phase of the last run.',
+            [('', [('phase', phase)], size)
+                for phase, size in summary['phase_max_rss_bytes'].items()])
+    for name, value in summary['counters'].items():
+        add_metric('last_run_%s' % name, 'gauge',
+                'Counted over the last run.', [('', [], value)])
+    imap_stats = summary['imap']
+    for name in ('commands', 'retries', 'reconnects', 'bytes_appended',
+            'bytes_sent', 'bytes_received', 'uncompressed_bytes_sent',
+            'uncompressed_bytes_received'):
+        add_metric('last_run_imap_%s' % name, 'gauge',
+                'Counted over the last run.', [('', [], imap_stats[name])])
+    add_metric('last_run_imap_command_duration_seconds', 'histogram',
+            'IMAP command latencies over the last run.',
+            [sample
+                for command, histogram
+                in sorted(imap_stats['command_latencies'].items())
+                for sample in (
+                    [('_bucket', [('command', command), ('le', bound)], count)
+                        for bound, count in histogram['buckets'].items()]
+                    + [('_sum', [('command', command)], histogram['sum']),
+                        ('_count', [('command', command)],
+                            histogram['buckets']['+Inf'])])])
+    return '\n'.join(lines) + '\n'
+
+def write_file_atomically(filepath, content):
+    # so that whoever reads it (e.g. node_exporter) never sees it
+    # half-written
+    temp_filepath = '%s.%d.tmp' % (filepath, os.getpid())
+    with open(temp_filepath, 'w') as out_file:
+        out_file.write(content)
+    os.rename(temp_filepath, filepath)
+
+class ImapWorkerBudget(object):
+    """
+    Shared by the IMAP worker processes (it's handed to them through the
+    pool initializer): how many of them may be running commands at once
+    and a factor by which they scale their batches, both adjusted
+    AIMD-style. Whenever the server throttles us (or drops a connection)
+    they're halved and the command is retried after an exponential
+    backoff; as commands keep going through they grow back a bit at
+    a time.
+    It also keeps the stats that end up in the metrics: commands,
+    retries, reconnects, bytes appended, bytes sent and received (as
+    they went over the wire, and before compression) and, for each
+    command in METRICS_COMMANDS, a histogram of its latency.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.released = Condition()
+        self.limit = RawValue('d', size)
+        self.in_use = RawValue('i', 0)
+        self.batch_factor = RawValue('d', 1.0)
+        self.backoff_delay = RawValue('d', 0.0)
+        self.last_decrease = RawValue('d', 0.0)
+        self.latency = RawValue('d', 0.0)
+        self.commands = RawValue('l', 0)
+        self.retries = RawValue('l', 0)
+        self.reconnects = RawValue('l', 0)
+        self.bytes_appended = RawValue('l', 0)
+        self.bytes_sent = RawValue('l', 0)
+        self.bytes_received = RawValue('l', 0)
+        self.uncompressed_bytes_sent = RawValue('l', 0)
+        self.uncompressed_bytes_received = RawValue('l', 0)
+        # a count per bucket (plus one for those beyond the last) for
+        # every command, one command after the other
+        self.latency_counts = RawArray(
+                'l', len(METRICS_COMMANDS) * (len(LATENCY_BUCKETS) + 1))
+        self.latency_sums = RawArray('d', len(METRICS_COMMANDS))
+
+    def acquire(self):
+        with self.released:
+            while self.in_use.value >= max(1, int(self.limit.value)):
+                self.released.wait()
+            self.in_use.value += 1
+
+    def release(self):
+        with self.released:
+            self.in_use.value -= 1
+            self.released.notify_all()
+
+    def scaled(self, value):
+        return max(1, int(value * self.batch_factor.value))
+
+    def record_success(self, duration, command=None):
+        with self.released:
+            self.commands.value += 1
+            if command in METRICS_COMMANDS:
+                self.record_latency(METRICS_COMMANDS.index(command), duration)
+            self.latency.value = 0.9 * self.latency.value + 0.1 * duration
+            self.backoff_delay.value = 0.0
+            if duration > TARGET_COMMAND_SECONDS:
+                self.batch_factor.value = max(
+                        MIN_BATCH_FACTOR, self.batch_factor.value / 2)
+            else:
+                self.batch_factor.value = min(
+                        1.0, self.batch_factor.value + BATCH_FACTOR_STEP)
+            self.limit.value = min(
+                    self.size, self.limit.value + 1 / self.limit.value)
+            self.released.notify_all()
+
+    def record_throttled(self, reason):
+        # returns how long to wait before retrying
+        with self.released:
+            self.commands.value += 1
+            self.retries.value += 1
+            now = time.time()
+            if now - self.last_decrease.value > self.latency.value:
+                # the other workers will likely be told as well;
+                # that's still one decrease
+                self.last_decrease.value = now
+                self.limit.value = max(1.0, self.limit.value / 2)
+                self.batch_factor.value = max(
+                        MIN_BATCH_FACTOR, self.batch_factor.value / 2)
+                self.backoff_delay.value = min(
+                        BACKOFF_MAX_DELAY,
+                        max(BACKOFF_INITIAL_DELAY,
+                            self.backoff_delay.value * 2))
+                log_notice('throttled (%s); down to %d worker(s) and'
+                        ' %d%% of the batch size, backing off for %.1fs' % (
+                            reason, int(self.limit.value),
+                            100 * self.batch_factor.value,
+                            self.backoff_delay.value))
+            return self.backoff_delay.value * random.uniform(0.5, 1.0)
+
+    def record_latency(self, command_index, duration):
+        bucket_index = len(LATENCY_BUCKETS)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if duration <= bound:
+                bucket_index = index
+                break
+        self.latency_counts[
+                command_index * (len(LATENCY_BUCKETS) + 1)
+                + bucket_index] += 1
+        self.latency_sums[command_index] += duration
+
+    def record_reconnect(self):
+        with self.released:
+            self.reconnects.value += 1
+
+    def record_bytes_appended(self, size):
+        with self.released:
+            self.bytes_appended.value += size
+
+    def record_traffic(self, imap_obj):
+        # takes over what the connection counted since the last time
+        with self.released:
+            self.bytes_sent.value += imap_obj.bytes_sent
+            self.bytes_received.value += imap_obj.bytes_received
+            self.uncompressed_bytes_sent.value += (
+                    imap_obj.uncompressed_bytes_sent)
+            self.uncompressed_bytes_received.value += (
+                    imap_obj.uncompressed_bytes_received)
+        imap_obj.reset_counts()
+
+    def stats(self):
+        with self.released:
+            command_latencies = {}
+            for command_index, command in enumerate(METRICS_COMMANDS):
+                first = command_index * (len(LATENCY_BUCKETS) + 1)
+                counts = self.latency_counts[
+                        first:first + len(LATENCY_BUCKETS) + 1]
+                if not any(counts):
+                    continue
+                # cumulative, as Prometheus has it
+                command_latencies[command] = {
+                        'buckets': OrderedDict(
+                            (prometheus_value(bound), sum(counts[:index + 1]))
+                            for index, bound in enumerate(
+                                LATENCY_BUCKETS + (float('inf'),))),
+                        'sum': self.latency_sums[command_index],
+                        }
+            return {
+                    'commands': self.commands.value,
+                    'retries': self.retries.value,
+                    'reconnects': self.reconnects.value,
+                    'bytes_appended': self.bytes_appended.value,
+                    'bytes_sent': self.bytes_sent.value,
+                    'bytes_received': self.bytes_received.value,
+                    'uncompressed_bytes_sent':
+                        self.uncompressed_bytes_sent.value,
+                    'uncompressed_bytes_received':
+                        self.uncompressed_bytes_received.value,
+                    'command_latencies': command_latencies,
+                    }
+
+# RFC 4978
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+class ImapConnection(IMAP4_SSL):
+    """
+    IMAP4_SSL that counts the bytes going through it, both as they go
+    over the wire and as they are before compression; once compress()
+    goes through, everything is deflated both ways (COMPRESS=DEFLATE).
+    """
+
+    def __init__(self, host, port=imaplib.IMAP4_SSL_PORT):
+        self.compressor = None
+        self.decompressor = None
+        self.read_buffer = ''
+        self.reset_counts()
+        IMAP4_SSL.__init__(self, host, port)
+
+    def reset_counts(self):
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.uncompressed_bytes_sent = 0
+        self.uncompressed_bytes_received = 0
+
+    def compress(self):
+        typ, data = self._simple_command('COMPRESS', 'DEFLATE')
+        if typ == 'OK':
+            # servers don't send anything past the OK until asked to,
+            # so there's nothing left in self.file to be inflated
+            self.compressor = zlib.compressobj(
+                    zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                    -zlib.MAX_WBITS)
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return (typ, data)
+
+    def send(self, data):
+        self.uncompressed_bytes_sent += len(data)
+        if self.compressor is not None:
+            data = (self.compressor.compress(data)
+                    + self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.bytes_sent += len(data)
+        IMAP4_SSL.send(self, data)
+
+    def inflate_more(self):
+        data = self.sslobj.read(IMAP_READ_CHUNK_SIZE)
+        if not data:
+            raise self.abort('socket error: EOF')
+        self.bytes_received += len(data)
+        data = self.decompressor.decompress(data)
+        self.uncompressed_bytes_received += len(data)
+        return data
+
+    def read(self, size):
+        if self.decompressor is None:
+            data = IMAP4_SSL.read(self, size)
+            self.bytes_received += len(data)
+            self.uncompressed_bytes_received += len(data)
+            return data
+        chunks = [self.read_buffer]
+        length = len(self.read_buffer)
+        while length < size:
+            chunks.append(self.inflate_more())
+            length += len(chunks[-1])
+        data = ''.join(chunks)
+        self.read_buffer = data[size:]
+        return data[:size]
+
+    def readline(self):
+        if self.decompressor is None:
+            line = IMAP4_SSL.readline(self)
+            self.bytes_received += len(line)
+            self.uncompressed_bytes_received += len(line)
+            return line
+        # only the latest chunk gets searched for the end of the line
+        chunks = [self.read_buffer]
+        length = len(self.read_buffer)
+        end = self.read_buffer.find('\n')
+        while end < 0:
+            if length > imaplib._MAXLINE:
+                raise self.error('got more than %d bytes' % imaplib._MAXLINE)
+            chunks.append(self.inflate_more())
+            end = chunks[-1].find('\n')
+            if end >= 0:
+                end += length
+            length += len(chunks[-1])
+        data = ''.join(chunks)
+        self.read_buffer = data[end + 1:]
+        return data[:end + 1]
+
+def imap_connect(hostname):
+    # the port can also be given as part of the hostname ('host:port')
+    host, separator, port = hostname.rpartition(':')
+    if not separator or not port.isdigit() or ':' in host:
+        return ImapConnection(hostname)
+    return ImapConnection(host, int(port))
+
+def imap_refresh_capabilities(imap_obj):
+    # servers may advertise more of them once we're logged in
+    typ, data = imap_obj.capability()
+    if typ == 'OK' and data and data[-1]:
+        imap_obj.capabilities = tuple(data[-1].upper().split())
+
+def imap_response_code_value(imap_obj, code):
+    _typ, data = imap_obj.response(code)
+    if not data or data[-1] is None:
+        return None
+    return int(data[-1])
+
 IMAP_WORKER_OBJ = None
 IMAP_WORKER_FOLDER = None
 IMAP_WORKER_HOSTNAME = None
 IMAP_WORKER_USERNAME = None
 IMAP_WORKER_PASSWORD = None
-def imap_worker_init(hostname, username, password, folder_name):
+IMAP_WORKER_BUDGET = None
+IMAP_WORKER_LAST_ACTIVE = None
+def imap_worker_init(hostname, username, password, folder_name, budget):
     global IMAP_WORKER_FOLDER, IMAP_WORKER_HOSTNAME
-    global IMAP_WORKER_USERNAME, IMAP_WORKER_PASSWORD
+    global IMAP_WORKER_USERNAME, IMAP_WORKER_PASSWORD, IMAP_WORKER_BUDGET
+    IMAP_WORKER_BUDGET = budget
     IMAP_WORKER_FOLDER = folder_name
     IMAP_WORKER_HOSTNAME = hostname
     IMAP_WORKER_USERNAME = username
     IMAP_WORKER_PASSWORD = password
-    signal.signal(signal.SIGINT, imap_worker_die)
-    imap_worker_setup()
+    # interrupts are dealt with by the parent, which terminates us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # connecting is left for the first task, so that workers which
+    # never get one don't log in for nothing
 
 def imap_worker_setup():
     global IMAP_WORKER_OBJ
     if IMAP_WORKER_OBJ is not None:
+        IMAP_WORKER_BUDGET.record_reconnect()
+        IMAP_WORKER_BUDGET.record_traffic(IMAP_WORKER_OBJ)
         try:
             IMAP_WORKER_OBJ.close()
         except Exception as e:
             log_error("couldnt close previous imap connection: %s" % repr(e))
-    IMAP_WORKER_OBJ = IMAP4_SSL(IMAP_WORKER_HOSTNAME)
-    IMAP_WORKER_OBJ.login(IMAP_WORKER_USERNAME, IMAP_WORKER_PASSWORD)
-    log_info('connected \'%s\' to %s' % (
-        IMAP_WORKER_USERNAME, IMAP_WORKER_HOSTNAME))
-    IMAP_WORKER_OBJ.select(IMAP_WORKER_FOLDER)
-
-#def imap_worker_die(signum, frame):
-def imap_worker_die():
-    if IMAP_WORKER_OBJ is not None:
+    for attempt in xrange(MAX_THROTTLED_ATTEMPTS):
         try:
-            IMAP_WORKER_OBJ.close()
-        except Exception:
-            pass
-    sys.exit(-1)
+            IMAP_WORKER_OBJ = imap_connect(IMAP_WORKER_HOSTNAME)
+            IMAP_WORKER_OBJ.login(IMAP_WORKER_USERNAME, IMAP_WORKER_PASSWORD)
+            log_info('connected \'%s\' to %s' % (
+                IMAP_WORKER_USERNAME, IMAP_WORKER_HOSTNAME))
+            imap_refresh_capabilities(IMAP_WORKER_OBJ)
+            if (IMAP_COMPRESS and
+                    'COMPRESS=DEFLATE' in IMAP_WORKER_OBJ.capabilities):
+                typ, data = IMAP_WORKER_OBJ.compress()
+                if typ != 'OK':
+                    log_error('couldn\'t enable compression: %s' % repr(data))
+            typ, data = IMAP_WORKER_OBJ.select(IMAP_WORKER_FOLDER)
+        except imaplib.IMAP4.abort as e:
+            typ, data = 'NO', ['connection lost: %s' % e]
+        else:
+            if not is_throttled_response(typ, data):
+                break
+        time.sleep(IMAP_WORKER_BUDGET.record_throttled(data[-1]))
+    if typ != 'OK':
+        raise Exception('couldn\'t select %s: %s' % (
+            repr(IMAP_WORKER_FOLDER), repr(data)))
+
+def imap_worker_check():
+    # the connection is kept for as long as the pool lives (through
+    # discovery, the fetching of message ids and the appends); one
+    # that has been idle for a while gets a NOOP before being put back
+    # to work, and gets replaced if it turns out to be gone
+    if IMAP_WORKER_OBJ is None:
+        imap_worker_setup()
+        return
+    if time.time() - IMAP_WORKER_LAST_ACTIVE < IMAP_IDLE_CHECK_SECONDS:
+        return
+    try:
+        typ, data = IMAP_WORKER_OBJ.noop()
+    except (imaplib.IMAP4.error, socket.error) as e:
+        typ, data = 'NO', [repr(e)]
+    if typ != 'OK':
+        log_info('idle connection is gone (%s); reconnecting' % data[-1])
+        imap_worker_setup()
 
 def imap_worker(worker_args):
+    global IMAP_WORKER_LAST_ACTIVE
     (func, args) = worker_args
-    assert (IMAP_WORKER_OBJ != None)
-    val = func(*args)
+    IMAP_WORKER_BUDGET.acquire()
+    try:
+        imap_worker_check()
+        val = func(*args)
+    finally:
+        IMAP_WORKER_LAST_ACTIVE = time.time()
+        if IMAP_WORKER_OBJ is not None:
+            IMAP_WORKER_BUDGET.record_traffic(IMAP_WORKER_OBJ)
+        IMAP_WORKER_BUDGET.release()
     return val
 
-def imap_worker_fetch_message_ids(message_refs):
-    log_info('attempting to fetch %d message ids' % len(message_refs))
-    if len(message_refs) < 1:
-        return []
-    _typ, data = IMAP_WORKER_OBJ.fetch(
-            ','.join(message_refs),
-            '(BODY[HEADER.FIELDS (MESSAGE-ID)])')
-    command_replies = [command_resp for _command, command_resp in data[::2]]
-    message_ids = []
-    for reply in command_replies:
+THROTTLED_RESPONSE_RE = re.compile(r'^\[(THROTTLED|UNAVAILABLE|LIMIT)\]')
+
+def is_throttled_response(typ, data):
+    return typ == 'NO' and THROTTLED_RESPONSE_RE.match(data[-1] or '')
+
+def imap_worker_command(command, func):
+    # runs func() -> (typ, data) over the worker's connection; while the
+    # server says we're being throttled (or drops the connection, which
+    # some do instead) it's retried after a backoff. func must look up
+    # IMAP_WORKER_OBJ when called, as it may have been replaced.
+    attempt = 0
+    while True:
+        started = time.time()
+        try:
+            typ, data = func()
+        except imaplib.IMAP4.abort as e:
+            attempt += 1
+            if attempt >= MAX_THROTTLED_ATTEMPTS:
+                raise
+            time.sleep(IMAP_WORKER_BUDGET.record_throttled(
+                'connection lost: %s' % e))
+            try:
+                imap_worker_setup()
+            except Exception as e:
+                log_error('couldn\'t reconnect: %s' % repr(e))
+            continue
+        if not is_throttled_response(typ, data):
+            IMAP_WORKER_BUDGET.record_success(time.time() - started, command)
+            return (typ, data)
+        attempt += 1
+        if attempt >= MAX_THROTTLED_ATTEMPTS:
+            return (typ, data)
+        time.sleep(IMAP_WORKER_BUDGET.record_throttled(data[-1]))
+
+def imap_worker_folder_status():
+    # (exists, uidvalidity, uidnext); the folder is selected anew so
+    # that they're current
+    typ, data = imap_worker_command('SELECT', lambda: IMAP_WORKER_OBJ.select(
+        IMAP_WORKER_FOLDER))
+    if typ != 'OK':
+        raise Exception('couldn\'t select %s: %s' % (
+            repr(IMAP_WORKER_FOLDER), repr(data)))
+    return (int(data[0]),
+            imap_response_code_value(IMAP_WORKER_OBJ, 'UIDVALIDITY'),
+            imap_response_code_value(IMAP_WORKER_OBJ, 'UIDNEXT'))
+
+def imap_worker_search_uids(uid_range):
+    typ, data = imap_worker_command('UID SEARCH', lambda: IMAP_WORKER_OBJ.uid(
+        'SEARCH', 'UID', uid_range))
+    if typ != 'OK':
+        raise Exception('couldn\'t search for uids %s: %s' % (
+            uid_range, repr(data)))
+    return map(int, data[0].split())
+
+UID_FETCH_RESPONSE_RE = re.compile(r'\bUID (\d+)')
+SIZE_FETCH_RESPONSE_RE = re.compile(r'\bRFC822\.SIZE (\d+)')
+APPENDUID_RESPONSE_RE = re.compile(r'\[APPENDUID (\d+) ([\d:,]+)\]')
+
+def imap_worker_fetch_message_ids(message_uids):
+    log_info('attempting to fetch %d message ids' % len(message_uids))
+    message_uids_and_ids = []
+    offset = 0
+    while offset < len(message_uids):
+        # the batch size is looked up again every time, as it shrinks
+        # while we're being throttled
+        batch = message_uids[offset:offset + IMAP_WORKER_BUDGET.scaled(
+            len(message_uids))]
+        offset += len(batch)
+        message_uids_and_ids.extend(fetch_message_ids_batch(batch))
+    return message_uids_and_ids
+
+def fetch_message_ids_batch(message_uids):
+    typ, data = imap_worker_command('UID FETCH', lambda: IMAP_WORKER_OBJ.uid(
+            'FETCH', uid_set(message_uids),
+            '(UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])'))
+    if typ != 'OK':
+        # (imaplib's own exceptions can't make it back to the parent)
+        raise Exception('couldn\'t fetch message ids: %s' % repr(data))
+    message_uids_and_ids = []
+    for datum in data:
+        if not isinstance(datum, tuple):
+            continue
+        command, reply = datum
+        uid_match = UID_FETCH_RESPONSE_RE.search(command)
+        if uid_match is None:
+            log_error('fetch reply without uid: %s' % repr(command))
+            continue
+        message_id = None
         if reply[:11].lower() == 'message-id:':
             message_id_parts = filter(len, re.split(r'\s+', reply[11:]))
             if len(message_id_parts) == 1:
                 [message_id] = message_id_parts
-                if len(message_id) > 0:
-                    log_debug('got message id %s' % message_id)
-                    message_ids.append(message_id)
-                else:
-                    log_error('message-id cannot be empty')
+                log_debug('got message id %s' % message_id)
             else:
                 log_error('unparsable message id: \%s' % message_id_parts)
-        else:
+        elif reply.strip():
             log_error('invalid message-id header: %s' % repr(reply))
-    return message_ids
+        message_uids_and_ids.append((int(uid_match.group(1)), message_id))
+
+    idless_uids = [
+            uid for uid, message_id in message_uids_and_ids
+            if message_id is None]
+    if len(idless_uids) > 0:
+        # ID-less messages get a fingerprint instead, or are kept (as
+        # None) if that can't be had, so that they're not fetched
+        # again on every run
+        fingerprints = fetch_message_fingerprints_batch(idless_uids)
+        message_uids_and_ids = [
+                (uid, fingerprints.get(uid) if message_id is None
+                    else message_id)
+                for uid, message_id in message_uids_and_ids]
+    return message_uids_and_ids
+
+def fetch_message_fingerprints_batch(message_uids):
+    # {uid: fingerprint} for the messages that can be fingerprinted;
+    # what's needed for it is small, and the same whether it comes
+    # from the server or from the local files
+    typ, data = imap_worker_command('UID FETCH', lambda: IMAP_WORKER_OBJ.uid(
+            'FETCH', uid_set(message_uids),
+            '(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (%s)])' % ' '.join(
+                name.upper() for name in FINGERPRINT_FIELDS)))
+    if typ != 'OK':
+        raise Exception('couldn\'t fetch fingerprints: %s' % repr(data))
+    fingerprints = {}
+    for index, datum in enumerate(data):
+        if not isinstance(datum, tuple):
+            continue
+        command, reply = datum
+        # whatever came after the header fields' literal, which the
+        # size might be in
+        trailer = data[index + 1] if index + 1 < len(data) else None
+        if not isinstance(trailer, str):
+            trailer = ''
+        uid_match = UID_FETCH_RESPONSE_RE.search(command)
+        size_match = SIZE_FETCH_RESPONSE_RE.search(command + ' ' + trailer)
+        if uid_match is None or size_match is None:
+            log_error('fetch reply without uid or size: %s' % repr(command))
+            continue
+        fingerprint = message_fingerprint(
+                int(size_match.group(1)),
+                parse_header_fields(reply, FINGERPRINT_FIELDS))
+        if fingerprint is not None:
+            fingerprints[int(uid_match.group(1))] = fingerprint
+    return fingerprints
+
+def imap_append(imap_obj, folder_name, messages):
+    # imaplib's append() only takes one message and always waits for
+    # the continuation request before sending the literal; this sends
+    # every (flags, timestamp, content) in 'messages' as one APPEND
+    # (MULTIAPPEND if more than one) and uses non-synchronizing literals
+    # whenever the server allows them (LITERAL+ / LITERAL-)
+    capabilities = imap_obj.capabilities
+    tag = imap_obj._new_tag()
+    data = '%s APPEND %s' % (tag, imap_obj._checkquote(folder_name))
+    for flags, timestamp, content in messages:
+        literal = imaplib.MapCRLF.sub(imaplib.CRLF, content)
+        data = '%s %s' % (data, flags)
+        if timestamp is not None:
+            data = '%s %s' % (data, imaplib.Time2Internaldate(timestamp))
+        if ('LITERAL+' in capabilities or
+                ('LITERAL-' in capabilities and
+                    len(literal) <= LITERAL_MINUS_MAX_SIZE)):
+            imap_obj.send('%s {%d+}%s' % (data, len(literal), imaplib.CRLF))
+        else:
+            imap_obj.send('%s {%d}%s' % (data, len(literal), imaplib.CRLF))
+            while imap_obj._get_response():
+                if imap_obj.tagged_commands[tag]:
+                    # rejected before the literal was sent
+                    return imap_obj._command_complete('APPEND', tag)
+        imap_obj.send(literal)
+        data = ''
+    imap_obj.send(imaplib.CRLF)
+    return imap_obj._command_complete('APPEND', tag)
 
-def imap_worker_append_message(filepath, is_dry_sync):
+def expand_uid_set(value):
+    uids = []
+    for uid_range in value.split(','):
+        first, _, last = uid_range.partition(':')
+        uids.extend(xrange(int(first), int(last or first) + 1))
+    return uids
+
+def appended_message_uids(data, message_count):
+    appenduid_match = APPENDUID_RESPONSE_RE.search(data[-1] or '')
+    if appenduid_match is None:
+        return (None, [None] * message_count)
+    uidvalidity = int(appenduid_match.group(1))
+    uids = expand_uid_set(appenduid_match.group(2))
+    if len(uids) != message_count:
+        return (None, [None] * message_count)
+    return (uidvalidity, uids)
+
+def read_message_to_append(filepath, message_id):
     with open(filepath, 'rb') as msg_file:
         content = msg_file.read()
-        message = email.message_from_string(content)
-        timestamp = parsedate(message['date'])
+    header_fields = parse_header_fields(content, ('date', 'subject'))
+    timestamp = parsedate(header_fields.get('date'))
+    try:
+        subject = decode_header(header_fields.get('subject'))
+    except Exception as e:
+        log_error('couldn\'t parse %s\'s subject: %s' %
+                (repr(filepath), repr(e)))
+        subject = ''
+    return (message_id, subject, timestamp, content)
+
+def imap_worker_append_message(message):
+    message_id, subject, timestamp, content = message
+    try:
+        typ, data = imap_worker_command('APPEND', lambda: imap_append(
+                IMAP_WORKER_OBJ, IMAP_WORKER_FOLDER,
+                [('(\\Seen)', timestamp, content)]))
+    except Exception as e:
+        log_error('couldn\'t upload %s: %s' % (repr(subject), repr(e)))
+        imap_worker_setup()
+        return
+    if typ != 'OK':
+        log_error('couldn\'t upload %s: %s' % (repr(subject), repr(data)))
+        return
+    IMAP_WORKER_BUDGET.record_bytes_appended(len(content))
+    uidvalidity, uids = appended_message_uids(data, 1)
+    return (message_id, uidvalidity, uids[0])
+
+def imap_worker_append_messages(filepaths_and_ids, is_dry_sync):
+    messages = []
+    for filepath, message_id in filepaths_and_ids:
+        message = read_message_to_append(filepath, message_id)
+        log_info('appending \'%s\' (%d bytes)' % (
+            repr(message[1]), len(message[3])))
+        messages.append(message)
+
+    if is_dry_sync:
+        return [(message_id, None, None) for message_id, _, _, _ in messages]
+
+    results = []
+    offset = 0
+    while offset < len(messages):
+        # the batch size is looked up again every time, as it shrinks
+        # while we're being throttled
+        batch = messages[offset:offset + IMAP_WORKER_BUDGET.scaled(
+            len(messages))]
+        offset += len(batch)
+        results.extend(append_messages_batch(batch))
+    return results
+
+def append_messages_batch(messages):
+    if len(messages) > 1 and 'MULTIAPPEND' in IMAP_WORKER_OBJ.capabilities:
         try:
-            subject = decode_header(message['subject'])
+            typ, data = imap_worker_command('APPEND', lambda: imap_append(
+                    IMAP_WORKER_OBJ, IMAP_WORKER_FOLDER,
+                    [('(\\Seen)', timestamp, content)
+                        for _, _, timestamp, content in messages]))
         except Exception as e:
-            log_error('couldn\'t parse %s\'s subject: %s' %
-                    (repr(filepath), repr(e)))
-            subject = ''
-        del message
+            typ, data = None, repr(e)
+            imap_worker_setup()
+        if typ == 'OK':
+            IMAP_WORKER_BUDGET.record_bytes_appended(
+                    sum(len(content) for _, _, _, content in messages))
+            uidvalidity, uids = appended_message_uids(data, len(messages))
+            return [(message_id, uidvalidity, uid)
+                    for (message_id, _, _, _), uid in zip(messages, uids)]
+        # MULTIAPPEND is all-or-nothing; retry one by one so that we
+        # find out which messages are being refused
+        log_error('couldn\'t upload %d messages at once (%s); '
+                'retrying one by one' % (len(messages), data))
 
-        log_info('appending \'%s\' (%d bytes)' % (repr(subject), len(content)))
-        if not is_dry_sync:
-            try:
-                IMAP_WORKER_OBJ.append(
-                        IMAP_WORKER_FOLDER,
-                        '(\\Seen)', timestamp, content)
-            except Exception as e:
-                log_error('couldn\'t upload %s: %s' % (repr(subject), repr(e)))
-                imap_worker_setup()
-                return
-        return True
+    results = map(imap_worker_append_message, messages)
+    return filter(lambda v: v, results)
+
+def append_batches(local_files):
+    # local_files: (filepath, message_id, size) tuples
+    batch = []
+    batch_size = 0
+    for filepath, message_id, size in local_files:
+        if batch and (batch_size + size > APPEND_BATCH_MAX_BYTES or
+                len(batch) >= APPEND_BATCH_MAX_MESSAGES):
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append((filepath, message_id))
+        batch_size += size
+    if batch:
+        yield batch
 
 def chunks(l, n):
     for i in xrange(0, len(l), n):
         yield l[i:i+n]
 
-def fetch_imap_message_ids(
-        hostname, username, password, folder_name, limit = IMAP_FETCH_LIMIT):
-    imap_obj = IMAP4_SSL(hostname)
-    imap_obj.login(username, password)
-    log_notice('connected \'%s\' to %s' % (username, hostname))
-    imap_obj.select(folder_name)
-    _typ, data = imap_obj.search(None, 'ALL')
-    imap_obj.close()
-    all_message_refs = data[0].split()
-    log_notice('found %d message refs; fetching up to %d message ids' % (
-        len(all_message_refs), min(len(all_message_refs), limit)))
-    message_refs = all_message_refs[:limit]
-    worker_pool = Pool(
-            MAX_IMAP_WORKERS, imap_worker_init,
-            [hostname, username, password, folder_name])
-    worker_pool_args = [
-            (imap_worker_fetch_message_ids, [chunk])
-            for chunk in chunks(
-                message_refs,
-                min(1000, max(1, len(message_refs) // MAX_IMAP_WORKERS)))]
+def iter_chunks(iterable, n):
+    # same as chunks(), for iterables of unknown length
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, n))
+        if not chunk:
+            return
+        yield chunk
+
+def pool_imap_unordered(worker_pool, func, tasks, window):
+    # same as worker_pool.imap_unordered(), except that:
+    # * no more than `window` tasks are handed out (and held in memory)
+    #   at once; the pool would otherwise go through all of `tasks`
+    #   right away, no matter how lazily they're generated
+    # * it can be interrupted; Python 2 only lets KeyboardInterrupt
+    #   through when waiting with a timeout
+    # * errors generating the tasks are raised here, rather than
+    #   leaving the pool waiting forever
+    slots = threading.Semaphore(window)
+    stopped = []
+    failures = []
+
+    def windowed_tasks():
+        # iterated over from within the pool's own task handler thread
+        try:
+            for task in tasks:
+                slots.acquire()
+                if stopped:
+                    return
+                yield task
+        except Exception as e:
+            log_error('couldn\'t generate tasks: %s' % repr(e))
+            failures.append(e)
+
+    results = worker_pool.imap_unordered(func, windowed_tasks())
     try:
-        message_ids = set(
-                reduce(
-                    operator.concat,
-                    worker_pool.map(imap_worker, worker_pool_args), []))
-        unique = frozenset(message_ids)
-        repeated_count = len(message_ids) - len(unique)
-        del message_ids
-        log_notice('successfully fetched %d message ids (%d repeated)' % (
-            len(unique), repeated_count))
-        worker_pool.terminate()
-        return unique
-    except Exception as e:
-        log_error('rage quitting on fetch_imap_message_ids: %s' % repr(e))
-        worker_pool.terminate()
-        worker_pool.join()
-        sys.exit(-1)
+        while True:
+            try:
+                result = results.next(POOL_RESULT_TIMEOUT)
+            except StopIteration:
+                break
+            slots.release()
+            yield result
+    finally:
+        # the task handler mustn't be left waiting for a slot, or the
+        # pool will never finish terminating
+        stopped.append(True)
+        slots.release()
+    if failures:
+        raise failures[0]
 
-def sync(local_file_per_id, remote_ids, hostname,
-        username, password, folder_name, is_dry_sync):
-    local_ids = frozenset(local_file_per_id.keys())
-    only_local = local_ids - remote_ids
-    log_notice('trying to append %d messages' % len(only_local))
-    worker_pool = Pool(
-            MAX_IMAP_WORKERS, imap_worker_init,
-            [hostname, username, password, folder_name])
-    worker_pool_args = [
-            (imap_worker_append_message,
-                [local_file_per_id[message_id], is_dry_sync])
-            for message_id in only_local]
+def progress_logger(description, total):
+    # returns a function to be called with the count so far; it logs it
+    # every PROGRESS_LOG_SECONDS
+    last_logged = [time.time()]
+    def log_progress(count):
+        now = time.time()
+        if now - last_logged[0] >= PROGRESS_LOG_SECONDS:
+            last_logged[0] = now
+            if total is None:
+                log_notice('%s %d so far' % (description, count))
+            else:
+                log_notice('%s %d out of %d so far' % (
+                    description, count, total))
+    return log_progress
+
+def uid_set(uids):
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and ranges[-1][1] + 1 == uid:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(
+            ('%d' % first) if first == last else ('%d:%d' % (first, last))
+            for first, last in ranges)
+
+# Python 2's array has no 'q'; 'l' is just as wide on LP64 platforms
+INT64_TYPECODE = 'l'
+
+# columns that indices created by earlier versions lack
+INDEX_ADDED_COLUMNS = [
+        ('remote_messages', 'message_digest', 'INTEGER'),
+        ('local_messages', 'message_digest', 'INTEGER'),
+        ]
+# bumped whenever rows written by earlier versions have to be redone
+INDEX_VERSION = 1
+
+def message_id_digest(message_id):
+    # 64 bits worth of hashed Message-ID, as a (signed) SQLite integer
+    if message_id is None:
+        return None
+    return struct.unpack('>q', hashlib.md5(message_id).digest()[:8])[0]
+
+def upgrade_index(db, table):
+    table_columns = [
+            row[1] for row in db.execute('PRAGMA table_info(%s)' % table)]
+    for added_table, column, column_type in INDEX_ADDED_COLUMNS:
+        if added_table == table and column not in table_columns:
+            db.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                table, column, column_type))
+    if db.execute('PRAGMA user_version').fetchone()[0] < 1:
+        # ID-less messages used to be indexed as such; they get a
+        # fingerprint now, so they're fetched (or parsed) again
+        if table == 'remote_messages':
+            db.execute(
+                    'UPDATE remote_folders SET uidnext = 1'
+                    ' WHERE folder_key IN ('
+                    'SELECT folder_key FROM remote_messages'
+                    ' WHERE message_id IS NULL)')
+        db.execute('DELETE FROM %s WHERE message_id IS NULL' % table)
+    db.execute('PRAGMA user_version = %d' % INDEX_VERSION)
+    db.create_function('message_id_digest', 1, message_id_digest)
+    db.execute(
+            'UPDATE %s SET message_digest = message_id_digest(message_id)'
+            ' WHERE message_digest IS NULL AND message_id IS NOT NULL' % table)
+
+def load_message_digests(rows, ref_typecode):
+    # (digests, refs) arrays out of (digest, ref) rows sorted by digest;
+    # repeated digests are only kept once
+    digests = array.array(INT64_TYPECODE)
+    refs = array.array(ref_typecode)
+    for digest, ref in rows:
+        if digests and digests[-1] == digest:
+            continue
+        digests.append(digest)
+        refs.append(ref)
+    return (digests, refs)
+
+def diff_message_digests(digests_a, digests_b):
+    # merges two sorted digest arrays; returns the positions of those
+    # only in a, the positions of those only in b and the common count
+    only_a = array.array('L')
+    only_b = array.array('L')
+    common_count = 0
+    index_a = index_b = 0
+    length_a = len(digests_a)
+    length_b = len(digests_b)
+    while index_a < length_a and index_b < length_b:
+        digest_a = digests_a[index_a]
+        digest_b = digests_b[index_b]
+        if digest_a < digest_b:
+            only_a.append(index_a)
+            index_a += 1
+        elif digest_b < digest_a:
+            only_b.append(index_b)
+            index_b += 1
+        else:
+            common_count += 1
+            index_a += 1
+            index_b += 1
+    only_a.extend(xrange(index_a, length_a))
+    only_b.extend(xrange(index_b, length_b))
+    return (only_a, only_b, common_count)
+
+def open_remote_index():
+    dirname = os.path.dirname(REMOTE_INDEX_FILEPATH)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    db = sqlite3.connect(REMOTE_INDEX_FILEPATH)
+    db.text_factory = str
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS remote_folders (
+            folder_key INTEGER PRIMARY KEY,
+            hostname TEXT NOT NULL,
+            username TEXT NOT NULL,
+            folder_name TEXT NOT NULL,
+            uidvalidity INTEGER,
+            uidnext INTEGER NOT NULL DEFAULT 1,
+            UNIQUE (hostname, username, folder_name));
+        CREATE TABLE IF NOT EXISTS remote_messages (
+            folder_key INTEGER NOT NULL,
+            uid INTEGER NOT NULL,
+            message_id TEXT,
+            PRIMARY KEY (folder_key, uid));
+        """)
+    upgrade_index(db, 'remote_messages')
+    db.execute(
+            'CREATE INDEX IF NOT EXISTS remote_messages_by_digest'
+            ' ON remote_messages (folder_key, message_digest)')
+    db.commit()
+    return db
+
+def load_remote_folder_state(db, hostname, username, folder_name):
+    db.execute(
+            'INSERT OR IGNORE INTO remote_folders'
+            ' (hostname, username, folder_name) VALUES (?, ?, ?)',
+            (hostname, username, folder_name))
+    return db.execute(
+            'SELECT folder_key, uidvalidity, uidnext FROM remote_folders'
+            ' WHERE hostname = ? AND username = ? AND folder_name = ?',
+            (hostname, username, folder_name)).fetchone()
+
+def fetch_imap_message_ids(
+        worker_pool, hostname, username, folder_name,
+        limit = IMAP_FETCH_LIMIT):
+    db = open_remote_index()
+    (folder_key, known_uidvalidity, known_uidnext) = load_remote_folder_state(
+            db, hostname, username, folder_name)
+
+    # over the same workers (and connections) that fetch the message
+    # ids and then append the messages
+    exists_count, uidvalidity, uidnext = worker_pool.apply(
+            imap_worker, [(imap_worker_folder_status, [])])
+
+    if uidvalidity is None or uidvalidity != known_uidvalidity:
+        if known_uidvalidity is not None:
+            log_notice('uidvalidity changed (%s -> %s); rescanning folder' % (
+                known_uidvalidity, uidvalidity))
+        db.execute(
+                'DELETE FROM remote_messages WHERE folder_key = ?',
+                (folder_key,))
+        known_uidnext = 1
+
+    known_count = db.execute(
+            'SELECT COUNT(*) FROM remote_messages WHERE folder_key = ?',
+            (folder_key,)).fetchone()[0]
+    if uidnext is not None and uidnext == known_uidnext \
+            and known_count == exists_count:
+        log_notice('folder unchanged since last run (uidnext %d)' % uidnext)
+        new_uids = []
+    else:
+        searched_uids = worker_pool.apply(
+                imap_worker,
+                [(imap_worker_search_uids, ['%d:*' % known_uidnext])])
+        # "n:*" always matches the highest uid, even if below n;
+        # messages we appended ourselves might be known already
+        known_new_uids = frozenset(uid for (uid,) in db.execute(
+            'SELECT uid FROM remote_messages'
+            ' WHERE folder_key = ? AND uid >= ?', (folder_key, known_uidnext)))
+        new_uids = sorted(
+                uid for uid in searched_uids
+                if uid >= known_uidnext and uid not in known_new_uids)
+        if known_count + len(new_uids) != exists_count and known_uidnext > 1:
+            remaining_uids = frozenset(worker_pool.apply(
+                imap_worker,
+                [(imap_worker_search_uids, ['1:%d' % (known_uidnext - 1)])]))
+            expunged_uids = [
+                    (folder_key, uid) for (uid,) in db.execute(
+                        'SELECT uid FROM remote_messages'
+                        ' WHERE folder_key = ? AND uid < ?',
+                        (folder_key, known_uidnext))
+                    if uid not in remaining_uids]
+            db.executemany(
+                    'DELETE FROM remote_messages'
+                    ' WHERE folder_key = ? AND uid = ?', expunged_uids)
+            log_notice('%d message refs were expunged since last run' %
+                    len(expunged_uids))
+
+    log_notice('found %d new message refs; fetching up to %d message ids' % (
+        len(new_uids), min(len(new_uids), limit)))
+    message_uids = new_uids[:limit]
+    if len(message_uids) > 0:
+        worker_pool_tasks = (
+                (imap_worker_fetch_message_ids, [chunk])
+                for chunk in chunks(
+                    message_uids,
+                    min(FETCH_BATCH_MAX_MESSAGES,
+                        max(1, len(message_uids) // MAX_IMAP_WORKERS))))
+        fetched_count = 0
+        log_progress = progress_logger('fetched', len(message_uids))
+        try:
+            for message_uids_and_ids in pool_imap_unordered(
+                    worker_pool, imap_worker, worker_pool_tasks,
+                    IMAP_WINDOW_TASKS):
+                db.executemany(
+                        'INSERT OR REPLACE INTO remote_messages'
+                        ' (folder_key, uid, message_id, message_digest)'
+                        ' VALUES (?, ?, ?, ?)',
+                        [(folder_key, uid, mid, message_id_digest(mid))
+                            for uid, mid in message_uids_and_ids])
+                # an interrupted run won't need to fetch them again
+                db.commit()
+                fetched_count += len(message_uids_and_ids)
+                METRICS.count('remote_ids_fetched', len(message_uids_and_ids))
+                log_progress(fetched_count)
+        except Exception as e:
+            log_error('rage quitting on fetch_imap_message_ids: %s' % repr(e))
+            db.close()
+            raise SyncError('fetching message ids failed')
+        if uidnext is None or len(message_uids) < len(new_uids):
+            # we can't move past the ones that were left out
+            uidnext = message_uids[-1] + 1
+
+    db.execute(
+            'UPDATE remote_folders SET uidvalidity = ?, uidnext = ?'
+            ' WHERE folder_key = ?',
+            (uidvalidity, uidnext or known_uidnext, folder_key))
+    db.commit()
+
+    defined_count = db.execute(
+            'SELECT COUNT(*) FROM remote_messages'
+            ' WHERE folder_key = ? AND message_digest IS NOT NULL',
+            (folder_key,)).fetchone()[0]
+    digests, _uids = load_message_digests(
+            db.execute(
+                'SELECT message_digest, uid FROM remote_messages'
+                ' WHERE folder_key = ? AND message_digest IS NOT NULL'
+                ' ORDER BY message_digest', (folder_key,)),
+            'L')
+    db.close()
+    log_notice('successfully fetched %d message ids (%d repeated)' % (
+        len(digests), defined_count - len(digests)))
+    return digests
+
+def record_appended_messages(
+        db, hostname, username, folder_name, appended_message_ids):
+    # only messages for which the server told us the UID (UIDPLUS)
+    # can go into the index; the others will be picked up next time
+    (folder_key, uidvalidity, uidnext) = load_remote_folder_state(
+            db, hostname, username, folder_name)
+    appended_uid_and_ids = dict(
+            (uid, message_id)
+            for message_id, message_uidvalidity, uid in appended_message_ids
+            if uid is not None and message_uidvalidity == uidvalidity)
+    db.executemany(
+            'INSERT OR REPLACE INTO remote_messages'
+            ' (folder_key, uid, message_id, message_digest)'
+            ' VALUES (?, ?, ?, ?)',
+            [(folder_key, uid, mid, message_id_digest(mid))
+                for uid, mid in appended_uid_and_ids.items()])
+    while uidnext in appended_uid_and_ids:
+        uidnext += 1
+    db.execute(
+            'UPDATE remote_folders SET uidnext = ? WHERE folder_key = ?',
+            (uidnext, folder_key))
+    db.commit()
+    return len(appended_uid_and_ids)
+
+def sync(worker_pool, dirnames, only_local_refs, hostname,
+        username, folder_name, is_dry_sync):
+    log_notice('trying to append %d messages' % len(only_local_refs))
+    appended_count = append_local_files(
+            worker_pool, lookup_local_message_files(dirnames, only_local_refs),
+            len(only_local_refs), hostname, username, folder_name,
+            is_dry_sync)
+    log_notice('appended %d messages (out of %d)' % (
+        appended_count, len(only_local_refs)))
+
+def append_local_files(worker_pool, local_files, total_count, hostname,
+        username, folder_name, is_dry_sync):
+    # appends the (filepath, message_id, size) local_files; returns how
+    # many got appended
+    # generated as they're handed out, so that only the batches in
+    # flight are ever held in memory
+    worker_pool_tasks = (
+            (imap_worker_append_messages, [batch, is_dry_sync])
+            for batch in append_batches(local_files))
+    appended_count = 0
+    indexed_count = 0
+    log_progress = progress_logger('appended', total_count)
+    db = None if is_dry_sync else open_remote_index()
     try:
-        results = filter(
-                lambda v: v,
-                worker_pool.map(imap_worker, worker_pool_args))
-        log_notice('appended %d messages (out of %d)' % (
-            len(results), len(only_local)))
-        worker_pool.terminate()
+        for results in pool_imap_unordered(
+                worker_pool, imap_worker, worker_pool_tasks,
+                IMAP_WINDOW_TASKS):
+            appended_count += len(results)
+            METRICS.count('messages_appended', len(results))
+            log_progress(appended_count)
+            if db is not None:
+                # recorded as they come, so that an interrupted run
+                # leaves whatever it appended indexed
+                indexed_count += record_appended_messages(
+                        db, hostname, username, folder_name, results)
     except Exception as e:
         log_error('rage quitting on sync: %s' % repr(e))
-        worker_pool.terminate()
-        worker_pool.join()
-        sys.exit(-1)
+        raise SyncError('appending messages failed')
+    finally:
+        if db is not None:
+            db.close()
 
+    if not is_dry_sync:
+        log_notice('indexed %d appended messages' % indexed_count)
+    return appended_count
 
-LOCAL_WORKER_CACHE = None
-def local_worker_init(cached_id_per_file):
-    global LOCAL_WORKER_CACHE
-    LOCAL_WORKER_CACHE = cached_id_per_file
-    signal.signal(signal.SIGINT, local_worker_die)
+class LocalScan(object):
+    """
+    fetch_local_message_ids() going on in a thread of its own while the
+    remote side gets scanned. Once told which message ids the remote
+    side has (see confirm_missing()), the files it parses from then on
+    that turn out to be missing are queued up (see missing_files()), so
+    that they can be appended before the scan is over. Copies of the
+    same message only get queued once; what's been queued is kept track
+    of on disk (in a private temporary database), so that memory use
+    doesn't grow with it.
+    """
 
-def parse_and_append_local_message_id(filepath):
-    cached_message_id = LOCAL_WORKER_CACHE.get(filepath)
-    if cached_message_id != None:
-        return (cached_message_id, filepath)
+    def __init__(self, given_dirnames, worker_pool):
+        self.result = None
+        self.error = None
+        self.remote_digests = None
+        # opened by the scan's own thread
+        self.queued_db = None
+        self.missing_queue = Queue.Queue()
+        self.thread = threading.Thread(
+                target=self.run, args=(given_dirnames, worker_pool))
+        # so that an interrupted run needn't wait for it to finish
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, given_dirnames, worker_pool):
+        try:
+            with METRICS.phase('local_scan'):
+                self.result = fetch_local_message_ids(
+                        given_dirnames, worker_pool, self.parsed)
+        except BaseException as e:
+            # SyncError included; it's raised again by wait()
+            self.error = e
+        finally:
+            if self.queued_db is not None:
+                self.queued_db.close()
+            self.missing_queue.put(None)
+
+    def parsed(self, parsed_files):
+        remote_digests = self.remote_digests
+        if remote_digests is None:
+            # left to the diff
+            return
+        if self.queued_db is None:
+            # '' has SQLite make a private database in a temporary file
+            self.queued_db = sqlite3.connect('')
+            self.queued_db.execute(
+                    'CREATE TABLE queued (message_digest INTEGER PRIMARY KEY)')
+        for dirname, filename, stat_key, message_id in parsed_files:
+            digest = message_id_digest(message_id)
+            if digest is None or sorted_contains(remote_digests, digest):
+                continue
+            if self.queued_db.execute(
+                    'INSERT OR IGNORE INTO queued (message_digest)'
+                    ' VALUES (?)', (digest,)).rowcount == 0:
+                # a copy of one that's been queued already
+                continue
+            self.missing_queue.put(
+                    (os.path.join(dirname, filename), message_id,
+                        stat_key[1]))
+
+    def confirm_missing(self, remote_digests):
+        self.remote_digests = remote_digests
+
+    def missing_files(self):
+        # (filepath, message_id, size) until the scan is over
+        while True:
+            missing_file = self.missing_queue.get()
+            if missing_file is None:
+                return
+            yield missing_file
+
+    def wait(self):
+        # returns what fetch_local_message_ids() did
+        while self.thread.is_alive():
+            # Python 2 only lets KeyboardInterrupt through when waiting
+            # with a timeout
+            self.thread.join(POOL_RESULT_TIMEOUT)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+def sorted_contains(values, value):
+    position = bisect.bisect_left(values, value)
+    return position < len(values) and values[position] == value
+
+
+def local_worker_init():
+    # interrupts are dealt with by the parent, which terminates us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+HEADER_FIELD_LINE_RE = re.compile(r'[\041-\071\073-\176]+:')
 
+def find_header_block_end(data, start=0):
+    # returns the offset right after the last header line, or -1
+    if data[:1] == '\n' or data[:2] == '\r\n':
+        return 0
+    ends = [end for end in (
+        data.find('\n\n', start), data.find('\n\r\n', start))
+        if end >= 0]
+    return (min(ends) + 1) if ends else -1
+
+def read_header_block(msg_file):
+    # reads no further than needed to find the first blank line;
+    # returns None if it's not there (or too far in)
+    data = ''
+    while len(data) < MAX_HEADER_BLOCK_SIZE:
+        chunk = msg_file.read(HEADER_READ_SIZE)
+        if not chunk:
+            return None
+        previous_size = len(data)
+        data += chunk
+        end = find_header_block_end(data, max(0, previous_size - 2))
+        if end >= 0:
+            return data[:end]
+    return None
+
+def scan_header_fields(header_block, field_names):
+    # Returns the raw values of the first occurrence of each of the
+    # (lowercase) field names, unfolded exactly as the email package
+    # would; or None if the block looks odd enough to require the
+    # full parser.
+    if '\r' in header_block.replace('\r\n', ''):
+        return None
+    values = {}
+    collecting = None
+    for line in header_block.splitlines(True):
+        if line[:1] in (' ', '\t'):
+            if collecting is False:
+                continue
+            elif collecting is None:
+                return None
+            values[collecting].append(line)
+            continue
+        match = HEADER_FIELD_LINE_RE.match(line)
+        if match is None:
+            return None
+        name = line[:match.end() - 1].lower()
+        if name in field_names and name not in values:
+            values[name] = [line[match.end():].lstrip()]
+            collecting = name
+        else:
+            collecting = False
+    return dict(
+            (name, ''.join(value_lines).rstrip('\r\n'))
+            for name, value_lines in values.items())
+
+def parse_header_fields(content, field_names):
+    # same as above, for messages that were fully read already
+    end = find_header_block_end(content[:MAX_HEADER_BLOCK_SIZE])
+    if end >= 0:
+        values = scan_header_fields(content[:end], field_names)
+        if values is not None:
+            return values
+    message = email.message_from_string(content)
+    return dict((name, message[name]) for name in field_names
+            if message[name] is not None)
+
+def read_header_fields(msg_file, field_names):
+    # header fields out of the header block alone, falling back to
+    # the full parser whenever the scan isn't conclusive
+    header_block = read_header_block(msg_file)
+    if header_block is not None:
+        values = scan_header_fields(header_block, field_names)
+        if values is not None:
+            return values
+    msg_file.seek(0)
+    return parse_header_fields(msg_file.read(), field_names)
+
+def is_corrupted_message_file(msg_file):
+    msg_file.seek(0, os.SEEK_END)
+    if msg_file.tell() < 3:
+        return False
+    msg_file.seek(-3, os.SEEK_END)
+    return msg_file.read(3) == '\x00\x00\x00'
+
+def parse_and_append_local_message_id(filepath):
     with open(filepath, 'rb') as msg_file:
-        content = msg_file.read()
-        if content.endswith('\x00\x00\x00'):
+        if is_corrupted_message_file(msg_file):
             log_error('cannot parse %s: corrupted' %
                     repr(os.path.basename(filepath)))
-            return
-        message = email.message_from_string(content)
-        message_id = message['message-id']
-        del message
-        del content
+            return (None, filepath)
+        msg_file.seek(0)
+        header_fields = read_header_fields(
+                msg_file, ('message-id',) + FINGERPRINT_FIELDS)
+        message_id = header_fields.get('message-id')
         if message_id is not None:
-            message_id = decode_header(message_id)
+            # stored as UTF-8 so that it reads back the same from the index
+            message_id = decode_header(message_id).encode('utf-8')
+        else:
+            message_id = read_message_fingerprint(msg_file, header_fields)
 
         if (message_id is None) or (len(message_id) == 0):
             log_error('cannot sync %s: invalid message id (%s)' %
                     (repr(filepath), repr(message_id)))
-        else:
-            return (message_id, filepath)
+            return (None, filepath)
+        return (message_id, filepath)
 
-#def imap_worker_die(signum, frame):
-def local_worker_die():
-    sys.exit(-1)
+def message_fingerprint(size, header_fields):
+    # '<fp:...>', a stand-in for the Message-ID of messages without
+    # one, out of what the server can tell without sending them over:
+    # their size (with CRLF line endings, as per RFC822.SIZE) and the
+    # (raw) values of FINGERPRINT_FIELDS; None if they have none of
+    # those. Copies of the same message get the same one, and so
+    # would two different messages the same in all of that.
+    if not any(name in header_fields for name in FINGERPRINT_FIELDS):
+        return None
+    fingerprint = hashlib.sha1('%d' % size)
+    for name in FINGERPRINT_FIELDS:
+        value = ' '.join(str(header_fields.get(name, '')).split())
+        fingerprint.update('\n%s:%s' % (name, value))
+    return '<fp:%s>' % fingerprint.hexdigest()
 
+def read_crlf_size(msg_file):
+    # the size of the message with every CR, LF or CRLF made into a
+    # CRLF, as it gets appended (see imap_append())
+    msg_file.seek(0)
+    size = 0
+    previous_chunk = ''
+    while True:
+        chunk = msg_file.read(FINGERPRINT_READ_SIZE)
+        if not chunk:
+            return size
+        size += (len(chunk) + chunk.count('\r') + chunk.count('\n')
+                - 2 * chunk.count('\r\n'))
+        if previous_chunk[-1:] == '\r' and chunk[:1] == '\n':
+            # a CRLF split across chunks
+            size -= 2
+        previous_chunk = chunk
 
-def fetch_local_message_ids(dirnames):
-    filepaths = []
-    for dirname in dirnames:
-        filenames = os.listdir(dirname)
-        log_info('listed %s' % dirname)
-        for filename in filenames:
-            filepath = os.path.join(dirname, filename)
-            if os.path.isfile(filepath):
-                filepaths.append(filepath)
+def read_message_fingerprint(msg_file, header_fields):
+    return message_fingerprint(read_crlf_size(msg_file), header_fields)
 
-    cache_filepath = 'cached_local_message_ids.pickle'
+def local_worker_parse_files(unindexed_files):
+    # results come back out of order; they carry what they're about
+    parsed_files = []
+    for dirname, filename, stat_key in unindexed_files:
+        message_id, _filepath = parse_and_append_local_message_id(
+                os.path.join(dirname, filename))
+        parsed_files.append((dirname, filename, stat_key, message_id))
+    return parsed_files
+
+def record_local_message_ids(parsed_rows_per_dirname):
+    for dirname, parsed_rows in parsed_rows_per_dirname.items():
+        db = open_local_index(dirname)
+        db.executemany(
+                'INSERT OR REPLACE INTO local_messages'
+                ' (filename, inode, size, mtime_ns,'
+                ' message_id, message_digest)'
+                ' VALUES (?, ?, ?, ?, ?, ?)', parsed_rows)
+        db.commit()
+        db.close()
+
+def local_index_filepath(dirname):
+    # one per directory, named after the hash of its real path
+    realpath = os.path.realpath(dirname)
+    if isinstance(realpath, unicode):
+        realpath = realpath.encode('utf-8')
+    return os.path.join(
+            LOCAL_INDEX_DIRPATH,
+            '%s.sqlite' % hashlib.sha1(realpath).hexdigest())
+
+def open_local_index(dirname):
+    if not os.path.isdir(LOCAL_INDEX_DIRPATH):
+        try:
+            os.makedirs(LOCAL_INDEX_DIRPATH)
+        except OSError:
+            # created by another worker in the meantime
+            if not os.path.isdir(LOCAL_INDEX_DIRPATH):
+                raise
+    db = sqlite3.connect(local_index_filepath(dirname))
+    db.text_factory = str
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS local_messages (
+            filename TEXT PRIMARY KEY,
+            inode INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            message_id TEXT);
+        """)
+    upgrade_index(db, 'local_messages')
+    db.execute(
+            'CREATE INDEX IF NOT EXISTS local_messages_by_digest'
+            ' ON local_messages (message_digest)')
+    db.commit()
+    return db
+
+def list_dir_entries(dirname):
+    # returns (name, is_dir, stat) tuples, stat being None for
+    # directories; with scandir, the entry types come from the directory
+    # itself (d_type), so only regular files get stat()ed
+    entries = []
+    if scandir is not None:
+        for entry in scandir(dirname):
+            if entry.is_dir(follow_symlinks=False):
+                entries.append((entry.name, True, None))
+            elif entry.is_file():
+                entries.append((entry.name, False, entry.stat()))
+        return entries
+    for name in os.listdir(dirname):
+        filestat = os.stat(os.path.join(dirname, name))
+        if stat.S_ISDIR(filestat.st_mode):
+            if not os.path.islink(os.path.join(dirname, name)):
+                entries.append((name, True, None))
+        elif stat.S_ISREG(filestat.st_mode):
+            entries.append((name, False, filestat))
+    return entries
+
+def list_local_files(dirname):
+    # returns (filename, (inode, size, mtime_ns)) pairs
+    local_files = []
+    for filename, is_dir, filestat in list_dir_entries(dirname):
+        # maildir filenames never start with a dot; the index does
+        if filename.startswith('.') or is_dir:
+            continue
+        local_files.append(
+                (filename,
+                    (filestat.st_ino, filestat.st_size,
+                        int(round(filestat.st_mtime * 1e9)))))
+    log_info('listed %s' % dirname)
+    return local_files
+
+def walk_local_dir(dirname, is_given):
+    # returns (message directories, directories to walk) found within
+    # dirname: the cur/ and new/ of every maildir (Maildir++ subfolders,
+    # which start with a dot, included) but not their tmp/. Directories
+    # given with no cur/ or new/ of their own, but with files in them,
+    # are taken as message directories themselves
+    message_dirnames = []
+    walk_dirnames = []
+    has_files = False
+    for name, is_dir, _filestat in list_dir_entries(dirname):
+        if not is_dir:
+            has_files = has_files or not name.startswith('.')
+        elif name in ('cur', 'new'):
+            message_dirnames.append(os.path.join(dirname, name))
+        elif name != 'tmp':
+            walk_dirnames.append(os.path.join(dirname, name))
+    if is_given and has_files and not message_dirnames:
+        message_dirnames.append(dirname)
+    return (message_dirnames, walk_dirnames)
+
+def index_local_dir(dirname):
+    # returns (files count, unindexed files), forgetting about the
+    # indexed files that are gone
+    local_files = list_local_files(dirname)
+    db = open_local_index(dirname)
+    indexed_stat_keys = dict(
+            (filename, (inode, size, mtime_ns))
+            for filename, inode, size, mtime_ns in db.execute(
+                'SELECT filename, inode, size, mtime_ns'
+                ' FROM local_messages'))
+    # cache hits are settled here, in the parent; the local workers
+    # only ever get the files that need parsing
+    unindexed_files = []
+    for filename, stat_key in local_files:
+        if indexed_stat_keys.pop(filename, None) != stat_key:
+            unindexed_files.append((dirname, filename, stat_key))
+    db.executemany(
+            'DELETE FROM local_messages WHERE filename = ?',
+            [(filename,) for filename in indexed_stat_keys])
+    db.commit()
+    db.close()
+    return (len(local_files), unindexed_files)
+
+def scan_local_dirs(walker_pool, given_dirnames, scanned_dirs):
+    # yields the unindexed files of every message directory found within
+    # given_dirnames, as they're found; the directories are walked (and
+    # listed) by the threads in walker_pool, and get appended to
+    # scanned_dirs, along with their files count, once listed
+    tasks = deque()
+    seen_dirnames = set()
+
+    def add_task(func, dirname, *args):
+        dirname = os.path.normpath(dirname)
+        if (func, dirname) not in seen_dirnames:
+            seen_dirnames.add((func, dirname))
+            tasks.append((func, dirname,
+                walker_pool.apply_async(func, (dirname,) + args)))
+
+    for dirname in given_dirnames:
+        if os.path.basename(os.path.normpath(dirname)) in ('cur', 'new'):
+            add_task(index_local_dir, dirname)
+        else:
+            add_task(walk_local_dir, dirname, True)
+    while tasks:
+        func, dirname, result = tasks.popleft()
+        if func is walk_local_dir:
+            message_dirnames, walk_dirnames = result.get(POOL_RESULT_TIMEOUT)
+            for message_dirname in message_dirnames:
+                add_task(index_local_dir, message_dirname)
+            for walk_dirname in walk_dirnames:
+                add_task(walk_local_dir, walk_dirname, False)
+        else:
+            files_count, unindexed_files = result.get(POOL_RESULT_TIMEOUT)
+            scanned_dirs.append((dirname, files_count))
+            METRICS.count('local_files', files_count)
+            for unindexed_file in unindexed_files:
+                yield unindexed_file
+
+def local_message_digest_rows(db, dir_index, dirs_count):
+    # local refs encode both the directory and the row within its index
+    for digest, rowid in db.execute(
+            'SELECT message_digest, rowid FROM local_messages'
+            ' WHERE message_digest IS NOT NULL ORDER BY message_digest'):
+        yield (digest, rowid * dirs_count + dir_index)
+
+def lookup_local_message_files(dirnames, refs):
+    # (filepath, message_id, size) for each of the local refs
+    dbs = {}
     try:
-        with open(cache_filepath, 'rb') as cache_f:
-            cached_id_per_file = pickle.load(cache_f)
-    except Exception:
-        cached_id_per_file = {}
+        for ref in sorted(refs):
+            rowid, dir_index = divmod(ref, len(dirnames))
+            if dir_index not in dbs:
+                dbs[dir_index] = open_local_index(dirnames[dir_index])
+            row = dbs[dir_index].execute(
+                    'SELECT filename, message_id, size FROM local_messages'
+                    ' WHERE rowid = ?', (rowid,)).fetchone()
+            if row is not None:
+                filename, message_id, size = row
+                yield (os.path.join(dirnames[dir_index], filename),
+                        message_id, size)
+    finally:
+        for db in dbs.values():
+            db.close()
 
-    log_notice('attempting to fetch message ids out of %d files' %
-            len(filepaths))
-    worker_pool = Pool(
-            MAX_LOCAL_WORKERS, local_worker_init, [cached_id_per_file])
+def fetch_local_message_ids(given_dirnames, worker_pool=None,
+        on_parsed=None):
+    # returns (message directories, digests, refs); the local workers
+    # start parsing as soon as the first unindexed files are found.
+    # worker_pool is left running if given (see LocalScan), and
+    # on_parsed gets called with every chunk of parsed files
+    is_own_pool = worker_pool is None
+    if is_own_pool:
+        worker_pool = Pool(MAX_LOCAL_WORKERS, local_worker_init)
+    # started after the workers have been forked
+    walker_pool = ThreadPool(MAX_WALKER_THREADS)
+    scanned_dirs = []
     try:
-        file_per_id_pairs = worker_pool.map(
-                parse_and_append_local_message_id, filepaths)
-        defined_file_per_id_pairs = filter(
-                lambda v: v is not None, file_per_id_pairs)
-        new_cached_id_per_file = dict(
-                [(v, k) for k, v in defined_file_per_id_pairs])
-        file_per_id = dict(defined_file_per_id_pairs)
-
-        invalid_count = len(file_per_id_pairs) - len(defined_file_per_id_pairs)
-        del file_per_id_pairs
-        repeated_count = len(defined_file_per_id_pairs) - len(file_per_id)
-        del defined_file_per_id_pairs
+        log_notice('attempting to fetch message ids out of %s' % (
+            ', '.join(map(repr, given_dirnames))))
+        # indexed as they come, LOCAL_COMMIT_FILES at a time, so that an
+        # interrupted run needn't parse them again
+        parsed_rows_per_dirname = {}
+        parsed_count = 0
+        log_progress = progress_logger('parsed', None)
+        pending_count = 0
+        for parsed_files in pool_imap_unordered(
+                worker_pool, local_worker_parse_files,
+                iter_chunks(
+                    scan_local_dirs(
+                        walker_pool, given_dirnames, scanned_dirs),
+                    LOCAL_CHUNK_SIZE),
+                LOCAL_WINDOW_TASKS):
+            for (dirname, filename, (inode, size, mtime_ns),
+                    message_id) in parsed_files:
+                parsed_rows_per_dirname.setdefault(dirname, []).append(
+                        (filename, inode, size, mtime_ns,
+                            message_id, message_id_digest(message_id)))
+            if on_parsed is not None:
+                on_parsed(parsed_files)
+            parsed_count += len(parsed_files)
+            pending_count += len(parsed_files)
+            METRICS.count('local_files_parsed', len(parsed_files))
+            METRICS.count('local_bytes_parsed', sum(
+                stat_key[1] for _, _, stat_key, _ in parsed_files))
+            log_progress(parsed_count)
+            if pending_count >= LOCAL_COMMIT_FILES:
+                record_local_message_ids(parsed_rows_per_dirname)
+                parsed_rows_per_dirname = {}
+                pending_count = 0
+        record_local_message_ids(parsed_rows_per_dirname)
+        if is_own_pool:
+            worker_pool.terminate()
+        walker_pool.terminate()
+        del parsed_rows_per_dirname
+        dirnames = [dirname for dirname, _files_count in scanned_dirs]
+        files_count = sum(
+                files_count for _dirname, files_count in scanned_dirs)
+
+        dbs = [open_local_index(dirname) for dirname in dirnames]
+        invalid_count = sum(
+                db.execute(
+                    'SELECT COUNT(*) FROM local_messages'
+                    ' WHERE message_digest IS NULL').fetchone()[0]
+                for db in dbs)
+        digests, refs = load_message_digests(
+                heapq.merge(*[
+                    local_message_digest_rows(db, dir_index, len(dbs))
+                    for dir_index, db in enumerate(dbs)]),
+                INT64_TYPECODE)
+        for db in dbs:
+            db.close()
+        del dbs
+        repeated_count = files_count - invalid_count - len(digests)
 
         log_notice(
                 'successfully fetched %d message ids'
-                ' (%d were invalid, %d were repeated) out of %d files' %
-                (len(file_per_id), invalid_count,
-                    repeated_count, len(filepaths)))
-        worker_pool.terminate()
-        with open(cache_filepath, 'wb') as cache_f:
-            cached_id_per_file.update(new_cached_id_per_file)
-            pickle.dump(cached_id_per_file, cache_f)
-        del new_cached_id_per_file
-        del cached_id_per_file
-        return file_per_id
+                ' (%d were invalid, %d were repeated) out of %d files'
+                ' (%d parsed) in %d directories' %
+                (len(digests), invalid_count, repeated_count,
+                    files_count, parsed_count, len(dirnames)))
+        return (dirnames, digests, refs)
     except Exception as e:
         log_error("rage quitting on fetch_local_message_ids: %s" % repr(e))
         worker_pool.terminate()
         worker_pool.join()
-        sys.exit(-1)
+        walker_pool.terminate()
+        raise SyncError('fetching local message ids failed')
 
 def run(run_type, hostname, username, password, folder_name, dirnames):
     assert (run_type in ['dry', 'dry_sync', 'sync'])
-    local_file_per_id = fetch_local_message_ids(dirnames)
-    remote_ids = fetch_imap_message_ids(
-            hostname, username, password, folder_name)
-    if run_type == 'dry':
-        local_ids = frozenset(local_file_per_id.keys())
-        only_remote = remote_ids - local_ids
-        only_local = local_ids - remote_ids
-        common = remote_ids & local_ids
-        log_notice('found %d remote-only, %d local-only, %d common IDs' % (
-            len(only_remote), len(only_local), len(common)))
-    elif run_type == 'dry_sync':
-        sync(local_file_per_id, remote_ids,
-                hostname, username, password, folder_name, True)
-    elif run_type == 'sync':
-        sync(local_file_per_id, remote_ids,
-                hostname, username, password, folder_name, False)
+    global METRICS
+    METRICS = RunMetrics()
+    budget = ImapWorkerBudget(MAX_IMAP_WORKERS)
+    try:
+        run_phases(run_type, hostname, username, password, folder_name,
+                dirnames, budget)
+        METRICS.succeeded = True
+    finally:
+        write_metrics(hostname, username, folder_name, budget)
+
+def write_metrics(hostname, username, folder_name, budget):
+    if METRICS_DIRNAME is None:
+        return
+    try:
+        METRICS.write(
+                [('hostname', hostname), ('username', username),
+                    ('folder', folder_name)],
+                budget)
+    except Exception as e:
+        log_error('couldn\'t write metrics: %s' % repr(e))
+
+def run_phases(run_type, hostname, username, password, folder_name,
+        dirnames, budget):
+    # a single pool of IMAP workers for the whole run, each keeping its
+    # connection (logged in, with the folder selected) from discovery
+    # to the last append; both pools get forked before the local scan
+    # starts its threads
+    worker_pool = Pool(
+            MAX_IMAP_WORKERS, imap_worker_init,
+            [hostname, username, password, folder_name, budget])
+    local_worker_pool = Pool(MAX_LOCAL_WORKERS, local_worker_init)
+    try:
+        # the local side gets scanned meanwhile
+        local_scan = LocalScan(dirnames, local_worker_pool)
+        with METRICS.phase('remote_scan'):
+            remote_digests = fetch_imap_message_ids(
+                    worker_pool, hostname, username, folder_name)
+        if run_type == 'sync':
+            # files parsed from now on that are missing get appended
+            # right away, rather than after the diff; dry syncs, which
+            # don't really append them, leave it all to the diff
+            local_scan.confirm_missing(remote_digests)
+            with METRICS.phase('transfer'):
+                appended_count = append_local_files(
+                        worker_pool, local_scan.missing_files(), None,
+                        hostname, username, folder_name, False)
+            if appended_count > 0:
+                log_notice('appended %d messages while the local scan'
+                        ' went on' % appended_count)
+                # those are in the remote index by now (with UIDPLUS),
+                # or else fetched as new ones
+                del remote_digests
+                with METRICS.phase('remote_scan'):
+                    remote_digests = fetch_imap_message_ids(
+                            worker_pool, hostname, username, folder_name)
+        dirnames, local_digests, local_refs = local_scan.wait()
+        local_worker_pool.terminate()
+
+        only_local, only_remote, common_count = diff_message_digests(
+                local_digests, remote_digests)
+        del remote_digests
+        only_local_refs = array.array(
+                INT64_TYPECODE,
+                (local_refs[position] for position in only_local))
+        if run_type == 'dry':
+            log_notice('found %d remote-only, %d local-only, %d common IDs' % (
+                len(only_remote), len(only_local_refs), common_count))
+        else:
+            with METRICS.phase('transfer'):
+                sync(worker_pool, dirnames, only_local_refs,
+                        hostname, username, folder_name,
+                        run_type == 'dry_sync')
+    finally:
+        local_worker_pool.terminate()
+        worker_pool.terminate()
+        worker_pool.join()
 
 if __name__ == '__main__':
     # Single directory (dry run):
@@ -369,10 +1900,18 @@ if __name__ == '__main__':
     #   python -OO maildir2imap.py sync imap.gmail.com \
     #       user@gmail.com 'password' '[Gmail]/All Mail' ~/Maildir/cur
     #
-    # Multiple directories (sync):
-    #   find ~/Maildir -type d \( -name cur -or -name new \) \
-    #       | sed 's/^\|$/\"/g' \
-    #       | xargs python -OO maildir2imap.py sync imap.gmail.com \
-    #           user@gmail.com 'password' '[Gmail]/All Mail'
+    # Whole maildir, subfolders included (sync):
+    #   python -OO maildir2imap.py sync imap.gmail.com \
+    #       user@gmail.com 'password' '[Gmail]/All Mail' ~/Maildir
     #
-    run(*(sys.argv[1:6] + [sys.argv[6:]]))
+    try:
+        run(*(sys.argv[1:6] + [sys.argv[6:]]))
+    except SyncError as e:
+        # logged already; so are the metrics, if asked for
+        log_error('giving up: %s' % e)
+        sys.exit(-1)
+    except KeyboardInterrupt:
+        # whatever got transferred (or indexed) so far was committed
+        # as it went, so the next run picks up from there
+        log_notice('interrupted')
+        sys.exit(-1)